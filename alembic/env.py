@@ -26,11 +26,14 @@ if config.config_file_name is not None:
 
 from rainfall.db import Base
 from rainfall.models.artwork import Artwork
+from rainfall.models.build_run import BuildRun
 from rainfall.models.file import File
 from rainfall.models.integration import Integration
 from rainfall.models.mastodon_credential import MastodonCredential
+from rainfall.models.object_purge import ObjectPurge
 from rainfall.models.release import Release
 from rainfall.models.site import Site
+from rainfall.models.transcode_blob import TranscodeBlob
 from rainfall.models.user import User
 
 target_metadata = Base.metadata
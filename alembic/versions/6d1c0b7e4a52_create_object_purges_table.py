@@ -0,0 +1,31 @@
+"""create object purges table
+
+Revision ID: 6d1c0b7e4a52
+Revises: 20a525107a88
+Create Date: 2026-10-18 10:12:37.204118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '6d1c0b7e4a52'
+down_revision: Union[str, None] = '20a525107a88'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+  op.create_table(
+      'object_purges', sa.Column('id', sa.Uuid(), nullable=False),
+      sa.Column('prefix', sa.String(length=1024), nullable=False),
+      sa.Column('created_at', sa.DateTime(), nullable=False),
+      sa.Column('attempts', sa.Integer(), nullable=False),
+      sa.Column('last_error', sa.Text(), nullable=True),
+      sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade() -> None:
+  op.drop_table('object_purges')
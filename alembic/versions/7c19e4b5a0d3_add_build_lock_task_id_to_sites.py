@@ -0,0 +1,27 @@
+"""add build lock task id to sites
+
+Revision ID: 7c19e4b5a0d3
+Revises: e5b27c9f4a13
+Create Date: 2026-10-18 18:05:37.412580
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '7c19e4b5a0d3'
+down_revision: Union[str, None] = 'e5b27c9f4a13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+  op.add_column(
+      'sites',
+      sa.Column('build_lock_task_id', sa.String(length=255), nullable=True))
+
+
+def downgrade() -> None:
+  op.drop_column('sites', 'build_lock_task_id')
@@ -0,0 +1,29 @@
+"""Add build fingerprint to sites
+
+Revision ID: b7e2d94f1c3a
+Revises: 6d1c0b7e4a52
+Create Date: 2026-10-18 11:02:45.118394
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2d94f1c3a'
+down_revision: Union[str, None] = '6d1c0b7e4a52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+  op.add_column(
+      'sites', sa.Column('build_fingerprint',
+                         sa.String(length=64),
+                         nullable=True))
+
+
+def downgrade() -> None:
+  op.drop_column('sites', 'build_fingerprint')
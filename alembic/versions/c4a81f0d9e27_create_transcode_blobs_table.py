@@ -0,0 +1,33 @@
+"""create transcode blobs table
+
+Revision ID: c4a81f0d9e27
+Revises: b7e2d94f1c3a
+Create Date: 2026-10-18 12:21:09.583127
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a81f0d9e27'
+down_revision: Union[str, None] = 'b7e2d94f1c3a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+  op.create_table('transcode_blobs',
+                  sa.Column('sha256', sa.String(length=64), nullable=False),
+                  sa.Column('size', sa.BigInteger(), nullable=False),
+                  sa.Column('last_used_at', sa.DateTime(), nullable=False),
+                  sa.Column('dedup_count', sa.Integer(), nullable=False),
+                  sa.PrimaryKeyConstraint('sha256'))
+  op.create_index('ix_transcode_blobs_last_used_at', 'transcode_blobs',
+                  ['last_used_at'])
+
+
+def downgrade() -> None:
+  op.drop_index('ix_transcode_blobs_last_used_at', 'transcode_blobs')
+  op.drop_table('transcode_blobs')
@@ -0,0 +1,35 @@
+"""Add build queue to sites
+
+Revision ID: d91f3a6c2b08
+Revises: c4a81f0d9e27
+Create Date: 2026-10-18 13:40:52.671920
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'd91f3a6c2b08'
+down_revision: Union[str, None] = 'c4a81f0d9e27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+  op.add_column(
+      'sites',
+      sa.Column('build_queued_task_id', sa.String(length=255), nullable=True))
+  op.add_column('sites', sa.Column('build_queued_at',
+                                   sa.DateTime(),
+                                   nullable=True))
+  op.add_column('sites',
+                sa.Column('build_lock_until', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+  op.drop_column('sites', 'build_lock_until')
+  op.drop_column('sites', 'build_queued_at')
+  op.drop_column('sites', 'build_queued_task_id')
@@ -0,0 +1,52 @@
+"""create build runs table
+
+Revision ID: e5b27c9f4a13
+Revises: d91f3a6c2b08
+Create Date: 2026-10-18 15:02:44.218734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5b27c9f4a13'
+down_revision: Union[str, None] = 'd91f3a6c2b08'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+  op.create_table(
+      'build_runs', sa.Column('id', sa.Uuid(), nullable=False),
+      sa.Column('site_id', sa.Uuid(), nullable=False),
+      sa.Column('task_id', sa.String(length=255), nullable=True),
+      sa.Column('status', sa.String(length=16), nullable=False),
+      sa.Column('queued_at', sa.DateTime(), nullable=True),
+      sa.Column('started_at', sa.DateTime(), nullable=False),
+      sa.Column('finished_at', sa.DateTime(), nullable=True),
+      sa.Column('queue_seconds', sa.Float(), nullable=True),
+      sa.Column('download_seconds', sa.Float(), nullable=True),
+      sa.Column('eno_seconds', sa.Float(), nullable=True),
+      sa.Column('faircamp_seconds', sa.Float(), nullable=True),
+      sa.Column('publish_seconds', sa.Float(), nullable=True),
+      sa.Column('zip_seconds', sa.Float(), nullable=True),
+      sa.Column('cleanup_seconds', sa.Float(), nullable=True),
+      sa.Column('download_files', sa.Integer(), nullable=True),
+      sa.Column('download_bytes', sa.BigInteger(), nullable=True),
+      sa.Column('download_cached', sa.Integer(), nullable=True),
+      sa.Column('publish_files', sa.Integer(), nullable=True),
+      sa.Column('publish_bytes', sa.BigInteger(), nullable=True),
+      sa.Column('zip_bytes', sa.BigInteger(), nullable=True),
+      sa.Column('faircamp_version', sa.String(length=255), nullable=True),
+      sa.Column('faircamp_exit_status', sa.Integer(), nullable=True),
+      sa.Column('faircamp_output_tail', sa.Text(), nullable=True),
+      sa.ForeignKeyConstraint(['site_id'], ['sites.id'], ondelete='CASCADE'),
+      sa.PrimaryKeyConstraint('id'))
+  op.create_index('ix_build_runs_site_id', 'build_runs', ['site_id'])
+
+
+def downgrade() -> None:
+  op.drop_index('ix_build_runs_site_id', 'build_runs')
+  op.drop_table('build_runs')
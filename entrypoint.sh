@@ -5,5 +5,5 @@ if [[ $# -gt 0 ]]; then
     exec "$@"
 else
     # Else default to starting the server
-    exec "pipenv run gunicorn --error-logfile - --access-logfile - -b 0.0.0.0 rainfall.main:create_app()"
+    exec "pipenv run gunicorn --worker-class gthread --threads 8 --error-logfile - --access-logfile - -b 0.0.0.0 rainfall.main:create_app()"
 fi
\ No newline at end of file
@@ -1,5 +1,3 @@
-import os
-import shutil
 from uuid import UUID
 
 import flask
@@ -9,7 +7,9 @@ from rainfall.db import db
 from rainfall.decorators import with_current_user, with_validated_release
 from rainfall.models.release import Release
 from rainfall.models.site import Site
-from rainfall.site import release_path, rename_release_dir
+from rainfall.purge import enqueue_purge, schedule_purge
+from rainfall.site import (file_object_path, release_object_path,
+                           rename_release_dir, site_preview_prefixes)
 
 release = flask.Blueprint('release', __name__)
 
@@ -71,11 +71,9 @@ def get_release_artwork(release, user):
   if release.artwork is None:
     flask.abort(404)
 
-  path = os.path.join(
-      release_path(flask.current_app.config['DATA_DIR'], release),
-      release.artwork.filename)
-  file = object_storage.get_object(path)
-  return flask.send_file(file, download_name=release.artwork.filename)
+  path = file_object_path(flask.current_app.config['DATA_DIR'],
+                          release.artwork)
+  return object_storage.serve_object(path, release.artwork.filename)
 
 
 @release.route('release/<release_id>/description', methods=['POST'])
@@ -111,7 +109,14 @@ def update_release_name(release, user):
 
   old_name = release.name
   release.name = name
-  rename_release_dir(flask.current_app.config['DATA_DIR'], release, old_name)
+  try:
+    rename_release_dir(flask.current_app.config['DATA_DIR'], release, old_name)
+  except FileExistsError:
+    db.session.rollback()
+    return flask.jsonify(
+        status=400,
+        error=f'A release with a name too similar to "{name}" already exists'
+    ), 400
 
   db.session.add(release)
   db.session.commit()
@@ -122,15 +127,18 @@ def update_release_name(release, user):
 @with_current_user
 @with_validated_release
 def delete_release(release, user):
+  # The objects are deleted in the background, see delete_site. The site's
+  # preview and saved faircamp cache still hold the release's songs, so they
+  # go too, until the site is built again.
+  config = flask.current_app.config
+  purges = [
+      schedule_purge(path)
+      for path in (release_object_path(config['DATA_DIR'], release),
+                   *site_preview_prefixes(config['PREVIEW_DIR'], release.site))
+  ]
   db.session.delete(release)
-
-  try:
-    path = release_path(flask.current_app.config['DATA_DIR'], release)
-    object_storage.rmtree(path)
-  except Exception as e:
-    db.session.rollback()
-    return flask.jsonify(
-        status=500, error='Could not delete release (filesystem error)'), 500
-
   db.session.commit()
+
+  for purge in purges:
+    enqueue_purge(purge.id)
   return '', 204
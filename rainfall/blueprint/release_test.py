@@ -1,16 +1,19 @@
 import os
 from unittest.mock import patch
 
+from sqlalchemy import select
 from uuid_extensions import uuid7
 
 from rainfall import object_storage
 from rainfall.conftest import BASIC_USER_ID
 from rainfall.db import db
 from rainfall.models.artwork import Artwork
+from rainfall.models.object_purge import ObjectPurge
 from rainfall.models.release import Release
 from rainfall.models.site import Site
 from rainfall.models.user import User
-from rainfall.site import release_path, site_path
+from rainfall.purge import purge_objects
+from rainfall.site import release_object_path, site_preview_prefixes
 
 
 class ReleaseTest:
@@ -205,6 +208,21 @@ class ReleaseTest:
       assert rv.status == '200 OK'
       assert rv.text == 'not-actually-artwork'
 
+  def test_get_release_artwork_presigned_redirect(self, app, releases_user,
+                                                 artwork_file):
+    app.config['MINIO_PRESIGNED_REDIRECTS'] = True
+    with app.app_context():
+      db.session.add(releases_user)
+      release_id = releases_user.sites[0].releases[0].id
+
+    with app.test_client() as client:
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/api/v1/release/{release_id}/artwork')
+      assert rv.status == '302 FOUND'
+      assert 'X-Amz-Signature=' in rv.headers['Location']
+
   def test_get_release_artwork_not_found(self, app, releases_user):
     with app.app_context(), app.test_client() as client:
       db.session.add(releases_user)
@@ -299,7 +317,8 @@ class ReleaseTest:
       db.session.refresh(release)
       assert release.name == cur_release_name
 
-  def test_delete_release(self, app, releases_user):
+  @patch('rainfall.blueprint.release.enqueue_purge')
+  def test_delete_release(self, mock_enqueue, app, releases_user):
     with app.app_context(), app.test_client() as client:
       db.session.add(releases_user)
       release = releases_user.sites[0].releases[1]
@@ -317,11 +336,23 @@ class ReleaseTest:
       for file in files:
         assert file not in db.session
       assert release not in releases_user.sites[0].releases
+      assert db.session.get(Release, release_id) is None
+
+      purges = db.session.scalars(select(ObjectPurge)).all()
+      assert sorted(purge.prefix for purge in purges) == sorted([
+          release_object_path(app.config['DATA_DIR'], release),
+          *site_preview_prefixes(app.config['PREVIEW_DIR'],
+                                 releases_user.sites[0])
+      ])
+      assert mock_enqueue.call_count == 3
+
+      for purge in purges:
+        purge_objects(str(purge.id))
       assert not any(
           object_client.list_objects(app.config['MINIO_BUCKET'],
-                                     prefix=release_path(
+                                     prefix=release_object_path(
                                          app.config['DATA_DIR'], release)))
-      assert db.session.get(Release, release_id) is None
+      assert not db.session.scalars(select(ObjectPurge)).all()
 
   def test_delete_release_not_exist(self, app, basic_user):
     with app.app_context(), app.test_client() as client:
@@ -332,23 +363,21 @@ class ReleaseTest:
       assert rv.status == '404 NOT FOUND'
 
   @patch('rainfall.blueprint.release.object_storage.rmtree')
-  def test_delete_release_filesystem_error(self, mock_rmtree, app,
-                                           releases_user):
+  @patch('rainfall.blueprint.release.enqueue_purge')
+  def test_delete_release_does_not_wait_for_objects(self, mock_enqueue,
+                                                    mock_rmtree, app,
+                                                    releases_user):
     with app.app_context(), app.test_client() as client:
       db.session.add(releases_user)
       release = releases_user.sites[0].releases[0]
       release_id = release.id
-      mock_rmtree.side_effect = object_storage.ObjectStorageException(
-          'Test error')
 
       with client.session_transaction() as sess:
         sess['user_id'] = BASIC_USER_ID
 
       rv = client.delete(f'/api/v1/release/{release_id}')
 
-      mock_rmtree.assert_called_once_with(
-          release_path(app.config['DATA_DIR'], release))
-      assert rv.status == '500 INTERNAL SERVER ERROR'
-      assert 'error' in rv.json
-      assert db.session.get(Release, release_id) is not None
-      assert release in releases_user.sites[0].releases
+      assert rv.status == '204 NO CONTENT'
+      mock_rmtree.assert_not_called()
+      assert mock_enqueue.call_count == 3
+      assert db.session.get(Release, release_id) is None
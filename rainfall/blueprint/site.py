@@ -4,12 +4,15 @@ import shutil
 from uuid import UUID
 
 import flask
+from sqlalchemy import select
 
-from rainfall import object_storage
 from rainfall.db import db
 from rainfall.decorators import with_current_site, with_current_user
+from rainfall.models.build_run import BuildRun
 from rainfall.models.site import Site
-from rainfall.site import rename_site_dir, site_path
+from rainfall.purge import enqueue_purge, schedule_purge
+from rainfall.site import (rename_site_dir, site_object_path, site_path,
+                           site_preview_prefixes)
 
 site = flask.Blueprint('site', __name__)
 
@@ -62,22 +65,43 @@ def get_site(site, user):
   return flask.jsonify(site.serialize())
 
 
+@site.route('/site/<site_id>/builds')
+@with_current_user
+@with_current_site
+def list_builds(site, user):
+  try:
+    limit = int(flask.request.args.get('limit', 20))
+  except ValueError:
+    return flask.jsonify(status=400, error='Invalid limit'), 400
+  if not 1 <= limit <= 100:
+    return flask.jsonify(status=400,
+                         error='Limit must be between 1 and 100'), 400
+
+  # Ids are time ordered, for builds that started at the same time.
+  runs = db.session.execute(
+      select(BuildRun).where(BuildRun.site_id == site.id).order_by(
+          BuildRun.started_at.desc(),
+          BuildRun.id.desc()).limit(limit)).scalars()
+  return flask.jsonify({'builds': [run.serialize() for run in runs]})
+
+
 @site.route('/site/<site_id>', methods=['DELETE'])
 @with_current_user
 @with_current_site
 def delete_site(site, user):
+  # The objects are deleted in the background, so that the request doesn't
+  # wait for however many objects the site has.
+  config = flask.current_app.config
+  purges = [
+      schedule_purge(path)
+      for path in (site_object_path(config['DATA_DIR'], site),
+                   *site_preview_prefixes(config['PREVIEW_DIR'], site))
+  ]
   db.session.delete(site)
-
-  try:
-    path = site_path(flask.current_app.config['DATA_DIR'], site)
-    object_storage.rmtree(path)
-  except Exception as e:
-    db.session.rollback()
-    log.exception('Could not delete site id=%s', site.id)
-    return flask.jsonify(status=500,
-                         error='Could not delete site (filesystem error)'), 500
-
   db.session.commit()
+
+  for purge in purges:
+    enqueue_purge(purge.id)
   return '', 204
 
 
@@ -100,7 +124,14 @@ def rename_site(site, user):
 
   old_name = site.name
   site.name = new_name
-  rename_site_dir(flask.current_app.config['DATA_DIR'], site, old_name)
+  try:
+    rename_site_dir(flask.current_app.config['DATA_DIR'], site, old_name)
+  except FileExistsError:
+    db.session.rollback()
+    return flask.jsonify(
+        status=400,
+        error=f'A site with a name too similar to "{new_name}" already exists'
+    ), 400
 
   db.session.add(site)
   db.session.commit()
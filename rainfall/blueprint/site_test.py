@@ -1,16 +1,22 @@
+import io
 import os
-from unittest.mock import patch
+from datetime import datetime
+from unittest.mock import MagicMock, patch
 
 import flask
 import pytest
+from sqlalchemy import select
 from uuid_extensions import uuid7
 
 from rainfall import object_storage
 from rainfall.conftest import BASIC_USER_ID
 from rainfall.db import db
+from rainfall.models.build_run import BuildRun
+from rainfall.models.object_purge import ObjectPurge
 from rainfall.models.site import Site
 from rainfall.models.user import User
-from rainfall.site import site_path
+from rainfall.purge import purge_objects
+from rainfall.site import site_object_path, site_path, site_preview_prefixes
 
 
 class SiteTest:
@@ -105,6 +111,51 @@ class SiteTest:
       sites = data.get('sites')
       assert len(sites) == 0
 
+  def test_list_builds(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      for i in range(3):
+        db.session.add(
+            BuildRun(site_id=site.id,
+                     status='success',
+                     started_at=datetime(2026, 1, 1 + i),
+                     faircamp_seconds=float(i)))
+      db.session.add(
+          BuildRun(site_id=sites_user.sites[1].id, status='success'))
+      db.session.commit()
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/api/v1/site/{site.id}/builds?limit=2')
+
+      assert rv.status == '200 OK'
+      builds = rv.json['builds']
+      assert [build['faircamp_seconds'] for build in builds] == [2.0, 1.0]
+      assert builds[0]['status'] == 'success'
+
+  def test_list_builds_invalid_limit(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/api/v1/site/{site.id}/builds?limit=1000')
+
+      assert rv.status == '400 BAD REQUEST'
+
+  def test_list_builds_no_user(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+
+      rv = client.get(f'/api/v1/site/{site.id}/builds')
+
+      assert rv.status == '401 UNAUTHORIZED'
+
   @patch('rainfall.blueprint.site.rename_site_dir')
   def test_rename_site(self, mock_rename_dir, app, sites_user):
     with app.app_context(), app.test_client() as client:
@@ -126,6 +177,23 @@ class SiteTest:
       site = db.session.get(Site, site_id)
       assert site.name == 'New Name'
 
+  def test_rename_site_similar_name(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site_id = sites_user.sites[0].id
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.post(f'/api/v1/site/{site_id}/name',
+                       json={'name': 'Another Cool Site!'})
+      assert rv.status == '400 BAD REQUEST'
+      assert 'error' in rv.json
+
+    with app.app_context():
+      site = db.session.get(Site, site_id)
+      assert site.name == 'Cool Site 1'
+
   def test_rename_site_no_user(self, app, sites_user):
     with app.app_context(), app.test_client() as client:
       db.session.add(sites_user)
@@ -170,10 +238,20 @@ class SiteTest:
       assert rv.status == '400 BAD REQUEST'
       assert 'error' in rv.json
 
-  def test_delete_site(self, app, sites_user):
+  @patch('rainfall.blueprint.site.enqueue_purge')
+  def test_delete_site(self, mock_enqueue, app, releases_user):
     with app.app_context(), app.test_client() as client:
-      db.session.add(sites_user)
-      site_id = sites_user.sites[0].id
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+      site_id = site.id
+      path = site_object_path(app.config['DATA_DIR'], site)
+      assert object_storage.path_exists(path, recursive=True)
+      preview_paths = site_preview_prefixes(app.config['PREVIEW_DIR'], site)
+      for name in ('public/index.html', 'manifest.json'):
+        object_storage.put_object(f'{preview_paths[0]}{name}',
+                                  io.BytesIO(b'{}'), 'text/plain')
+      object_storage.put_object(f'{preview_paths[1]}faircamp-cache.json',
+                                io.BytesIO(b'{}'), 'application/json')
 
       with client.session_transaction() as sess:
         sess['user_id'] = BASIC_USER_ID
@@ -184,6 +262,17 @@ class SiteTest:
       site = db.session.get(Site, site_id)
       assert site is None
 
+      purges = db.session.scalars(select(ObjectPurge)).all()
+      assert sorted(purge.prefix for purge in purges) == sorted(
+          [path, *preview_paths])
+      assert sorted(call.args[0] for call in mock_enqueue.call_args_list) == (
+          sorted(purge.id for purge in purges))
+
+      for purge in purges:
+        purge_objects(str(purge.id))
+      for prefix in (path, *preview_paths):
+        assert not object_storage.path_exists(prefix, recursive=True)
+
   def test_delete_site_no_user(self, app, sites_user):
     with app.app_context(), app.test_client() as client:
       db.session.add(sites_user)
@@ -202,20 +291,19 @@ class SiteTest:
       rv = client.delete(f'/api/v1/site/{uuid7()}')
       assert rv.status == '404 NOT FOUND'
 
-  @patch('rainfall.blueprint.site.object_storage.rmtree')
-  def test_delete_site_filesystem_error(self, mock_rmtree, app, sites_user):
+  def test_delete_site_enqueue_error(self, app, sites_user):
     with app.app_context(), app.test_client() as client:
       db.session.add(sites_user)
       site_id = sites_user.sites[0].id
 
-      object_client = object_storage.connect(app)
       with client.session_transaction() as sess:
         sess['user_id'] = BASIC_USER_ID
 
-      mock_rmtree.side_effect = Exception('Some error')
-
-      rv = client.delete(f'/api/v1/site/{site_id}')
-      assert rv.status == '500 INTERNAL SERVER ERROR'
+      with patch.dict(app.extensions, {'celery': MagicMock()}):
+        app.extensions['celery'].send_task.side_effect = Exception('No broker')
+        rv = client.delete(f'/api/v1/site/{site_id}')
+      assert rv.status == '204 NO CONTENT'
 
-      site = db.session.get(Site, site_id)
-      assert site is not None
+      assert db.session.get(Site, site_id) is None
+      # The tombstones remain for a later purge.
+      assert len(db.session.scalars(select(ObjectPurge)).all()) == 3
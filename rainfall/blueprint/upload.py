@@ -1,7 +1,13 @@
+import logging
+import math
+import mimetypes
 import os
+from types import SimpleNamespace
 from uuid import UUID
 
 import flask
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from uuid_extensions import uuid7
 
 from rainfall import object_storage
 from rainfall.db import db
@@ -10,14 +16,18 @@ from rainfall.models.artwork import Artwork
 from rainfall.models.file import File
 from rainfall.models.release import Release
 from rainfall.site import delete_file as delete_db_file
-from rainfall.site import release_path, secure_filename
+from rainfall.site import release_object_path, secure_filename
 
 upload = flask.Blueprint('upload', __name__)
 
+log = logging.getLogger(__name__)
+
 ALLOWED_SONG_EXTS = [
     '.aiff', '.aif', '.alac', '.flac', '.mp3', '.ogg', '.opus', '.wav'
 ]
 ALLOWED_ART_EXTS = ['.gif', '.jpg', '.jpeg', '.png', '.webp']
+# The most parts S3 combines into one object.
+MAX_UPLOAD_PARTS = 10000
 
 
 def check_file_types(allowed_exts, *song_files):
@@ -41,14 +51,15 @@ def write_files(release, claz, *files):
       return flask.jsonify(status=400,
                            error=f'File name {name} is too long'), 400
 
-    obj = claz(filename=name)
+    # The id is assigned up front because it is also the object's key.
+    obj = claz(id=uuid7(), filename=name)
     # Yield so that the calling function can properly save metadata to db.
     yield obj
 
     # Write the file to object storage.
-    cur_release_path = release_path(flask.current_app.config['DATA_DIR'],
-                                    release)
-    object_path = os.path.join(cur_release_path, obj.filename)
+    object_path = os.path.join(
+        release_object_path(flask.current_app.config['DATA_DIR'], release),
+        str(obj.id))
     object_storage.put_object(object_path, file, file.content_type)
 
 
@@ -97,3 +108,223 @@ def upload_release_art(release, user):
   db.session.commit()
 
   return '', 204
+
+
+def upload_session_serializer():
+  return URLSafeTimedSerializer(flask.current_app.secret_key,
+                                salt='song-upload-session')
+
+
+def upload_part_path(file_id, part_number):
+  # Outside the release, so that nothing that lists the release's objects
+  # sees the parts. A lifecycle rule on the prefix can remove the parts of
+  # sessions that were never finished.
+  return os.path.join(flask.current_app.config['DATA_DIR'], 'uploads',
+                      file_id, str(part_number))
+
+
+def upload_part_sizes(size, part_size):
+  num_parts = math.ceil(size / part_size)
+  return [part_size] * (num_parts - 1) + [size - part_size * (num_parts - 1)]
+
+
+def upload_part_paths(session_file):
+  return [
+      upload_part_path(session_file['id'], part_number)
+      for part_number in range(
+          1,
+          len(upload_part_sizes(session_file['size'],
+                                session_file['part_size'])) + 1)
+  ]
+
+
+def load_upload_session(release, user):
+  data = flask.request.get_json(silent=True)
+  token = data.get('session') if isinstance(data, dict) else None
+  if not isinstance(token, str):
+    return None, (flask.jsonify(status=400,
+                                error='Missing upload session'), 400)
+
+  try:
+    session = upload_session_serializer().loads(
+        token,
+        max_age=flask.current_app.config['MINIO_PRESIGNED_UPLOAD_EXPIRY'])
+  except BadSignature:
+    return None, (flask.jsonify(status=400,
+                                error='Invalid or expired upload session'),
+                  400)
+
+  if (session['release_id'] != str(release.id) or
+      session['user_id'] != str(user.id)):
+    return None, (flask.jsonify(
+        status=403, error='Upload session is not for that release'), 403)
+
+  return session, None
+
+
+@upload.route('upload/release/<release_id>/song/session', methods=['POST'])
+@with_current_user
+@with_validated_release
+def create_song_upload_session(release, user):
+  '''
+  Returns presigned forms for the client to POST the parts of each song to
+  object storage directly, each part as an object of its own. The songs are
+  combined from their parts and added to the release by
+  finalize_song_upload_session.
+  '''
+  if not object_storage.supports_presigned_urls():
+    return flask.jsonify(
+        status=400,
+        error='Direct uploads are not supported by this storage backend'), 400
+
+  data = flask.request.get_json(silent=True)
+  if not isinstance(data, dict):
+    return flask.jsonify(status=400, error='No JSON object provided'), 400
+  files = data.get('files') or []
+  if (not isinstance(files, list) or
+      not all(isinstance(song, dict) for song in files)):
+    return flask.jsonify(status=400, error='Invalid files'), 400
+  songs = [
+      SimpleNamespace(filename=song.get('filename', ''),
+                      size=song.get('size'),
+                      content_type=song.get('content_type')) for song in files
+  ]
+  if not songs:
+    return flask.jsonify(status=400, error='No songs to upload'), 400
+  for song in songs:
+    if (not isinstance(song.filename, str) or
+        not isinstance(song.content_type, (str, type(None)))):
+      return flask.jsonify(status=400, error='Invalid file name or type'), 400
+
+  resp = check_file_types(ALLOWED_SONG_EXTS, *songs)
+  if resp is not None:
+    return resp
+
+  config = flask.current_app.config
+  part_size = config['MINIO_UPLOAD_PART_SIZE']
+  for song in songs:
+    song.name = secure_filename(song.filename)
+    if len(song.name) > 1024:
+      return flask.jsonify(status=400,
+                           error=f'File name {song.name} is too long'), 400
+    if (not isinstance(song.size, int) or song.size <= 0 or
+        song.size > config['MAX_SONG_UPLOAD_SIZE'] or
+        math.ceil(song.size / part_size) > MAX_UPLOAD_PARTS):
+      return flask.jsonify(
+          status=400,
+          error=f'File {song.filename} has an invalid or too large size'), 400
+
+  session_files = []
+  response_files = []
+  for song in songs:
+    file_id = str(uuid7())
+    content_type = (song.content_type or
+                    mimetypes.guess_type(song.name)[0] or
+                    'application/octet-stream')
+    # Each form only accepts a part of its size, so no more than the
+    # announced size can be uploaded.
+    parts = [
+        object_storage.presigned_post_form(upload_part_path(file_id,
+                                                            part_number),
+                                           size)
+        for part_number, size in enumerate(
+            upload_part_sizes(song.size, part_size), start=1)
+    ]
+
+    session_files.append({
+        'id': file_id,
+        'filename': song.name,
+        'content_type': content_type,
+        'size': song.size,
+        'part_size': part_size,
+    })
+    response_files.append({
+        'id': file_id,
+        'filename': song.filename,
+        'part_size': part_size,
+        'parts': parts,
+    })
+
+  session = upload_session_serializer().dumps({
+      'release_id': str(release.id),
+      'user_id': str(user.id),
+      'files': session_files,
+  })
+  return flask.jsonify({'session': session, 'files': response_files})
+
+
+@upload.route('upload/release/<release_id>/song/session/finalize',
+              methods=['POST'])
+@with_current_user
+@with_validated_release
+def finalize_song_upload_session(release, user):
+  session, resp = load_upload_session(release, user)
+  if resp is not None:
+    return resp
+
+  config = flask.current_app.config
+  cur_release_path = release_object_path(config['DATA_DIR'], release)
+  completed = []
+  try:
+    for session_file in session['files']:
+      object_path = os.path.join(cur_release_path, session_file['id'])
+      object_storage.compose_parts(object_path,
+                                   upload_part_paths(session_file),
+                                   upload_part_sizes(
+                                       session_file['size'],
+                                       session_file['part_size']),
+                                   session_file['content_type'],
+                                   max_size=config['MAX_SONG_UPLOAD_SIZE'])
+      completed.append(session_file)
+  except Exception:
+    log.exception('Could not finalize upload session for release id=%s',
+                  release.id)
+    for session_file in session['files']:
+      object_path = os.path.join(cur_release_path, session_file['id'])
+      try:
+        if session_file in completed:
+          object_storage.remove_object(object_path)
+        # Otherwise the uploaded parts are kept (and billed) until a
+        # lifecycle rule removes them, and the session can't be retried.
+        object_storage.remove_objects(upload_part_paths(session_file))
+      except Exception:
+        log.exception('Could not clean up upload of file id=%s',
+                      session_file['id'])
+    return flask.jsonify(
+        status=400, error='Upload session is incomplete or already used'), 400
+
+  for session_file in session['files']:
+    try:
+      object_storage.remove_objects(upload_part_paths(session_file))
+    except Exception:
+      log.exception('Could not remove uploaded parts of file id=%s',
+                    session_file['id'])
+
+  for session_file in session['files']:
+    file = File(id=UUID(session_file['id']), filename=session_file['filename'])
+    release.files.append(file)
+    # Give the file a new name if it's a dupe. This must be done after
+    # the file is added to the release.
+    file.maybe_rename()
+
+  db.session.add(release)
+  db.session.commit()
+
+  return '', 204
+
+
+@upload.route('upload/release/<release_id>/song/session', methods=['DELETE'])
+@with_current_user
+@with_validated_release
+def abort_song_upload_session(release, user):
+  session, resp = load_upload_session(release, user)
+  if resp is not None:
+    return resp
+
+  for session_file in session['files']:
+    try:
+      object_storage.remove_objects(upload_part_paths(session_file))
+    except Exception:
+      log.exception('Could not abort upload of file id=%s', session_file['id'])
+
+  return '', 204
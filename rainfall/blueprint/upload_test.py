@@ -1,15 +1,17 @@
 import io
 import os
 import time
-from unittest.mock import patch
 
 import flask
+import urllib3
 
 from rainfall import object_storage
+from rainfall.blueprint.upload import upload_part_path
 from rainfall.conftest import BASIC_USER_ID
 from rainfall.db import db
 from rainfall.models.artwork import Artwork
-from rainfall.site import release_path, secure_filename
+from rainfall.site import (file_object_path, release_object_path,
+                           release_path)
 
 
 def assert_file_contents(app, path, contents):
@@ -42,11 +44,10 @@ class UploadTest:
 
       assert rv.status == '204 NO CONTENT', rv.text
 
-      song_path = os.path.join(release_path(app.config['DATA_DIR'], release),
-                               secure_filename('song1.wav'))
-      assert_file_contents(app, song_path, b'not-actually-a-song')
       assert len(release.files) == 1
       assert release.files[0].filename == 'song1.wav'
+      song_path = file_object_path(app.config['DATA_DIR'], release.files[0])
+      assert_file_contents(app, song_path, b'not-actually-a-song')
 
   def test_upload_multiple_files(self, app, releases_user):
     with app.app_context(), app.test_client() as client:
@@ -67,18 +68,15 @@ class UploadTest:
 
       assert rv.status == '204 NO CONTENT', rv.text
 
-      song_release_path = release_path(app.config['DATA_DIR'], release)
-      song_1_path = os.path.join(song_release_path,
-                                 secure_filename('song1.wav'))
-      song_2_path = os.path.join(song_release_path,
-                                 secure_filename('song2.wav'))
-      assert_file_contents(app, song_1_path, b'not-actually-a-song')
-      assert_file_contents(app, song_2_path, b'not-actually-a-song-2')
-
       assert len(release.files) == 2
       assert release.files[0].filename == 'song1.wav'
       assert release.files[1].filename == 'song2.wav'
 
+      song_1_path = file_object_path(app.config['DATA_DIR'], release.files[0])
+      song_2_path = file_object_path(app.config['DATA_DIR'], release.files[1])
+      assert_file_contents(app, song_1_path, b'not-actually-a-song')
+      assert_file_contents(app, song_2_path, b'not-actually-a-song-2')
+
   def test_upload_multiple_files_existing_multiple(self, app, releases_user):
     with app.app_context(), app.test_client() as client:
       db.session.add(releases_user)
@@ -153,9 +151,8 @@ class UploadTest:
       db.session.refresh(release)
       assert release.artwork
       assert release.artwork.filename == 'some_artwork.jpg'
-      file_path = os.path.join(
-          release_path(flask.current_app.config['DATA_DIR'], release),
-          'some_artwork.jpg')
+      file_path = file_object_path(flask.current_app.config['DATA_DIR'],
+                                   release.artwork)
       assert_file_contents(app, file_path, b'not-actually-artwork')
 
   def test_upload_release_art_no_file(self, app, releases_user):
@@ -216,3 +213,259 @@ class UploadTest:
           release_path(flask.current_app.config['DATA_DIR'], release),
           'artwork.jpg')
       assert not os.path.exists(file_path)
+
+  def create_upload_session(self, app, client, release, files):
+    app.config['MINIO_PUBLIC_ENDPOINT'] = app.config['MINIO_ENDPOINT']
+    app.config['MINIO_PUBLIC_SECURE'] = False
+    return client.post(f'/api/v1/upload/release/{release.id}/song/session',
+                       json={'files': files})
+
+  def upload_part(self, part, data):
+    return urllib3.request('POST',
+                           part['url'],
+                           fields=dict(part['fields'], file=('part', data)))
+
+  def test_upload_session(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      rv = self.create_upload_session(app, client, release, [{
+          'filename': 'song1.wav',
+          'size': 19
+      }])
+      assert rv.status == '200 OK', rv.text
+      session = rv.json['session']
+      assert len(rv.json['files']) == 1
+      parts = rv.json['files'][0]['parts']
+      assert len(parts) == 1
+
+      resp = self.upload_part(parts[0], b'not-actually-a-song')
+      assert resp.status == 204
+
+      rv = client.post(
+          f'/api/v1/upload/release/{release.id}/song/session/finalize',
+          json={'session': session})
+      assert rv.status == '204 NO CONTENT', rv.text
+
+      db.session.refresh(release)
+      assert len(release.files) == 1
+      assert release.files[0].filename == 'song1.wav'
+      song_path = file_object_path(app.config['DATA_DIR'], release.files[0])
+      assert_file_contents(app, song_path, b'not-actually-a-song')
+
+  def test_upload_session_renames_dupes(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[1]
+      rv = self.create_upload_session(app, client, release, [{
+          'filename': 's0_r1_file_0.wav',
+          'size': 4
+      }])
+      self.upload_part(rv.json['files'][0]['parts'][0], b'song')
+
+      rv = client.post(
+          f'/api/v1/upload/release/{release.id}/song/session/finalize',
+          json={'session': rv.json['session']})
+      assert rv.status == '204 NO CONTENT', rv.text
+
+      db.session.refresh(release)
+      assert release.files[-1].filename == 's0_r1_file_0_1.wav'
+      assert release.files[-1].original_filename == 's0_r1_file_0.wav'
+
+  def test_upload_session_wrong_file_type(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      rv = self.create_upload_session(app, client, release, [{
+          'filename': 'song1.txt',
+          'size': 4
+      }])
+      assert rv.status == '400 BAD REQUEST', rv.text
+
+  def test_upload_session_invalid_json(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      url = f'/api/v1/upload/release/{release.id}/song/session'
+      for body in (['song1.wav'], 'song1.wav', {'files': 'song1.wav'}, {
+          'files': ['song1.wav']
+      }, {
+          'files': [{
+              'filename': None,
+              'size': 4
+          }]
+      }, {
+          'files': [{
+              'filename': 4,
+              'size': 4
+          }]
+      }):
+        rv = client.post(url, json=body)
+        assert rv.status == '400 BAD REQUEST', (body, rv.text)
+
+      for body in (['session'], 'session', {'session': None}):
+        rv = client.post(f'{url}/finalize', json=body)
+        assert rv.status == '400 BAD REQUEST', (body, rv.text)
+        rv = client.delete(url, json=body)
+        assert rv.status == '400 BAD REQUEST', (body, rv.text)
+
+  def test_upload_session_too_large(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      rv = self.create_upload_session(
+          app, client, release, [{
+              'filename': 'song1.wav',
+              'size': app.config['MAX_SONG_UPLOAD_SIZE'] + 1
+          }])
+      assert rv.status == '400 BAD REQUEST', rv.text
+
+  def test_upload_session_finalize_nothing_uploaded(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      rv = self.create_upload_session(app, client, release, [{
+          'filename': 'song1.wav',
+          'size': 4
+      }])
+
+      rv = client.post(
+          f'/api/v1/upload/release/{release.id}/song/session/finalize',
+          json={'session': rv.json['session']})
+      assert rv.status == '400 BAD REQUEST', rv.text
+      db.session.refresh(release)
+      assert len(release.files) == 0
+
+  def test_upload_session_finalize_wrong_size(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      rv = self.create_upload_session(app, client, release, [{
+          'filename': 'song1.wav',
+          'size': 4
+      }])
+      # Real object storage rejects the part, moto's policy check doesn't.
+      self.upload_part(rv.json['files'][0]['parts'][0], b'not-actually-a-song')
+
+      rv = client.post(
+          f'/api/v1/upload/release/{release.id}/song/session/finalize',
+          json={'session': rv.json['session']})
+      assert rv.status == '400 BAD REQUEST', rv.text
+      db.session.refresh(release)
+      assert len(release.files) == 0
+
+  def test_upload_session_finalize_partial(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      rv = self.create_upload_session(app, client, release, [{
+          'filename': 'song1.wav',
+          'size': 4
+      }, {
+          'filename': 'song2.wav',
+          'size': 4
+      }])
+      files = rv.json['files']
+      self.upload_part(files[0]['parts'][0], b'song')
+
+      rv = client.post(
+          f'/api/v1/upload/release/{release.id}/song/session/finalize',
+          json={'session': rv.json['session']})
+      assert rv.status == '400 BAD REQUEST', rv.text
+
+      # The completed song and the uploaded parts are removed.
+      object_dir = release_object_path(app.config['DATA_DIR'], release)
+      assert not object_storage.object_exists(
+          f'{object_dir}/{files[0]["id"]}')
+      assert not object_storage.object_exists(
+          upload_part_path(files[0]['id'], 1))
+
+  def test_upload_session_finalize_bad_session(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      rv = client.post(
+          f'/api/v1/upload/release/{release.id}/song/session/finalize',
+          json={'session': 'not-a-session'})
+      assert rv.status == '400 BAD REQUEST', rv.text
+
+  def test_upload_session_finalize_other_release(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      other_release = releases_user.sites[0].releases[1]
+      rv = self.create_upload_session(app, client, release, [{
+          'filename': 'song1.wav',
+          'size': 4
+      }])
+
+      rv = client.post(
+          f'/api/v1/upload/release/{other_release.id}/song/session/finalize',
+          json={'session': rv.json['session']})
+      assert rv.status == '403 FORBIDDEN', rv.text
+
+  def test_upload_session_abort(self, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = releases_user.id
+
+      release = releases_user.sites[0].releases[0]
+      rv = self.create_upload_session(app, client, release, [{
+          'filename': 'song1.wav',
+          'size': 4
+      }])
+      session = rv.json['session']
+      part = rv.json['files'][0]['parts'][0]
+      self.upload_part(part, b'song')
+
+      rv = client.delete(f'/api/v1/upload/release/{release.id}/song/session',
+                         json={'session': session})
+      assert rv.status == '204 NO CONTENT', rv.text
+      assert not object_storage.object_exists(part['fields']['key'])
+
+      rv = client.post(
+          f'/api/v1/upload/release/{release.id}/song/session/finalize',
+          json={'session': session})
+      assert rv.status == '400 BAD REQUEST', rv.text
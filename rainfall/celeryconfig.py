@@ -1,5 +1,7 @@
 import os
 
+from kombu import Queue
+
 broker_url = os.environ['REDIS_URL'],
 result_backend = os.environ['REDIS_URL']
 # Don't use a pool, connect every time. There seems to be an issue with
@@ -8,3 +10,47 @@ broker_pool_limit = None
 # Retry forever if Redis is unreachable.
 broker_connection_max_retries = None
 broker_connection_retry_on_startup = True
+
+# Preview builds, which a user is waiting for.
+INTERACTIVE_QUEUE = 'interactive'
+# Maintenance work that nobody is waiting for, like purging the objects of
+# deleted sites.
+BULK_QUEUE = 'bulk'
+
+task_queues = (Queue(INTERACTIVE_QUEUE), Queue(BULK_QUEUE))
+task_default_queue = INTERACTIVE_QUEUE
+task_routes = {
+    'rainfall.main.generate_site_async': {
+        'queue': INTERACTIVE_QUEUE
+    },
+    'rainfall.main.purge_objects_async': {
+        'queue': BULK_QUEUE
+    },
+}
+
+# Worker processes for each queue. A worker runs the sum for the queues it
+# consumes (all of them, unless it's started with -Q), unless it's started
+# with -c.
+queue_concurrency = {
+    INTERACTIVE_QUEUE: int(os.environ.get('CELERY_INTERACTIVE_CONCURRENCY', 2)),
+    BULK_QUEUE: int(os.environ.get('CELERY_BULK_CONCURRENCY', 1)),
+}
+
+# With the Redis broker, 0 is the highest priority and 9 the lowest. Each
+# priority is a separate list in Redis, and workers take from the highest
+# priority list that has tasks.
+broker_transport_options = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+task_default_priority = 5
+# Builds of sites with more than large_preview_files files get the lower
+# priority, so that a huge catalog doesn't hold up everyone else's previews.
+preview_priority = 0
+large_preview_priority = 6
+large_preview_files = int(os.environ.get('CELERY_LARGE_PREVIEW_FILES', 200))
+# Builds take seconds to minutes, so a worker only reserves as many tasks as
+# it has processes. Otherwise tasks wait behind a long build while other
+# workers are idle, and priorities only apply to what is left in Redis.
+worker_prefetch_multiplier = 1
@@ -18,7 +18,7 @@ from rainfall.models.integration import Integration
 from rainfall.models.release import Release
 from rainfall.models.site import Site
 from rainfall.models.user import User
-from rainfall.site import release_path, site_path
+from rainfall.site import file_object_path
 from rainfall.test_constants import (TEST_FILE_PATH, TEST_JPG_DATA,
                                      TEST_MINIO_BUCKET, TEST_WAV_PATH)
 
@@ -132,18 +132,6 @@ def releases_user(app, sites_user):
                             File(filename='s0_r1_file_1.wav'),
                         ],
                         artwork=Artwork(filename='artwork.jpg'))
-
-    with open(TEST_WAV_PATH, 'rb') as f:
-      object_storage.put_object(
-          f'{app.config["DATA_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/Cool Site 1/Site 0 Release 2/s0_r1_file_0.wav',
-          f, 'audio/wav')
-    with open(TEST_WAV_PATH, 'rb') as f:
-      object_storage.put_object(
-          f'{app.config["DATA_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/Cool Site 1/Site 0 Release 2/s0_r1_file_1.wav',
-          f, 'audio/wav')
-    object_storage.put_object(
-        f'{app.config["DATA_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/Cool Site 1/Site 0 Release 2/artwork.jpg',
-        TEST_JPG_DATA, 'image/jpeg')
     sites_user.sites[0].releases.append(release_2)
 
     release_3 = Release(name='Site 1 Release 1')
@@ -152,6 +140,14 @@ def releases_user(app, sites_user):
     db.session.add(sites_user)
     db.session.commit()
 
+    for file in release_2.files:
+      with open(TEST_WAV_PATH, 'rb') as f:
+        object_storage.put_object(
+            file_object_path(app.config['DATA_DIR'], file), f, 'audio/wav')
+    object_storage.put_object(
+        file_object_path(app.config['DATA_DIR'], release_2.artwork),
+        TEST_JPG_DATA, 'image/jpeg')
+
   return sites_user
 
 
@@ -168,9 +164,8 @@ def artwork_file(app, releases_user):
     db.session.add(releases_user)
     release = releases_user.sites[0].releases[0]
     release.artwork = Artwork(id=uuid7(), filename='artwork.jpg')
-    file_path = os.path.join(
-        release_path(flask.current_app.config['DATA_DIR'], release),
-        'artwork.jpg')
+    file_path = file_object_path(flask.current_app.config['DATA_DIR'],
+                                 release.artwork)
     db.session.commit()
     object_storage.put_object(file_path, io.BytesIO(b'not-actually-artwork'),
                               'image/jpeg')
@@ -1,3 +1,5 @@
+from datetime import datetime, timezone
+
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 
@@ -7,3 +9,8 @@ class Base(DeclarativeBase):
 
 
 db = SQLAlchemy(model_class=Base)
+
+
+def utcnow():
+  '''The current time as naive UTC, how DateTime columns store it.'''
+  return datetime.now(timezone.utc).replace(tzinfo=None)
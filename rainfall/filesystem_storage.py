@@ -0,0 +1,218 @@
+import os
+import shutil
+import time
+import uuid
+
+import flask
+
+from rainfall.object_cache import link_or_copy
+from rainfall.object_storage import (STREAM_CHUNK_SIZE, ObjectStorageException,
+                                     TransferStats, walk_files)
+
+
+class FilesystemStorage:
+  '''
+  Storage backend that keeps objects as plain files under root, for single
+  node deployments, benchmarks and fast tests. It implements the same
+  operations as the MinIO functions in object_storage (without the client
+  and bucket arguments), which dispatch here when STORAGE_BACKEND is
+  'filesystem'.
+
+  Writes go to a temporary file that is renamed into place, so readers never
+  see partial objects. Directory renames are a single os.rename.
+  '''
+
+  def __init__(self, root):
+    self.root = os.path.abspath(root)
+
+  def _path(self, key):
+    path = os.path.normpath(os.path.join(self.root, key or ''))
+    if path != self.root and not path.startswith(self.root + os.sep):
+      raise ObjectStorageException(f'Object name {key} is outside of storage')
+    return path
+
+  def _write_atomic(self, path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+      write(tmp_path)
+      os.replace(tmp_path, path)
+    finally:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+  def create_root(self):
+    os.makedirs(self.root, exist_ok=True)
+
+  def get_object(self, path):
+    try:
+      return open(self._path(path), 'rb')
+    except (FileNotFoundError, IsADirectoryError):
+      raise ObjectStorageException(f'Object {path} does not exist')
+
+  def send_object(self, path, download_name, as_attachment=False, cache=None):
+    # Files are read from the local disk, so the read cache is not used.
+    full_path = self._path(path)
+    if not os.path.isfile(full_path):
+      flask.abort(404)
+    # Sending a path lets the WSGI server use sendfile(), and werkzeug handles
+    # conditional and Range requests.
+    return flask.send_file(full_path,
+                           download_name=download_name,
+                           as_attachment=as_attachment,
+                           conditional=True)
+
+  def stream_object(self, path, offset, length):
+    if not length:
+      return
+    with open(self._path(path), 'rb') as f:
+      f.seek(offset)
+      remaining = length
+      while remaining > 0:
+        chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+          break
+        remaining -= len(chunk)
+        yield chunk
+
+  def object_streamer(self):
+    return self.stream_object
+
+  def put_object(self, path, file, content_type):
+    file.seek(0)
+
+    def write(tmp_path):
+      with open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(file, f)
+
+    self._write_atomic(self._path(path), write)
+
+  def put_stream(self, path, write, content_type):
+    size = 0
+
+    def write_file(tmp_path):
+      nonlocal size
+      with open(tmp_path, 'wb') as f:
+        write(f)
+        size = f.tell()
+
+    self._write_atomic(self._path(path), write_file)
+    return size
+
+  def compose_parts(self,
+                    path,
+                    part_paths,
+                    part_sizes,
+                    content_type,
+                    max_size=None):
+    # Parts are only uploaded with presigned POSTs.
+    raise ObjectStorageException(
+        'Direct uploads are not supported by the filesystem backend')
+
+  def copy_object(self, old_path, new_path):
+    src = self._path(old_path)
+    self._write_atomic(self._path(new_path),
+                       lambda tmp_path: shutil.copyfile(src, tmp_path))
+
+  def remove_object(self, path):
+    try:
+      os.remove(self._path(path))
+    except FileNotFoundError:
+      pass
+
+  def remove_objects(self, paths):
+    for path in paths:
+      self.remove_object(path)
+
+  def rmtree(self, path):
+    full_path = self._path(path)
+    if full_path == self.root:
+      # Like the MinIO version, empty the storage but keep the bucket.
+      for entry in os.scandir(full_path) if os.path.isdir(full_path) else []:
+        if entry.is_dir(follow_symlinks=False):
+          shutil.rmtree(entry.path)
+        else:
+          os.remove(entry.path)
+    elif os.path.isdir(full_path):
+      shutil.rmtree(full_path)
+    elif os.path.exists(full_path):
+      os.remove(full_path)
+
+  def download_file(self, path, output_path):
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    shutil.copyfile(self._path(path), output_path)
+
+  def download_files(self, paths, cache=None):
+    # The files are already local, so they are linked into place and the
+    # cache is not needed.
+    start = time.monotonic()
+    stats = TransferStats()
+    for path, output_path in paths:
+      os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+      link_or_copy(self._path(path), output_path)
+      stats.files += 1
+      stats.bytes += os.path.getsize(output_path)
+    stats.seconds = time.monotonic() - start
+    return stats
+
+  def upload_dir_recursively(self, path, output_path):
+    assert os.path.isdir(path)
+    return self.upload_files(walk_files(path, output_path))
+
+  def upload_files(self, files):
+    start = time.monotonic()
+    stats = TransferStats()
+    for local_path, remote_path, size in files:
+      self._write_atomic(
+          self._path(remote_path),
+          lambda tmp_path: shutil.copyfile(local_path, tmp_path))
+      stats.files += 1
+      stats.bytes += size
+    stats.seconds = time.monotonic() - start
+    return stats
+
+  def rename_dir_recursively(self, old_path, new_path):
+    start = time.monotonic()
+    stats = TransferStats()
+    src = self._path(old_path)
+    if not os.path.exists(src):
+      return stats
+
+    for _, _, size in walk_files(src, ''):
+      stats.files += 1
+      stats.bytes += size
+    dst = self._path(new_path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.rename(src, dst)
+    stats.seconds = time.monotonic() - start
+    return stats
+
+  def object_etags(self, paths):
+    # Files are replaced rather than modified, so size and mtime identify the
+    # contents well enough.
+    etags = {}
+    for path in paths:
+      stat = os.stat(self._path(path))
+      etags[path] = f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+    return etags
+
+  def object_exists(self, path):
+    return os.path.isfile(self._path(path))
+
+  def path_exists(self, path, recursive=False):
+    # Object names are prefixes, so 'a/b' matches 'a/b', 'a/b/c' and 'a/bc'.
+    full_path = self._path(path)
+    parent = full_path if path.endswith('/') else os.path.dirname(full_path)
+    prefix = '' if path.endswith('/') else os.path.basename(full_path)
+    if not os.path.isdir(parent):
+      return False
+
+    with os.scandir(parent) as entries:
+      for entry in entries:
+        if not entry.name.startswith(prefix):
+          continue
+        if entry.is_file():
+          return True
+        if entry.is_dir() and next(walk_files(entry.path, ''), None):
+          return True
+    return False
@@ -0,0 +1,147 @@
+import io
+import os
+
+import pytest
+from werkzeug.exceptions import NotFound
+
+from rainfall import object_storage
+
+
+@pytest.fixture
+def fs_app(app, tmp_path):
+  app.config['STORAGE_BACKEND'] = 'filesystem'
+  app.config['STORAGE_ROOT'] = str(tmp_path / 'storage')
+  object_storage.create_bucket_if_not_exists(app)
+  yield app
+  app.config['STORAGE_BACKEND'] = 'minio'
+
+
+class FilesystemStorageTest:
+
+  def test_put_get(self, fs_app):
+    with fs_app.app_context():
+      object_storage.put_object('a/b.txt', io.BytesIO(b'hello'), 'text/plain')
+
+      with object_storage.get_object('a/b.txt') as f:
+        assert f.read() == b'hello'
+    assert os.path.isfile(os.path.join(fs_app.config['STORAGE_ROOT'], 'a',
+                                       'b.txt'))
+
+  def test_put_stream(self, fs_app):
+    with fs_app.app_context():
+      actual = object_storage.put_stream('a/b.zip',
+                                         lambda f: f.write(b'hello'),
+                                         'application/zip')
+
+      assert actual == 5
+      with object_storage.get_object('a/b.zip') as f:
+        assert f.read() == b'hello'
+
+  def test_stream_object(self, fs_app):
+    with fs_app.app_context():
+      object_storage.put_object('a/b.txt', io.BytesIO(b'0123456789'),
+                                'text/plain')
+
+      assert b''.join(object_storage.stream_object('a/b.txt', 2, 5)) == (
+          b'23456')
+
+  def test_get_missing(self, fs_app):
+    with fs_app.app_context(), pytest.raises(
+        object_storage.ObjectStorageException):
+      object_storage.get_object('missing.txt')
+
+  def test_outside_root(self, fs_app):
+    with fs_app.app_context(), pytest.raises(
+        object_storage.ObjectStorageException):
+      object_storage.put_object('../escape.txt', io.BytesIO(b'x'),
+                                'text/plain')
+
+  def test_exists(self, fs_app):
+    with fs_app.app_context():
+      object_storage.put_object('exists/nested/a.txt', io.BytesIO(b'a'),
+                                'text/plain')
+
+      assert object_storage.object_exists('exists/nested/a.txt')
+      assert not object_storage.object_exists('exists/nested')
+      assert object_storage.path_exists('exists')
+      assert object_storage.path_exists('exists/nes')
+      assert object_storage.path_exists('exists/nested', recursive=True)
+      assert not object_storage.path_exists('exists/other', recursive=True)
+
+  def test_rmtree(self, fs_app):
+    with fs_app.app_context():
+      object_storage.put_object('tree/a.txt', io.BytesIO(b'a'), 'text/plain')
+      object_storage.put_object('other/b.txt', io.BytesIO(b'b'), 'text/plain')
+
+      object_storage.rmtree('tree')
+      assert not object_storage.path_exists('tree', recursive=True)
+      assert object_storage.object_exists('other/b.txt')
+
+      object_storage.rmtree('')
+      assert not object_storage.path_exists('other', recursive=True)
+    assert os.path.isdir(fs_app.config['STORAGE_ROOT'])
+
+  def test_rename_dir_recursively(self, fs_app):
+    with fs_app.app_context():
+      for name in ('a.wav', 'nested/c.jpg'):
+        object_storage.put_object(f'rename/old/{name}',
+                                  io.BytesIO(name.encode()), 'audio/wav')
+
+      actual = object_storage.rename_dir_recursively('rename/old',
+                                                     'rename/new')
+
+      assert not object_storage.path_exists('rename/old', recursive=True)
+      with object_storage.get_object('rename/new/nested/c.jpg') as f:
+        assert f.read() == b'nested/c.jpg'
+
+    assert actual.files == 2
+    assert actual.bytes == 17
+
+  def test_upload_and_download(self, fs_app, tmp_path):
+    (tmp_path / 'site' / 'nested').mkdir(parents=True)
+    (tmp_path / 'site' / 'index.html').write_bytes(b'<html></html>')
+    (tmp_path / 'site' / 'nested' / 'a.css').write_bytes(b'body {}')
+
+    with fs_app.app_context():
+      uploaded = object_storage.upload_dir_recursively(
+          path=str(tmp_path / 'site'), output_path='upload')
+      downloaded = object_storage.download_files([
+          ('upload/index.html', str(tmp_path / 'out' / 'index.html')),
+          ('upload/nested/a.css', str(tmp_path / 'out' / 'a.css')),
+      ])
+
+    assert uploaded.files == 2
+    assert uploaded.bytes == 20
+    assert downloaded.files == 2
+    assert (tmp_path / 'out' / 'a.css').read_bytes() == b'body {}'
+
+  def test_send_object_range(self, fs_app):
+    with fs_app.app_context():
+      object_storage.put_object('preview/song.mp3', io.BytesIO(b'0123456789'),
+                                'audio/mpeg')
+
+    with fs_app.test_request_context(headers={'Range': 'bytes=2-5'}):
+      rv = object_storage.serve_object('preview/song.mp3', 'song.mp3')
+      rv.direct_passthrough = False
+
+      assert rv.status_code == 206
+      assert rv.get_data() == b'2345'
+      rv.close()
+
+  def test_send_object_missing(self, fs_app):
+    with fs_app.test_request_context(), pytest.raises(NotFound):
+      object_storage.serve_object('preview/missing.mp3', 'missing.mp3')
+
+  def test_multipart_unsupported(self, fs_app):
+    with fs_app.app_context():
+      assert not object_storage.supports_presigned_urls()
+      with pytest.raises(object_storage.ObjectStorageException):
+        object_storage.compose_parts('a.flac', ['a.flac.1'], [1], 'audio/flac')
+
+  def test_object_etags(self, fs_app):
+    with fs_app.app_context():
+      object_storage.put_object('a.wav', io.BytesIO(b'a'), 'audio/wav')
+      before = object_storage.object_etags(['a.wav'])
+      object_storage.put_object('a.wav', io.BytesIO(b'bb'), 'audio/wav')
+
+      assert object_storage.object_etags(['a.wav']) != before
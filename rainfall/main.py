@@ -1,23 +1,31 @@
+import hmac
 import logging
 import os
+import uuid
+from datetime import datetime
 
 import flask
 from authlib.integrations.flask_client import OAuth
 from celery import Celery
 from celery.result import AsyncResult
+from celery.signals import (celeryd_init, worker_process_init,
+                            worker_process_shutdown)
 from flask_seasurf import SeaSurf
 
-from rainfall import object_storage
+from rainfall import object_storage, progress, read_cache, zip_stream
 from rainfall.blueprint.file import file as file_blueprint
 from rainfall.blueprint.oauth import OauthBlueprintFactory
 from rainfall.blueprint.release import release as release_blueprint
 from rainfall.blueprint.site import site as site_blueprint
 from rainfall.blueprint.upload import upload as upload_blueprint
 from rainfall.blueprint.user import UserBlueprintFactory
-from rainfall.db import db
+from rainfall.db import db, utcnow
 from rainfall.decorators import with_current_site, with_current_user
-from rainfall.site import (generate_site, get_zip_file, public_dir, site_exists,
-                           zip_file_path)
+from rainfall.purge import purge_objects
+from rainfall.site import (acquire_build_lock, build_running, generate_site,
+                           preview_cache, public_dir, queued_build_task_id,
+                           release_build_lock, site_exists, site_fingerprint,
+                           site_zip_layout, zip_object_path)
 from rainfall.test_constants import TEST_FILE_PATH, TEST_MINIO_BUCKET
 
 log = logging.getLogger(__name__)
@@ -26,12 +34,94 @@ logging.basicConfig(level=logging.DEBUG)
 task_app = Celery('tasks')
 task_app.config_from_object('rainfall.celeryconfig')
 
+# (pid, app) of the app that tasks in this worker process run in.
+_worker_app = None
 
-@task_app.task
-def generate_site_async(data_dir_path, preview_dir_path, site_id):
-  app = create_app()
+
+def worker_app():
+  '''
+  Returns this worker process's app, creating it on first use. The app, and
+  with it the DB engine and the object storage client, is reused by every
+  task the process runs.
+  '''
+  global _worker_app
+  # A forked child must not share its parent's connections.
+  if _worker_app is None or _worker_app[0] != os.getpid():
+    _worker_app = (os.getpid(), create_app())
+  return _worker_app[1]
+
+
+def worker_concurrency(conf, queues=None):
+  '''
+  Returns the number of processes for a worker that consumes queues (all
+  queues if None), from the queue_concurrency setting.
+  '''
+  queues = queues or conf.queue_concurrency.keys()
+  return sum(conf.queue_concurrency.get(queue, 1) for queue in queues)
+
+
+@celeryd_init.connect
+def configure_worker(conf=None, options=None, **kwargs):
+  # -c takes precedence over the queues' concurrency.
+  if options.get('concurrency'):
+    return
+  conf.worker_concurrency = worker_concurrency(conf, options.get('queues'))
+
+
+def preview_priority(conf, site):
+  files = sum(len(release.files) for release in site.releases)
+  if files > conf.large_preview_files:
+    return conf.large_preview_priority
+  return conf.preview_priority
+
+
+@worker_process_init.connect
+def init_worker_app(**kwargs):
+  # Creating the app before the first task arrives keeps it off the task's
+  # critical path.
+  worker_app()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_app(**kwargs):
+  if _worker_app is None or _worker_app[0] != os.getpid():
+    return
+  app = _worker_app[1]
+  if 'sqlalchemy' in app.extensions:
+    with app.app_context():
+      db.engine.dispose()
+
+
+@task_app.task(bind=True, max_retries=None)
+def generate_site_async(self,
+                        data_dir_path,
+                        preview_dir_path,
+                        site_id,
+                        queued_at=None):
+  app = worker_app()
   with app.app_context():
-    return generate_site(data_dir_path, preview_dir_path, site_id)
+    # Only one build of a site runs at a time. A follow-up build waits for
+    # the running one to finish.
+    if not acquire_build_lock(site_id, self.request.id):
+      raise self.retry(countdown=app.config['PREVIEW_BUILD_RETRY_SECONDS'])
+    try:
+      return generate_site(
+          data_dir_path,
+          preview_dir_path,
+          site_id,
+          task_id=self.request.id,
+          queued_at=datetime.fromisoformat(queued_at) if queued_at else None)
+    finally:
+      release_build_lock(site_id, self.request.id)
+
+
+@task_app.task(autoretry_for=(Exception,),
+               retry_backoff=True,
+               retry_backoff_max=600,
+               max_retries=8)
+def purge_objects_async(purge_id):
+  with worker_app().app_context():
+    purge_objects(purge_id)
 
 
 def create_app():
@@ -45,10 +135,108 @@ def create_app():
   app.config['MASTODON_WEBSITE'] = os.environ['MASTODON_WEBSITE']
   app.config['DATA_DIR'] = os.environ['DATA_DIR']
   app.config['PREVIEW_DIR'] = os.environ['PREVIEW_DIR']
+  # 'minio', or 'filesystem' to keep objects as files under STORAGE_ROOT.
+  app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'minio')
+  app.config['STORAGE_ROOT'] = os.environ.get('STORAGE_ROOT', 'object-data')
   app.config['MINIO_ENDPOINT'] = os.environ['MINIO_ENDPOINT']
   app.config['MINIO_ACCESS_KEY'] = os.environ['MINIO_ACCESS_KEY']
   app.config['MINIO_SECRET_KEY'] = os.environ['MINIO_SECRET_KEY']
   app.config['MINIO_BUCKET'] = os.environ['MINIO_BUCKET']
+  app.config['MINIO_POOL_MAXSIZE'] = int(
+      os.environ.get('MINIO_POOL_MAXSIZE', 10))
+  app.config['MINIO_CONNECT_TIMEOUT'] = float(
+      os.environ.get('MINIO_CONNECT_TIMEOUT', 5))
+  app.config['MINIO_READ_TIMEOUT'] = float(
+      os.environ.get('MINIO_READ_TIMEOUT', 300))
+  app.config['MINIO_KEEPALIVE'] = os.environ.get('MINIO_KEEPALIVE',
+                                                 'true').lower() == 'true'
+  app.config['MINIO_UPLOAD_WORKERS'] = int(
+      os.environ.get('MINIO_UPLOAD_WORKERS', 8))
+  app.config['MINIO_UPLOAD_PART_SIZE'] = int(
+      os.environ.get('MINIO_UPLOAD_PART_SIZE', 16 * 1024 * 1024))
+  app.config['MINIO_UPLOAD_PART_WORKERS'] = int(
+      os.environ.get('MINIO_UPLOAD_PART_WORKERS', 4))
+  app.config['MINIO_DOWNLOAD_WORKERS'] = int(
+      os.environ.get('MINIO_DOWNLOAD_WORKERS', 8))
+  app.config['MINIO_COPY_WORKERS'] = int(
+      os.environ.get('MINIO_COPY_WORKERS', 16))
+  app.config['MINIO_DELETE_WORKERS'] = int(
+      os.environ.get('MINIO_DELETE_WORKERS', 4))
+  # Seconds to cache existence checks for, when the object is found and not.
+  app.config['MINIO_EXISTS_CACHE_TTL'] = float(
+      os.environ.get('MINIO_EXISTS_CACHE_TTL', 5))
+  app.config['MINIO_EXISTS_CACHE_NEGATIVE_TTL'] = float(
+      os.environ.get('MINIO_EXISTS_CACHE_NEGATIVE_TTL', 1))
+  # When enabled, downloads and media are redirects to presigned URLs on the
+  # public MinIO endpoint instead of being proxied through the app. URLs are
+  # signed per window of MINIO_PRESIGNED_EXPIRY seconds and stay valid for
+  # another window, so browsers can cache them.
+  app.config['MINIO_PRESIGNED_REDIRECTS'] = os.environ.get(
+      'MINIO_PRESIGNED_REDIRECTS', 'false').lower() == 'true'
+  app.config['MINIO_PRESIGNED_EXPIRY'] = int(
+      os.environ.get('MINIO_PRESIGNED_EXPIRY', 300))
+  app.config['MINIO_PUBLIC_ENDPOINT'] = os.environ.get('MINIO_PUBLIC_ENDPOINT')
+  app.config['MINIO_PUBLIC_SECURE'] = os.environ.get(
+      'MINIO_PUBLIC_SECURE', 'true').lower() == 'true'
+  app.config['MINIO_REGION'] = os.environ.get('MINIO_REGION', 'us-east-1')
+  app.config['MINIO_PRESIGNED_UPLOAD_EXPIRY'] = int(
+      os.environ.get('MINIO_PRESIGNED_UPLOAD_EXPIRY', 6 * 60 * 60))
+  # Largest song accepted through a direct to storage upload session.
+  app.config['MAX_SONG_UPLOAD_SIZE'] = int(
+      os.environ.get('MAX_SONG_UPLOAD_SIZE', 2 * 1024 * 1024 * 1024))
+  # Worker-local cache of downloaded songs and artwork. It must be on the same
+  # filesystem as DATA_DIR so entries can be hard linked into catalogs.
+  app.config['SOURCE_CACHE_DIR'] = os.environ.get(
+      'SOURCE_CACHE_DIR', os.path.join(app.config['DATA_DIR'],
+                                       '.source-cache'))
+  app.config['SOURCE_CACHE_MAX_BYTES'] = int(
+      os.environ.get('SOURCE_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+  # Each build runs in its own scratch directory in here. Songs are hard
+  # linked from SOURCE_CACHE_DIR into it, so they should share a filesystem
+  # (both on local NVMe, for example), otherwise they are copied.
+  app.config['BUILD_WORKSPACE_DIR'] = os.environ.get(
+      'BUILD_WORKSPACE_DIR', os.path.join(app.config['DATA_DIR'],
+                                          '.workspaces'))
+
+  # Used to invalidate saved faircamp caches, detected from the faircamp
+  # binary if not set.
+  app.config['FAIRCAMP_VERSION'] = os.environ.get('FAIRCAMP_VERSION')
+  # Limits of faircamp and the processes it starts, 0 is no limit. A build
+  # that runs out of time fails with the status 'timeout'. The memory and CPU
+  # time limits apply to each process, and are set with prlimit. The memory
+  # limit is RLIMIT_DATA, the memory a process allocates, rather than
+  # RLIMIT_AS, which also counts address space that threads and memory
+  # mapped files reserve without using it.
+  app.config['FAIRCAMP_TIMEOUT_SECONDS'] = int(
+      os.environ.get('FAIRCAMP_TIMEOUT_SECONDS', 30 * 60))
+  app.config['FAIRCAMP_KILL_GRACE_SECONDS'] = int(
+      os.environ.get('FAIRCAMP_KILL_GRACE_SECONDS', 10))
+  app.config['FAIRCAMP_MEMORY_LIMIT_BYTES'] = int(
+      os.environ.get('FAIRCAMP_MEMORY_LIMIT_BYTES', 3 * 1024 * 1024 * 1024))
+  app.config['FAIRCAMP_CPU_LIMIT_SECONDS'] = int(
+      os.environ.get('FAIRCAMP_CPU_LIMIT_SECONDS', 0))
+  # Builds run at a lower CPU and I/O priority than the worker itself.
+  app.config['FAIRCAMP_NICE'] = int(os.environ.get('FAIRCAMP_NICE', 10))
+  app.config['FAIRCAMP_IONICE'] = os.environ.get('FAIRCAMP_IONICE',
+                                                 'true').lower() == 'true'
+  # Total size of faircamp cache files shared by all sites. Sharing saves
+  # storage; faircamp still transcodes a track once for each site.
+  app.config['TRANSCODE_CACHE_MAX_BYTES'] = int(
+      os.environ.get('TRANSCODE_CACHE_MAX_BYTES', 50 * 1024 * 1024 * 1024))
+  # Read-through cache of preview assets in the web process. Objects up to
+  # PREVIEW_CACHE_MEMORY_OBJECT_MAX are kept in memory, larger ones up to
+  # PREVIEW_CACHE_DISK_OBJECT_MAX on disk. A budget of 0 disables a tier.
+  app.config['PREVIEW_CACHE_DIR'] = os.environ.get(
+      'PREVIEW_CACHE_DIR', os.path.join(app.config['PREVIEW_DIR'],
+                                        '.preview-cache'))
+  app.config['PREVIEW_CACHE_MEMORY_BYTES'] = int(
+      os.environ.get('PREVIEW_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+  app.config['PREVIEW_CACHE_MEMORY_OBJECT_MAX'] = int(
+      os.environ.get('PREVIEW_CACHE_MEMORY_OBJECT_MAX', 256 * 1024))
+  app.config['PREVIEW_CACHE_DISK_BYTES'] = int(
+      os.environ.get('PREVIEW_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+  app.config['PREVIEW_CACHE_DISK_OBJECT_MAX'] = int(
+      os.environ.get('PREVIEW_CACHE_DISK_OBJECT_MAX', 64 * 1024 * 1024))
 
   # Authlib automatically extracts these
   app.config['NETLIFY_CLIENT_ID'] = os.environ['NETLIFY_CLIENT_ID']
@@ -62,6 +250,43 @@ def create_app():
   else:
     app.config['TESTING'] = True
 
+  # Lets request handlers enqueue tasks without importing this module.
+  app.extensions['celery'] = task_app
+
+  # How long a build may hold a site's build lock, after which the worker is
+  # assumed to have died. Also how long a queued build may wait to start.
+  # The lease isn't renewed, so it must be longer than the slowest build:
+  # FAIRCAMP_TIMEOUT_SECONDS plus downloading the files and publishing the
+  # build. Otherwise a second build of the site can start while one runs.
+  app.config['PREVIEW_BUILD_LOCK_SECONDS'] = int(
+      os.environ.get('PREVIEW_BUILD_LOCK_SECONDS', 60 * 60))
+  # How often a follow-up build checks whether the running build finished.
+  app.config['PREVIEW_BUILD_RETRY_SECONDS'] = int(
+      os.environ.get('PREVIEW_BUILD_RETRY_SECONDS', 5))
+
+  # A zip of each build is stored, so that downloads can be redirected to
+  # object storage like other large objects. Without it, zips are streamed
+  # through the app from the published build, and builds don't pay for
+  # writing a zip.
+  app.config['PREVIEW_STORE_ZIP'] = os.environ.get(
+      'PREVIEW_STORE_ZIP', 'true').lower() == 'true'
+
+  # Counters of the web process that serves the request, of the MinIO
+  # connection pool and the preview read cache, are served at /api/v1/stats
+  # to requests with this token as their bearer token. Unset disables the
+  # endpoint.
+  app.config['STATS_TOKEN'] = os.environ.get('STATS_TOKEN')
+
+  # Build progress events are published to Redis, unless REDIS_URL is unset.
+  app.config['REDIS_URL'] = os.environ.get('REDIS_URL')
+  # An event stream holds a gunicorn thread while it's open, so the app runs
+  # with the gthread worker class. Streams still end now and then and the
+  # browser reconnects, so that idle ones don't pile up.
+  app.config['PREVIEW_EVENTS_MAX_SECONDS'] = int(
+      os.environ.get('PREVIEW_EVENTS_MAX_SECONDS', 25))
+  app.config['PREVIEW_EVENTS_HEARTBEAT_SECONDS'] = int(
+      os.environ.get('PREVIEW_EVENTS_HEARTBEAT_SECONDS', 10))
+
   csrf = SeaSurf(app)
   oauth = OAuth(app)
 
@@ -76,6 +301,23 @@ def create_app():
 
   FRONTEND_DIR = '../rainfall-frontend/dist'
 
+  def unchanged_fingerprint(site):
+    '''
+    Returns the site's fingerprint if it's the one of the last successful
+    build and that build's preview exists, otherwise None.
+    '''
+    if site.build_fingerprint is None:
+      return None
+    try:
+      fingerprint = site_fingerprint(app.config['DATA_DIR'], str(site.id))
+    except Exception:
+      log.exception('Could not fingerprint site id=%s', site.id)
+      return None
+    if (fingerprint != site.build_fingerprint or
+        not site_exists(app.config['PREVIEW_DIR'], str(site.id))):
+      return None
+    return fingerprint
+
   @app.route('/api/v1/preview/<site_id>', methods=['GET', 'POST'])
   @with_current_user
   @with_current_site
@@ -91,22 +333,92 @@ def create_app():
       else:
         return '', 404
 
-    result = generate_site_async.delay(app.config['DATA_DIR'],
-                                       app.config['PREVIEW_DIR'], str(site.id))
-    site.preview_task_id = result.id
-    db.session.add(site)
+    # Fingerprinting reads object storage, so it's done before the row is
+    # locked, not while other requests for the site wait on the lock.
+    fingerprint = unchanged_fingerprint(site)
+
+    # Lock the row so that concurrent requests agree on the queued build.
+    db.session.refresh(site, with_for_update=True)
+
+    # A build that hasn't started yet will pick up this request's changes too.
+    task_id = queued_build_task_id(site)
+    if task_id is not None:
+      db.session.commit()
+      return flask.jsonify(status=200, task_id=task_id)
+
+    # Nothing changed since the last successful build, so there's nothing to
+    # do. The status endpoint reports success while there is no task.
+    if (not build_running(site) and fingerprint is not None and
+        fingerprint == site.build_fingerprint):
+      site.preview_task_id = None
+      db.session.commit()
+      return flask.jsonify(status=200, task_id=None)
+
+    # Either nothing is running, or this is the single follow-up build of the
+    # running one. The id is recorded before the task is sent, so that it
+    # can't start before it's known to be queued.
+    task_id = str(uuid.uuid4())
+    queued_at = utcnow()
+    site.build_queued_task_id = task_id
+    site.build_queued_at = queued_at
+    site.preview_task_id = task_id
     db.session.commit()
-    return '', 204
+    generate_site_async.apply_async(
+        args=(app.config['DATA_DIR'], app.config['PREVIEW_DIR'], str(site.id)),
+        kwargs={'queued_at': queued_at.isoformat()},
+        task_id=task_id,
+        priority=preview_priority(task_app.conf, site))
+    return flask.jsonify(status=200, task_id=task_id)
 
   @app.route('/api/v1/preview/<site_id>/status')
   @with_current_user
   @with_current_site
   def preview_status(site, user):
     if site.preview_task_id is None:
+      if site.build_fingerprint is not None:
+        # The last preview request was skipped as a no-op.
+        return flask.jsonify(status=200, task_status='SUCCESS')
       return flask.jsonify(status=404, error='No preview task found'), 404
     result = AsyncResult(site.preview_task_id, app=task_app)
     return flask.jsonify(status=200, task_status=result.status)
 
+  @app.route('/api/v1/preview/<site_id>/events')
+  @with_current_user
+  @with_current_site
+  def preview_events(site, user):
+    client = progress.connect()
+    if client is None:
+      return flask.jsonify(status=404,
+                           error='Build progress is not available'), 404
+    task_id = flask.request.args.get('task_id') or site.preview_task_id
+
+    def poll_status():
+      if task_id is None:
+        return None
+      result = AsyncResult(task_id, app=task_app)
+      if result.status == 'SUCCESS' and result.result[0]:
+        stage = 'done'
+      elif result.status in ('SUCCESS', 'FAILURE'):
+        stage = 'failed'
+      else:
+        return None
+      return {
+          'task_id': task_id,
+          'stage': stage,
+          'progress': None,
+          'message': None
+      }
+
+    events = progress.stream(client, str(site.id), task_id, poll_status,
+                             app.config['PREVIEW_EVENTS_HEARTBEAT_SECONDS'],
+                             app.config['PREVIEW_EVENTS_MAX_SECONDS'])
+    return flask.Response(events,
+                          mimetype='text/event-stream',
+                          headers={
+                              'Cache-Control': 'no-cache',
+                              'X-Accel-Buffering': 'no'
+                          })
+
   @app.route('/preview/<site_id>/')
   @with_current_user
   @with_current_site
@@ -114,8 +426,9 @@ def create_app():
     # The decorators ensure that the site belongs to the user.
     index_path = os.path.join(app.config['PREVIEW_DIR'], public_dir(site),
                               'index.html')
-    file = object_storage.get_object(index_path)
-    return flask.send_file(file, download_name='index.html')
+    return object_storage.serve_object(index_path,
+                                       'index.html',
+                                       cache=preview_cache())
 
   @app.route('/preview/<site_id>/<path:filename>')
   @with_current_user
@@ -126,19 +439,38 @@ def create_app():
       filename += 'index.html'
     file_path = os.path.join(app.config['PREVIEW_DIR'], public_dir(site),
                              filename)
-    file = object_storage.get_object(file_path)
-    return flask.send_file(file, download_name=os.path.basename(file_path))
+    return object_storage.serve_object(file_path,
+                                       os.path.basename(file_path),
+                                       cache=preview_cache())
 
   @app.route('/api/v1/zip/<site_id>')
   @with_current_user
   @with_current_site
   def zip(site, user):
-    try:
-      file = get_zip_file(app.config['PREVIEW_DIR'], site)
-    except FileNotFoundError:
+    # Only a stored zip can be redirected to.
+    zip_path = zip_object_path(app.config['PREVIEW_DIR'], site)
+    if object_storage.object_exists(zip_path):
+      return object_storage.serve_object(zip_path,
+                                         'rainfall_site.zip',
+                                         as_attachment=True)
+
+    layout = site_zip_layout(app.config['PREVIEW_DIR'], site)
+    if layout is None:
       return flask.jsonify(
           status=404, error=f'Zip file does not exist for site {site.id}'), 404
-    return flask.send_file(file, download_name='rainfall_site.zip')
+    return zip_stream.send_zip(layout, 'rainfall_site.zip')
+
+  @app.route('/api/v1/stats')
+  def stats():
+    token = app.config['STATS_TOKEN']
+    if not token:
+      return flask.jsonify(status=404, error='Not found'), 404
+    authorization = flask.request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode('utf-8'),
+                               f'Bearer {token}'.encode('utf-8')):
+      return flask.jsonify(status=403, error='Invalid stats token'), 403
+    return flask.jsonify(object_storage=object_storage.pool_stats(),
+                         read_cache=read_cache.stats())
 
   @app.route('/')
   @app.route('/<path:filename>')
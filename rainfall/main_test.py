@@ -1,7 +1,553 @@
-from rainfall.main import create_app
+import io
+import json
+import os
+import zipfile
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import urllib3
+
+from rainfall import object_storage
+from rainfall.conftest import BASIC_USER_ID
+from rainfall.db import db, utcnow
+from rainfall.main import (configure_worker, create_app, init_worker_app,
+                           preview_priority, purge_objects_async, task_app,
+                           worker_app)
+from rainfall.site import (acquire_build_lock, preview_cache, public_dir,
+                           site_fingerprint, upload_site_objects,
+                           zip_object_path)
+
+
+def put_preview_asset(app, site, filename, data):
+  path = f'{app.config["PREVIEW_DIR"]}/{public_dir(site)}/{filename}'
+  object_storage.put_object(path, io.BytesIO(data), 'application/octet-stream')
 
 
 class MainTest:
 
   def test_create_app_no_errors(self):
     create_app()
+
+  def test_stats(self, app):
+    app.config['STATS_TOKEN'] = 'secret'
+    with app.app_context(), app.test_client() as client:
+      object_storage.put_object('stats/a.txt', io.BytesIO(b'a'), 'text/plain')
+      cache = preview_cache()
+
+      rv = client.get('/api/v1/stats',
+                      headers={'Authorization': 'Bearer secret'})
+
+      assert rv.status == '200 OK'
+      assert rv.json['object_storage']['requests'] >= 1
+      assert rv.json['read_cache'][cache.root] == cache.stats()
+
+  def test_stats_invalid_token(self, app):
+    app.config['STATS_TOKEN'] = 'secret'
+    with app.test_client() as client:
+      rv = client.get('/api/v1/stats',
+                      headers={'Authorization': 'Bearer wrong'})
+
+      assert rv.status == '403 FORBIDDEN'
+
+  def test_stats_disabled(self, app):
+    app.config['STATS_TOKEN'] = None
+    with app.test_client() as client:
+      rv = client.get('/api/v1/stats')
+
+      assert rv.status == '404 NOT FOUND'
+
+  def test_preview_index(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      put_preview_asset(app, site, 'index.html', b'<html></html>')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/preview/{site.id}/')
+      assert rv.status == '200 OK'
+      assert rv.data == b'<html></html>'
+      assert rv.mimetype == 'text/html'
+      assert rv.headers['Accept-Ranges'] == 'bytes'
+
+  def test_preview_asset_range(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      put_preview_asset(app, site, 'track/song.mp3', b'0123456789')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/preview/{site.id}/track/song.mp3',
+                      headers={'Range': 'bytes=2-5'})
+      assert rv.status == '206 PARTIAL CONTENT'
+      assert rv.data == b'2345'
+      assert rv.headers['Content-Length'] == '4'
+      assert rv.headers['Content-Range'] == 'bytes 2-5/10'
+      assert rv.mimetype == 'audio/mpeg'
+
+  def test_preview_asset_range_suffix(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      put_preview_asset(app, site, 'song.mp3', b'0123456789')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/preview/{site.id}/song.mp3',
+                      headers={'Range': 'bytes=-3'})
+      assert rv.status == '206 PARTIAL CONTENT'
+      assert rv.data == b'789'
+
+  def test_preview_asset_range_not_satisfiable(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      put_preview_asset(app, site, 'song.mp3', b'0123456789')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/preview/{site.id}/song.mp3',
+                      headers={'Range': 'bytes=20-30'})
+      assert rv.status == '416 REQUESTED RANGE NOT SATISFIABLE'
+      assert rv.headers['Content-Range'] == 'bytes */10'
+
+  def test_preview_asset_if_range_mismatch(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      put_preview_asset(app, site, 'song.mp3', b'0123456789')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/preview/{site.id}/song.mp3',
+                      headers={
+                          'Range': 'bytes=2-5',
+                          'If-Range': '"stale-etag"'
+                      })
+      assert rv.status == '200 OK'
+      assert rv.data == b'0123456789'
+
+  def test_preview_asset_not_found(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/preview/{site.id}/missing.mp3')
+      assert rv.status == '404 NOT FOUND'
+
+  def test_zip(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      object_storage.put_object(zip_object_path(app.config['PREVIEW_DIR'],
+                                                site), io.BytesIO(b'not-a-zip'),
+                                'application/zip')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/api/v1/zip/{site.id}')
+      assert rv.status == '200 OK'
+      assert rv.data == b'not-a-zip'
+      assert rv.headers['Content-Disposition'] == (
+          'attachment; filename=rainfall_site.zip')
+
+  def test_zip_streamed(self, app, sites_user, tmp_path):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      with open(os.path.join(tmp_path, 'index.html'), 'wb') as f:
+        f.write(b'<html></html>')
+      with open(os.path.join(tmp_path, 'song.mp3'), 'wb') as f:
+        f.write(b'0123456789')
+      upload_site_objects(app.config['PREVIEW_DIR'], str(site.id), tmp_path)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/api/v1/zip/{site.id}')
+      assert rv.status == '200 OK'
+      assert rv.headers['Content-Length'] == str(len(rv.data))
+      assert rv.headers['Content-Disposition'] == (
+          'attachment; filename=rainfall_site.zip')
+      with zipfile.ZipFile(io.BytesIO(rv.data)) as zf:
+        assert zf.read('public/song.mp3') == b'0123456789'
+
+      etag = rv.headers['ETag']
+      ranged = client.get(f'/api/v1/zip/{site.id}',
+                          headers={
+                              'Range': 'bytes=10-99',
+                              'If-Range': etag
+                          })
+      assert ranged.status == '206 PARTIAL CONTENT'
+      assert ranged.data == rv.data[10:100]
+      assert ranged.headers['Content-Range'] == (
+          f'bytes 10-99/{len(rv.data)}')
+
+  def test_zip_stored(self, app, sites_user, tmp_path):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      with open(os.path.join(tmp_path, 'index.html'), 'wb') as f:
+        f.write(b'<html></html>')
+      upload_site_objects(app.config['PREVIEW_DIR'], str(site.id), tmp_path)
+      object_storage.put_object(zip_object_path(app.config['PREVIEW_DIR'],
+                                                site), io.BytesIO(b'not-a-zip'),
+                                'application/zip')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      # The stored zip is served rather than streamed, so it can be
+      # redirected to.
+      rv = client.get(f'/api/v1/zip/{site.id}')
+      assert rv.data == b'not-a-zip'
+
+  def test_zip_not_found(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/api/v1/zip/{site.id}')
+      assert rv.status == '404 NOT FOUND'
+
+  def test_preview_asset_presigned_redirect(self, app, sites_user):
+    app.config['MINIO_PRESIGNED_REDIRECTS'] = True
+    app.config['MINIO_PUBLIC_ENDPOINT'] = app.config['MINIO_ENDPOINT']
+    app.config['MINIO_PUBLIC_SECURE'] = False
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      put_preview_asset(app, site, 'song.mp3', b'0123456789')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/preview/{site.id}/song.mp3')
+      assert rv.status == '302 FOUND'
+      location = rv.headers['Location']
+      assert location.startswith(f'http://{app.config["MINIO_ENDPOINT"]}/')
+      assert 'X-Amz-Signature=' in location
+      max_age = app.config['MINIO_PRESIGNED_EXPIRY']
+      assert rv.headers['Cache-Control'].startswith('private, max-age=')
+      assert max_age <= int(rv.headers['Cache-Control'].split('=')[1]) <= (
+          2 * max_age)
+      # The same URL within a window, so the browser's cached copy is used.
+      assert client.get(
+          f'/preview/{site.id}/song.mp3').headers['Location'] == location
+
+      resp = urllib3.request('GET', location)
+      assert resp.status == 200
+      assert resp.data == b'0123456789'
+      assert resp.headers['Content-Type'] == 'audio/mpeg'
+
+  def test_preview_index_presigned_not_redirected(self, app, sites_user):
+    app.config['MINIO_PRESIGNED_REDIRECTS'] = True
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      put_preview_asset(app, site, 'index.html', b'<html></html>')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/preview/{site.id}/')
+      assert rv.status == '200 OK'
+      assert rv.data == b'<html></html>'
+
+  def test_preview_styles_presigned_not_redirected(self, app, sites_user):
+    app.config['MINIO_PRESIGNED_REDIRECTS'] = True
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      put_preview_asset(app, site, 'style.css', b'body {}')
+      put_preview_asset(app, site, 'script.js', b'let a;')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      # Their relative references resolve against this URL.
+      assert client.get(f'/preview/{site.id}/style.css').data == b'body {}'
+      assert client.get(f'/preview/{site.id}/script.js').data == b'let a;'
+
+  def test_zip_presigned_redirect(self, app, sites_user):
+    app.config['MINIO_PRESIGNED_REDIRECTS'] = True
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      object_storage.put_object(zip_object_path(app.config['PREVIEW_DIR'],
+                                                site), io.BytesIO(b'not-a-zip'),
+                                'application/zip')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/api/v1/zip/{site.id}')
+      assert rv.status == '302 FOUND'
+      assert 'response-content-disposition=attachment' in rv.headers[
+          'Location']
+
+  def test_preview_asset_cached(self, app, sites_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+      put_preview_asset(app, site, 'style.css', b'body {}')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/preview/{site.id}/style.css')
+      assert rv.data == b'body {}'
+
+      with patch.object(object_storage.connect(), 'get_object') as mock_get:
+        rv = client.get(f'/preview/{site.id}/style.css',
+                        headers={'Range': 'bytes=1-3'})
+        mock_get.assert_not_called()
+      assert rv.status == '206 PARTIAL CONTENT'
+      assert rv.data == b'ody'
+      assert preview_cache().stats()['memory_hits'] >= 1
+
+      # A changed object has a new ETag, so it is never served stale.
+      put_preview_asset(app, site, 'style.css', b'body { color: red }')
+      rv = client.get(f'/preview/{site.id}/style.css')
+      assert rv.data == b'body { color: red }'
+
+  @patch('rainfall.main.generate_site_async')
+  def test_create_preview(self, mock_task, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.post(f'/api/v1/preview/{site.id}')
+
+      assert rv.status == '200 OK'
+      task_id = rv.json['task_id']
+      mock_task.apply_async.assert_called_once()
+      assert mock_task.apply_async.call_args.kwargs['task_id'] == task_id
+      assert mock_task.apply_async.call_args.kwargs['priority'] == 0
+      assert site.preview_task_id == task_id
+      assert site.build_queued_task_id == task_id
+
+  @patch('rainfall.main.generate_site_async')
+  def test_create_preview_attaches_to_queued(self, mock_task, app,
+                                             releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      first = client.post(f'/api/v1/preview/{site.id}')
+      second = client.post(f'/api/v1/preview/{site.id}')
+
+      assert second.json['task_id'] == first.json['task_id']
+      mock_task.apply_async.assert_called_once()
+
+  @patch('rainfall.main.generate_site_async')
+  def test_create_preview_stale_queued(self, mock_task, app, releases_user):
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+      site.build_queued_task_id = 'lost-task'
+      site.build_queued_at = utcnow() - timedelta(days=1)
+      db.session.commit()
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.post(f'/api/v1/preview/{site.id}')
+
+      assert rv.json['task_id'] != 'lost-task'
+      mock_task.apply_async.assert_called_once()
+
+  @patch('rainfall.main.generate_site_async')
+  def test_create_preview_follow_up(self, mock_task, app, releases_user):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+      site_id = str(site.id)
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      first = client.post(f'/api/v1/preview/{site_id}')
+      assert acquire_build_lock(site_id, first.json['task_id'])
+
+      # Requests during the build coalesce into a single follow-up build.
+      second = client.post(f'/api/v1/preview/{site_id}')
+      third = client.post(f'/api/v1/preview/{site_id}')
+
+      assert second.json['task_id'] != first.json['task_id']
+      assert third.json['task_id'] == second.json['task_id']
+      assert mock_task.apply_async.call_count == 2
+
+  @patch('rainfall.main._worker_app', None)
+  @patch('rainfall.main.create_app')
+  def test_worker_app_reused(self, mock_create_app):
+    app = worker_app()
+
+    assert worker_app() is app
+    mock_create_app.assert_called_once()
+
+  @patch('rainfall.main._worker_app', None)
+  @patch('rainfall.main.create_app')
+  def test_worker_app_after_fork(self, mock_create_app):
+    mock_create_app.side_effect = lambda: object()
+    app = worker_app()
+    with patch('rainfall.main.os.getpid', return_value=-1):
+      forked_app = worker_app()
+
+    assert forked_app is not app
+
+  @patch('rainfall.main._worker_app', None)
+  @patch('rainfall.main.purge_objects')
+  @patch('rainfall.main.create_app')
+  def test_tasks_use_worker_app(self, mock_create_app, mock_purge, app):
+    mock_create_app.return_value = app
+    init_worker_app()
+
+    purge_objects_async('purge-1')
+    purge_objects_async('purge-2')
+
+    mock_create_app.assert_called_once()
+    assert mock_purge.call_count == 2
+
+  def test_task_routes(self):
+    router = task_app.amqp.router
+
+    assert router.route({}, 'rainfall.main.generate_site_async')[
+        'queue'].name == 'interactive'
+    assert router.route(
+        {}, 'rainfall.main.purge_objects_async')['queue'].name == 'bulk'
+
+  def test_configure_worker(self):
+    conf = SimpleNamespace(queue_concurrency={'interactive': 3, 'bulk': 1},
+                           worker_concurrency=None)
+
+    configure_worker(conf=conf, options={'queues': ['interactive']})
+    assert conf.worker_concurrency == 3
+
+    configure_worker(conf=conf, options={'queues': None})
+    assert conf.worker_concurrency == 4
+
+    # -c takes precedence.
+    configure_worker(conf=conf, options={'queues': ['bulk'], 'concurrency': 8})
+    assert conf.worker_concurrency == 4
+
+  def test_preview_priority(self, app, releases_user):
+    conf = SimpleNamespace(preview_priority=0,
+                           large_preview_priority=6,
+                           large_preview_files=1)
+    with app.app_context():
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+
+      assert preview_priority(conf, site) == 6
+      conf.large_preview_files = 100
+      assert preview_priority(conf, site) == 0
+
+  @patch('rainfall.main.progress.connect')
+  def test_preview_events(self, mock_connect, app, sites_user):
+    client = mock_connect.return_value
+    client.get.return_value = json.dumps({
+        'task_id': 'task-1',
+        'stage': 'done',
+        'progress': 1,
+        'message': None
+    })
+    with app.app_context(), app.test_client() as http_client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+
+      with http_client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = http_client.get(f'/api/v1/preview/{site.id}/events?task_id=task-1')
+
+      assert rv.status == '200 OK'
+      assert rv.mimetype == 'text/event-stream'
+      assert b'"stage": "done"' in rv.data
+
+  def test_preview_events_disabled(self, app, sites_user):
+    app.config['REDIS_URL'] = None
+    with app.app_context(), app.test_client() as client:
+      db.session.add(sites_user)
+      site = sites_user.sites[0]
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.get(f'/api/v1/preview/{site.id}/events')
+
+      assert rv.status == '404 NOT FOUND'
+
+  @patch('rainfall.main.generate_site_async')
+  def test_create_preview_unchanged(self, mock_task, app, releases_user):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+      site.build_fingerprint = site_fingerprint(app.config['DATA_DIR'],
+                                                str(site.id))
+      site.preview_task_id = 'old-task'
+      db.session.commit()
+      put_preview_asset(app, site, 'index.html', b'<html></html>')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      calls = []
+      refresh = db.session.refresh
+      with patch('rainfall.main.site_fingerprint',
+                 side_effect=lambda *args: calls.append('fingerprint') or
+                 site_fingerprint(*args)), patch.object(
+                     db.session,
+                     'refresh',
+                     side_effect=lambda *args, **kwargs: calls.append(
+                         'refresh') or refresh(*args, **kwargs)):
+        rv = client.post(f'/api/v1/preview/{site.id}')
+      assert rv.json['task_id'] is None
+      mock_task.apply_async.assert_not_called()
+      # The site isn't fingerprinted while its row is locked.
+      assert calls == ['fingerprint', 'refresh']
+
+      rv = client.get(f'/api/v1/preview/{site.id}/status')
+      assert rv.json['task_status'] == 'SUCCESS'
+
+  @patch('rainfall.main.generate_site_async')
+  def test_create_preview_changed(self, mock_task, app, releases_user):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    with app.app_context(), app.test_client() as client:
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+      site.build_fingerprint = site_fingerprint(app.config['DATA_DIR'],
+                                                str(site.id))
+      site.releases[0].description = 'A new description'
+      db.session.commit()
+      put_preview_asset(app, site, 'index.html', b'<html></html>')
+
+      with client.session_transaction() as sess:
+        sess['user_id'] = BASIC_USER_ID
+
+      rv = client.post(f'/api/v1/preview/{site.id}')
+
+      assert rv.json['task_id'] is not None
+      mock_task.apply_async.assert_called_once()
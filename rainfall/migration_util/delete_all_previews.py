@@ -7,7 +7,7 @@ from werkzeug.utils import secure_filename as old_secure_filename
 from rainfall.db import db
 from rainfall.main import create_app
 from rainfall.models import Site
-from rainfall.site import build_dir, cache_dir, secure_filename, site_path
+from rainfall.site import build_dir, secure_filename, site_path
 
 
 def rename_all_sites():
@@ -17,7 +17,8 @@ def rename_all_sites():
   for site in Site.query.all():
     site_dir_path = site_path(data_dir_path, site)
     build_dir_path = build_dir(preview_dir_path, str(site.id))
-    cache_dir_path = cache_dir(preview_dir_path, str(site.id))
+    # Where faircamp's cache used to be kept, next to the build dir.
+    cache_dir_path = os.path.join(os.path.dirname(build_dir_path), 'cache')
     try:
       print(f'Deleting public dir for site {site_dir_path} -- {build_dir_path}')
       shutil.rmtree(build_dir_path)
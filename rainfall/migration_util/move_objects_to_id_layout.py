@@ -0,0 +1,82 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import flask
+
+from rainfall import object_storage
+from rainfall.main import create_app
+from rainfall.models import Site
+from rainfall.site import file_object_path, file_path
+
+# Moves song and artwork objects from their name based paths
+# (DATA_DIR/<user id>/<site name>/<release name>/<filename>) to their id based
+# paths (DATA_DIR/<user id>/<site id>/<release id>/<file id>).
+#
+# Every move is a copy followed by a delete, and objects that already exist at
+# their new path are skipped, so the script can be interrupted and re-run.
+
+MIGRATION_WORKERS = int(os.environ.get('MIGRATION_WORKERS', 16))
+
+urllib_logger = logging.getLogger('urllib3.connectionpool')
+urllib_logger.setLevel(logging.WARNING)
+
+
+def move_object(app, old_path, new_path):
+  with app.app_context():
+    if object_storage.object_exists(new_path):
+      if object_storage.object_exists(old_path):
+        # Copied on a previous run that was interrupted before the delete.
+        object_storage.remove_object(old_path)
+      return 'skipped'
+
+    if not object_storage.object_exists(old_path):
+      return 'missing'
+
+    object_storage.copy_object(old_path, new_path)
+    object_storage.remove_object(old_path)
+    return 'moved'
+
+
+def move_all_objects():
+  print('Querying sites...')
+  app = flask.current_app._get_current_object()
+  data_dir_path = app.config['DATA_DIR']
+
+  moves = []
+  for site in Site.query.all():
+    for release in site.releases:
+      files = list(release.files)
+      if release.artwork:
+        files.append(release.artwork)
+      for file in files:
+        moves.append((file_path(data_dir_path, file),
+                      file_object_path(data_dir_path, file)))
+
+  print(f'Moving {len(moves)} objects with {MIGRATION_WORKERS} workers...')
+  counts = {'moved': 0, 'skipped': 0, 'missing': 0, 'failed': 0}
+  with ThreadPoolExecutor(max_workers=MIGRATION_WORKERS) as pool:
+    futures = {
+        pool.submit(move_object, app, old_path, new_path): old_path
+        for old_path, new_path in moves
+    }
+    for future in as_completed(futures):
+      try:
+        result = future.result()
+      except Exception as e:
+        print(f'X - Could not move {futures[future]}: {e}')
+        result = 'failed'
+      if result == 'missing':
+        print(f'X - Object not found: {futures[future]}')
+      counts[result] += 1
+
+  print(f'Done: {counts}')
+  if counts['failed']:
+    print('Some objects failed to move, re-run to resume.')
+
+
+if __name__ == '__main__':
+  print('Running move_all_objects...')
+  app = create_app()
+  with app.app_context():
+    move_all_objects()
@@ -9,7 +9,7 @@ from rainfall import object_storage
 from rainfall.db import db
 from rainfall.main import create_app
 from rainfall.models import Site
-from rainfall.site import build_dir, cache_dir, secure_filename, site_path
+from rainfall.site import build_dir, secure_filename, site_path
 
 FROM_PREVIEW_DIR = os.environ.get('FROM_PREVIEW_DIR', '/data/preview-data')
 FROM_DATA_DIR = os.environ.get('FROM_DATA_DIR', '/data/song-data')
@@ -25,11 +25,13 @@ def upload_local_files():
   for site in Site.query.all():
     from_site_dir_path = site_path(FROM_DATA_DIR, site)
     from_build_dir_path = build_dir(FROM_PREVIEW_DIR, str(site.id))
-    from_cache_dir_path = cache_dir(FROM_PREVIEW_DIR, str(site.id))
+    # Where faircamp's cache used to be kept, next to the build dir.
+    from_cache_dir_path = os.path.join(os.path.dirname(from_build_dir_path),
+                                       'cache')
 
     site_dir_path = site_path(data_dir_path, site)
     build_dir_path = build_dir(preview_dir_path, str(site.id))
-    cache_dir_path = cache_dir(preview_dir_path, str(site.id))
+    cache_dir_path = os.path.join(os.path.dirname(build_dir_path), 'cache')
 
     try:
       print(
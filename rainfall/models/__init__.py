@@ -5,3 +5,6 @@ from .release import Release
 from .site import Site
 from .user import User
 from .integration import Integration
+from .object_purge import ObjectPurge
+from .transcode_blob import TranscodeBlob
+from .build_run import BuildRun
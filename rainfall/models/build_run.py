@@ -0,0 +1,58 @@
+from dataclasses import dataclass, fields
+from datetime import datetime
+
+from sqlalchemy import ForeignKey
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.types import (BigInteger, DateTime, Float, Integer, String,
+                              Text, Uuid)
+from uuid_extensions import uuid7
+
+from rainfall.db import db, utcnow
+
+
+@dataclass
+class BuildRun(db.Model):
+  '''
+  One build of a site's preview, with how long each stage took and how much
+  it transferred. Stages that didn't run are None.
+  '''
+  __tablename__ = 'build_runs'
+
+  id: Mapped[bytes] = mapped_column(Uuid, primary_key=True, default=uuid7)
+  site_id: Mapped[bytes] = mapped_column(
+      ForeignKey('sites.id', ondelete='CASCADE'), index=True)
+  task_id: Mapped[str] = mapped_column(String(255), nullable=True)
+  # 'running', 'success', 'failed' (faircamp failed), 'timeout' (faircamp
+  # ran out of time) or 'error'.
+  status: Mapped[str] = mapped_column(String(16), default='running')
+  # Naive UTC.
+  queued_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+  started_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
+  finished_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+  queue_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+  download_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+  eno_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+  faircamp_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+  publish_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+  zip_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+  cleanup_seconds: Mapped[float] = mapped_column(Float, nullable=True)
+
+  download_files: Mapped[int] = mapped_column(Integer, nullable=True)
+  download_bytes: Mapped[int] = mapped_column(BigInteger, nullable=True)
+  download_cached: Mapped[int] = mapped_column(Integer, nullable=True)
+  publish_files: Mapped[int] = mapped_column(Integer, nullable=True)
+  publish_bytes: Mapped[int] = mapped_column(BigInteger, nullable=True)
+  zip_bytes: Mapped[int] = mapped_column(BigInteger, nullable=True)
+
+  faircamp_version: Mapped[str] = mapped_column(String(255), nullable=True)
+  faircamp_exit_status: Mapped[int] = mapped_column(Integer, nullable=True)
+  # The end of faircamp's output (stdout and stderr).
+  faircamp_output_tail: Mapped[str] = mapped_column(Text, nullable=True)
+
+  def __repr__(self) -> str:
+    return (f'BuildRun(id={self.id!r}, site_id={self.site_id!r}, '
+            f'status={self.status!r})')
+
+  def serialize(self):
+    return {field.name: getattr(self, field.name) for field in fields(self)}
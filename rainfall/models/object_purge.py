@@ -0,0 +1,27 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.types import DateTime, Integer, String, Text, Uuid
+from uuid_extensions import uuid7
+
+from rainfall.db import db, utcnow
+
+
+@dataclass
+class ObjectPurge(db.Model):
+  '''
+  A tombstone for an object storage prefix whose database rows are already
+  deleted. The row is removed once every object under the prefix is gone.
+  '''
+  __tablename__ = 'object_purges'
+
+  id: Mapped[bytes] = mapped_column(Uuid, primary_key=True, default=uuid7)
+  prefix: Mapped[str] = mapped_column(String(1024))
+  # Naive UTC.
+  created_at: Mapped[datetime] = mapped_column(DateTime, default=utcnow)
+  attempts: Mapped[int] = mapped_column(Integer, default=0)
+  last_error: Mapped[str] = mapped_column(Text, nullable=True)
+
+  def __repr__(self) -> str:
+    return f'ObjectPurge(id={self.id!r}, prefix={self.prefix!r})'
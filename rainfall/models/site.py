@@ -1,9 +1,10 @@
 from typing import List
 from dataclasses import dataclass, fields
+from datetime import datetime
 
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy.types import Uuid, String, Text
+from sqlalchemy.types import DateTime, Uuid, String, Text
 from uuid_extensions import uuid7
 
 from rainfall.db import db
@@ -26,6 +27,17 @@ class Site(db.Model):
   releases: Mapped[List['Release']] = relationship(back_populates='site',
                                                    cascade='all, delete-orphan')
   preview_task_id: Mapped[str] = mapped_column(String(255), nullable=True)
+  # site_fingerprint() of the last successful build.
+  build_fingerprint: Mapped[str] = mapped_column(String(64), nullable=True)
+  # The build task that has been enqueued but not started, which new preview
+  # requests attach to.
+  build_queued_task_id: Mapped[str] = mapped_column(String(255),
+                                                    nullable=True)
+  build_queued_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+  # Set while a build runs, expires in case the worker dies. Naive UTC.
+  build_lock_until: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+  # The build task that holds the build lock.
+  build_lock_task_id: Mapped[str] = mapped_column(String(255), nullable=True)
 
   def __repr__(self) -> str:
     return f'Site(id={self.id!r}, user_id={self.user_id!r}, name={self.name!r})'
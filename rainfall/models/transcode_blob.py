@@ -0,0 +1,29 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.types import BigInteger, DateTime, Integer, String
+
+from rainfall.db import db, utcnow
+
+
+@dataclass
+class TranscodeBlob(db.Model):
+  '''
+  A file from faircamp's cache (a transcode, or faircamp's metadata about
+  one) stored once for the whole installation, by content hash.
+  '''
+  __tablename__ = 'transcode_blobs'
+
+  sha256: Mapped[str] = mapped_column(String(64), primary_key=True)
+  size: Mapped[int] = mapped_column(BigInteger)
+  # Naive UTC.
+  last_used_at: Mapped[datetime] = mapped_column(DateTime,
+                                                 default=utcnow,
+                                                 index=True)
+  # How many times a build produced this blob again and didn't have to store
+  # it (storage dedup, faircamp still transcoded it).
+  dedup_count: Mapped[int] = mapped_column(Integer, default=0)
+
+  def __repr__(self) -> str:
+    return f'TranscodeBlob(sha256={self.sha256!r}, size={self.size!r})'
@@ -0,0 +1,132 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class ObjectCache:
+  '''
+  A size-bounded, least recently used cache of object contents on the local
+  disk, keyed by ETag.
+
+  All state lives in the filesystem (an entry's atime is its last use) so the
+  cache can be shared by every worker process on a machine. Entries are hard
+  linked into place, so the cache dir must be on the same filesystem as the
+  paths it populates, and callers must never modify the linked files. An
+  entry's mtime is left alone, so links to it keep the same mtime.
+  '''
+
+  def __init__(self, root, max_bytes):
+    self.root = root
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _entry_path(self, etag):
+    return os.path.join(self.root, etag.strip('"'))
+
+  def materialize(self, etag, output_path, download):
+    '''
+    Places the object with the given ETag at output_path. On a miss,
+    download(path) is called to fetch the object to path first. Returns
+    whether it was a hit.
+    '''
+    os.makedirs(self.root, exist_ok=True)
+    entry_path = self._entry_path(etag)
+    if os.path.exists(entry_path):
+      hit = True
+      os.utime(entry_path,
+               ns=(time.time_ns(), os.stat(entry_path).st_mtime_ns))
+    else:
+      hit = False
+      tmp_path = f'{entry_path}.{uuid.uuid4().hex}.part'
+      try:
+        download(tmp_path)
+        os.replace(tmp_path, entry_path)
+      finally:
+        if os.path.exists(tmp_path):
+          os.remove(tmp_path)
+
+    with self._lock:
+      if hit:
+        self.hits += 1
+      else:
+        self.misses += 1
+
+    try:
+      link_or_copy(entry_path, output_path)
+    except FileNotFoundError:
+      # Evicted by another process between the check and the link.
+      download(output_path)
+    return hit
+
+  def evict(self):
+    '''Removes least recently used entries until the cache fits max_bytes.'''
+    entries = []
+    total = 0
+    if not os.path.isdir(self.root):
+      return
+    with os.scandir(self.root) as it:
+      for entry in it:
+        if not entry.is_file() or entry.name.endswith('.part'):
+          continue
+        stat = entry.stat()
+        entries.append((stat.st_atime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        # Evicted by another process.
+        continue
+      total -= size
+      with self._lock:
+        self.evictions += 1
+
+  def stats(self):
+    return {
+        'root': self.root,
+        'max_bytes': self.max_bytes,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+    }
+
+
+def link_or_copy(src, dst):
+  if os.path.exists(dst):
+    os.remove(dst)
+  try:
+    os.link(src, dst)
+  except OSError:
+    # Cross-device or no hard link support, fall back to a copy.
+    shutil.copyfile(src, dst)
+
+
+def get_cache(root, max_bytes):
+  '''
+  Returns the process-wide ObjectCache for root, or None if max_bytes is 0
+  (the cache is disabled).
+  '''
+  if not root or not max_bytes:
+    return None
+
+  with _caches_lock:
+    cache = _caches.get(root)
+    if cache is None or cache.max_bytes != max_bytes:
+      cache = ObjectCache(root, max_bytes)
+      _caches[root] = cache
+  return cache
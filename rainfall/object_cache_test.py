@@ -0,0 +1,70 @@
+import os
+
+from rainfall.object_cache import ObjectCache, get_cache
+
+
+def write_download(data):
+
+  def download(path):
+    with open(path, 'wb') as f:
+      f.write(data)
+
+  return download
+
+
+class ObjectCacheTest:
+
+  def test_materialize_miss_then_hit(self, tmp_path):
+    cache = ObjectCache(str(tmp_path / 'cache'), 1024)
+    out_1 = str(tmp_path / 'out_1.wav')
+    out_2 = str(tmp_path / 'out_2.wav')
+
+    assert not cache.materialize('etag1', out_1, write_download(b'song'))
+    assert cache.materialize('etag1', out_2,
+                             write_download(b'should not be downloaded'))
+
+    with open(out_2, 'rb') as f:
+      assert f.read() == b'song'
+    assert os.stat(out_2).st_ino == os.stat(tmp_path / 'cache' / 'etag1').st_ino
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+  def test_materialize_overwrites_output(self, tmp_path):
+    cache = ObjectCache(str(tmp_path / 'cache'), 1024)
+    out = tmp_path / 'out.wav'
+    out.write_bytes(b'stale')
+
+    cache.materialize('etag1', str(out), write_download(b'fresh'))
+
+    assert out.read_bytes() == b'fresh'
+
+  def test_evict_least_recently_used(self, tmp_path):
+    cache = ObjectCache(str(tmp_path / 'cache'), 10)
+    for i, etag in enumerate(('old', 'newer', 'newest')):
+      cache.materialize(etag, str(tmp_path / etag), write_download(b'12345'))
+      os.utime(tmp_path / 'cache' / etag, (i, i))
+
+    cache.evict()
+
+    assert not os.path.exists(tmp_path / 'cache' / 'old')
+    assert os.path.exists(tmp_path / 'cache' / 'newer')
+    assert os.path.exists(tmp_path / 'cache' / 'newest')
+    # Linked copies survive eviction.
+    assert (tmp_path / 'old').read_bytes() == b'12345'
+    assert cache.stats()['evictions'] == 1
+
+  def test_materialize_hit_keeps_mtime(self, tmp_path):
+    cache = ObjectCache(str(tmp_path / 'cache'), 1024)
+    cache.materialize('etag1', str(tmp_path / 'out_1'), write_download(b'a'))
+    os.utime(tmp_path / 'cache' / 'etag1', (100, 100))
+
+    cache.materialize('etag1', str(tmp_path / 'out_2'), write_download(b'a'))
+
+    assert os.stat(tmp_path / 'out_2').st_mtime == 100
+    assert os.stat(tmp_path / 'out_2').st_atime > 100
+
+  def test_get_cache_disabled(self, tmp_path):
+    assert get_cache(str(tmp_path), 0) is None
+
+  def test_get_cache_shared(self, tmp_path):
+    assert get_cache(str(tmp_path), 10) is get_cache(str(tmp_path), 10)
@@ -1,12 +1,25 @@
-import glob
+import io
 import logging
+import mimetypes
 import os
-from functools import wraps
+import queue
+import socket
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import partial, wraps
 
 import flask
+import urllib3
 from minio import Minio
-from minio.commonconfig import CopySource
+from minio.commonconfig import ComposeSource, CopySource
+from minio.datatypes import PostPolicy
 from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
+from werkzeug.http import dump_options_header
 
 log = logging.getLogger(__name__)
 
@@ -19,19 +32,214 @@ class ObjectDeleteException(ObjectStorageException):
   pass
 
 
+@dataclass
+class TransferStats:
+  files: int = 0
+  bytes: int = 0
+  seconds: float = 0.0
+  cached: int = 0
+
+  @property
+  def bytes_per_second(self):
+    return self.bytes / self.seconds if self.seconds else 0.0
+
+
+# Minio clients are thread safe and hold a urllib3 connection pool, so there
+# is one per process per set of credentials. Sockets must never be shared
+# between a parent and its forked children (gunicorn workers, Celery prefork
+# children), so the registry is emptied in the child after a fork.
+_clients = {}
+# The _CountingPoolManager of each client in _clients.
+_http_clients = []
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+_client_counters = {'created': 0, 'reused': 0}
+
+# Short lived cache of existence checks, (kind, bucket, path) -> (exists,
+# expiry). Writes and deletes made through this module invalidate it, changes
+# made by other processes show up once the entry expires.
+_exists_cache = {}
+_exists_cache_lock = threading.Lock()
+_EXISTS_CACHE_MAX_ENTRIES = 10000
+
+
+def _reset_clients():
+  global _clients_lock, _clients_pid
+  _clients.clear()
+  _http_clients.clear()
+  _clients_lock = threading.Lock()
+  _clients_pid = os.getpid()
+  _client_counters['created'] = 0
+  _client_counters['reused'] = 0
+  _exists_cache.clear()
+
+
+os.register_at_fork(after_in_child=_reset_clients)
+
+
+class _CountingPoolManager(urllib3.PoolManager):
+  '''
+  A PoolManager that counts its requests, and how many of them are waiting
+  for a response at the same time, for sizing MINIO_POOL_MAXSIZE.
+  '''
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.counters_lock = threading.Lock()
+    self.requests = 0
+    self.errors = 0
+    self.in_flight = 0
+    self.peak_in_flight = 0
+
+  def urlopen(self, method, url, redirect=True, **kw):
+    with self.counters_lock:
+      self.requests += 1
+      self.in_flight += 1
+      self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+    try:
+      return super().urlopen(method, url, redirect=redirect, **kw)
+    except Exception:
+      with self.counters_lock:
+        self.errors += 1
+      raise
+    finally:
+      with self.counters_lock:
+        self.in_flight -= 1
+
+
+def _http_client(app):
+  socket_options = list(urllib3.connection.HTTPConnection.default_socket_options)
+  if app.config['MINIO_KEEPALIVE']:
+    socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+
+  return _CountingPoolManager(
+      timeout=urllib3.Timeout(connect=app.config['MINIO_CONNECT_TIMEOUT'],
+                              read=app.config['MINIO_READ_TIMEOUT']),
+      maxsize=app.config['MINIO_POOL_MAXSIZE'],
+      socket_options=socket_options,
+      retries=urllib3.Retry(total=5,
+                            backoff_factor=0.2,
+                            status_forcelist=[500, 502, 503, 504]))
+
+
 def connect(app=None):
   if app is None:
     app = flask.current_app
-  return Minio(app.config['MINIO_ENDPOINT'],
-               access_key=app.config['MINIO_ACCESS_KEY'],
-               secret_key=app.config['MINIO_SECRET_KEY'],
-               secure=False)
+
+  if _clients_pid != os.getpid():
+    # Fork hooks don't run for every way a process can be cloned.
+    _reset_clients()
+
+  key = (app.config['MINIO_ENDPOINT'], app.config['MINIO_ACCESS_KEY'],
+         app.config['MINIO_SECRET_KEY'])
+  client = _clients.get(key)
+  if client is not None:
+    _client_counters['reused'] += 1
+    return client
+
+  with _clients_lock:
+    client = _clients.get(key)
+    if client is None:
+      http = _http_client(app)
+      client = Minio(app.config['MINIO_ENDPOINT'],
+                     access_key=app.config['MINIO_ACCESS_KEY'],
+                     secret_key=app.config['MINIO_SECRET_KEY'],
+                     secure=False,
+                     http_client=http)
+      _clients[key] = client
+      _http_clients.append(http)
+      _client_counters['created'] += 1
+    else:
+      _client_counters['reused'] += 1
+  return client
+
+
+def _presign_client(app):
+  # Presigned URLs are fetched by browsers, so they are signed for the public
+  # endpoint. Signing is done locally, the region is fixed so that no request
+  # is needed to look it up.
+  endpoint = app.config['MINIO_PUBLIC_ENDPOINT'] or app.config['MINIO_ENDPOINT']
+  key = ('presign', endpoint, app.config['MINIO_PUBLIC_SECURE'],
+         app.config['MINIO_REGION'], app.config['MINIO_ACCESS_KEY'],
+         app.config['MINIO_SECRET_KEY'])
+  client = _clients.get(key)
+  if client is None:
+    with _clients_lock:
+      client = _clients.get(key)
+      if client is None:
+        client = Minio(endpoint,
+                       access_key=app.config['MINIO_ACCESS_KEY'],
+                       secret_key=app.config['MINIO_SECRET_KEY'],
+                       secure=app.config['MINIO_PUBLIC_SECURE'],
+                       region=app.config['MINIO_REGION'])
+        _clients[key] = client
+  return client
+
+
+def pool_stats():
+  '''
+  Returns counters for the clients and connection pools of this process, for
+  sizing MINIO_POOL_MAXSIZE under load.
+  '''
+  stats = {
+      'pid': os.getpid(),
+      'clients': len(_clients),
+      'clients_created': _client_counters['created'],
+      'clients_reused': _client_counters['reused'],
+      'pools': 0,
+      'connections_opened': 0,
+      'connections_idle': 0,
+      'requests': 0,
+      'request_errors': 0,
+      'requests_in_flight': 0,
+      'peak_requests_in_flight': 0,
+  }
+  for http in list(_http_clients):
+    with http.counters_lock:
+      stats['requests'] += http.requests
+      stats['request_errors'] += http.errors
+      stats['requests_in_flight'] += http.in_flight
+      stats['peak_requests_in_flight'] += http.peak_in_flight
+    for pool_key in http.pools.keys():
+      pool = http.pools.get(pool_key)
+      if pool is None:
+        continue
+      stats['pools'] += 1
+      stats['connections_opened'] += pool.num_connections
+      stats['connections_idle'] += pool.pool.qsize() if pool.pool else 0
+  return stats
+
+
+def storage_backend(app=None):
+  '''
+  Returns the FilesystemStorage to use instead of MinIO, or None when
+  STORAGE_BACKEND is 'minio'.
+  '''
+  if app is None:
+    app = flask.current_app
+  if app.config['STORAGE_BACKEND'] == 'minio':
+    return None
+  if app.config['STORAGE_BACKEND'] != 'filesystem':
+    raise ObjectStorageException(
+        f'Unknown storage backend {app.config["STORAGE_BACKEND"]}')
+
+  # Imported here because filesystem_storage builds on this module.
+  from rainfall.filesystem_storage import FilesystemStorage
+  return FilesystemStorage(app.config['STORAGE_ROOT'])
 
 
 def inject_client_and_bucket(fn):
+  '''
+  Calls fn with the MinIO client and bucket, or, with another storage
+  backend, calls the backend's method of the same name instead.
+  '''
 
   @wraps(fn)
   def wrapper(*args, **kwargs):
+    backend = storage_backend()
+    if backend is not None:
+      return getattr(backend, fn.__name__)(*args, **kwargs)
+
     client = connect()
     bucket = flask.current_app.config['MINIO_BUCKET']
     return fn(client, bucket, *args, **kwargs)
@@ -39,7 +247,52 @@ def inject_client_and_bucket(fn):
   return wrapper
 
 
+def supports_presigned_urls():
+  return storage_backend() is None
+
+
+def _cached_exists(kind, bucket, path, check):
+  key = (kind, bucket, path)
+  now = time.monotonic()
+  cached = _exists_cache.get(key)
+  if cached is not None and cached[1] > now:
+    return cached[0]
+
+  exists = check()
+  config = flask.current_app.config
+  ttl = (config['MINIO_EXISTS_CACHE_TTL']
+         if exists else config['MINIO_EXISTS_CACHE_NEGATIVE_TTL'])
+  if ttl > 0:
+    with _exists_cache_lock:
+      if len(_exists_cache) >= _EXISTS_CACHE_MAX_ENTRIES:
+        _exists_cache.clear()
+      _exists_cache[key] = (exists, now + ttl)
+  return exists
+
+
+def _invalidate(*paths):
+  '''
+  Drops cached existence checks for paths, their parent prefixes and
+  everything under them. A path of None drops everything.
+  '''
+  with _exists_cache_lock:
+    if any(not path for path in paths):
+      _exists_cache.clear()
+      return
+    for key in list(_exists_cache):
+      cached_path = key[2]
+      if any(
+          path.startswith(cached_path) or cached_path.startswith(path)
+          for path in paths):
+        _exists_cache.pop(key, None)
+
+
 def create_bucket_if_not_exists(app):
+  backend = storage_backend(app)
+  if backend is not None:
+    backend.create_root()
+    return
+
   client = connect(app)
   bucket = app.config['MINIO_BUCKET']
   if not client.bucket_exists(bucket):
@@ -51,30 +304,444 @@ def get_object(client, bucket, path):
   return client.get_object(bucket, path)
 
 
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+def requested_range(stat):
+  '''
+  Returns the (start, stop) byte range the current request asks for, None to
+  send the whole object, or False if the range can't be satisfied.
+  '''
+  req_range = flask.request.range
+  if req_range is None or req_range.units != 'bytes' or len(
+      req_range.ranges) != 1:
+    return None
+
+  if_range = flask.request.if_range
+  if if_range.etag is not None and if_range.etag != stat.etag:
+    return None
+  if if_range.date is not None and (stat.last_modified is None or
+                                    stat.last_modified > if_range.date):
+    return None
+
+  return req_range.range_for_length(stat.size) or False
+
+
+def content_disposition(download_name):
+  return dump_options_header('attachment', {'filename': download_name})
+
+
+def _presign_window(now):
+  '''
+  Returns the start of the window of MINIO_PRESIGNED_EXPIRY seconds that now
+  is in, and when URLs signed for it expire: a window after it ends. URLs for
+  the same object signed in the same window are the same, so browsers can
+  cache the object behind them.
+  '''
+  expiry = flask.current_app.config['MINIO_PRESIGNED_EXPIRY']
+  start = datetime.fromtimestamp(now.timestamp() // expiry * expiry,
+                                 timezone.utc)
+  return start, start + timedelta(seconds=2 * expiry)
+
+
+def presigned_url(path, download_name, as_attachment=False, now=None):
+  '''
+  Returns a URL that allows a GET of the object at path for at least
+  MINIO_PRESIGNED_EXPIRY seconds after now.
+  '''
+  app = flask.current_app
+  start, expires_at = _presign_window(now or datetime.now(timezone.utc))
+  mimetype, _ = mimetypes.guess_type(download_name)
+  response_headers = {
+      'response-content-type': mimetype or 'application/octet-stream'
+  }
+  if as_attachment:
+    response_headers['response-content-disposition'] = content_disposition(
+        download_name)
+
+  return _presign_client(app).presigned_get_object(
+      app.config['MINIO_BUCKET'],
+      path,
+      expires=expires_at - start,
+      response_headers=response_headers,
+      request_date=start)
+
+
+def _redirected(mimetype, as_attachment):
+  # Only downloads and media are redirected. Pages, stylesheets and scripts
+  # are proxied, because their relative references (links, url() in CSS)
+  # must resolve against our URL, not against the signed one.
+  if as_attachment:
+    return True
+  if mimetype is None or mimetype == 'image/svg+xml':
+    return False
+  return (mimetype.split('/')[0] in ('audio', 'video', 'image') or
+          mimetype == 'application/zip')
+
+
+def serve_object(path, download_name, as_attachment=False, cache=None):
+  '''
+  Responds to the current request with the object at path. With
+  MINIO_PRESIGNED_REDIRECTS enabled, downloads and media are a redirect to a
+  short lived presigned URL, so their bytes never pass through this process.
+  Proxied objects are read through cache, a ReadCache, when one is given.
+  '''
+  mimetype, _ = mimetypes.guess_type(download_name)
+  if (flask.current_app.config['MINIO_PRESIGNED_REDIRECTS'] and
+      _redirected(mimetype, as_attachment) and supports_presigned_urls()):
+    now = datetime.now(timezone.utc)
+    response = flask.redirect(
+        presigned_url(path, download_name, as_attachment=as_attachment,
+                      now=now))
+    # The redirect is cached for as long as the URL stays valid.
+    _, expires_at = _presign_window(now)
+    max_age = int((expires_at - now).total_seconds())
+    response.headers['Cache-Control'] = f'private, max-age={max_age}'
+    return response
+
+  return send_object(path,
+                     download_name,
+                     as_attachment=as_attachment,
+                     cache=cache)
+
+
+def _fetch_object(client, bucket, path, out):
+  obj = client.get_object(bucket, path)
+  try:
+    for chunk in obj.stream(STREAM_CHUNK_SIZE):
+      out.write(chunk)
+  finally:
+    obj.close()
+    obj.release_conn()
+
+
+def _stream_file(f, start, stop):
+  try:
+    f.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+      chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+      if not chunk:
+        break
+      remaining -= len(chunk)
+      yield chunk
+  finally:
+    f.close()
+
+
+def _stream_object(client, bucket, path, offset, length):
+  if not length:
+    return
+  obj = client.get_object(bucket, path, offset=offset, length=length)
+  try:
+    yield from obj.stream(STREAM_CHUNK_SIZE)
+  finally:
+    obj.close()
+    obj.release_conn()
+
+
+@inject_client_and_bucket
+def stream_object(client, bucket, path, offset, length):
+  '''
+  Yields length bytes of the object at path, starting at offset. The
+  connection is returned to the pool when the generator is closed.
+  '''
+  return _stream_object(client, bucket, path, offset, length)
+
+
+@inject_client_and_bucket
+def object_streamer(client, bucket):
+  '''
+  Returns stream_object bound to the current app's storage, for streaming
+  objects once the app context is gone, e.g. in a response body.
+  '''
+  return partial(_stream_object, client, bucket)
+
+
+@inject_client_and_bucket
+def send_object(client,
+                bucket,
+                path,
+                download_name,
+                as_attachment=False,
+                cache=None):
+  '''
+  Streams the object at path as the response to the current request,
+  honoring single byte Range requests. The connection is returned to the
+  pool as soon as the response is closed.
+  '''
+  try:
+    stat = client.stat_object(bucket, path)
+  except S3Error as e:
+    if e.code in ('NoSuchKey', 'NoSuchObject', 'ResourceNotFound'):
+      flask.abort(404)
+    raise
+
+  mimetype, _ = mimetypes.guess_type(download_name)
+  headers = {'Accept-Ranges': 'bytes'}
+  response = flask.Response(
+      mimetype=mimetype or stat.content_type or 'application/octet-stream',
+      headers=headers)
+  if as_attachment:
+    response.headers['Content-Disposition'] = content_disposition(
+        download_name)
+  response.set_etag(stat.etag)
+  if stat.last_modified is not None:
+    response.last_modified = stat.last_modified
+
+  byte_range = requested_range(stat)
+  if byte_range is False:
+    response.status_code = 416
+    response.headers['Content-Range'] = f'bytes */{stat.size}'
+    return response
+
+  if byte_range is None:
+    start, stop = 0, stat.size
+  else:
+    start, stop = byte_range
+    response.status_code = 206
+    response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{stat.size}'
+  response.content_length = stop - start
+
+  if flask.request.method == 'HEAD' or stop == start:
+    return response
+
+  if cache is not None:
+    f = cache.open(path, stat.etag, stat.size,
+                   lambda out: _fetch_object(client, bucket, path, out))
+    if f is not None:
+      response.response = _stream_file(f, start, stop)
+      response.call_on_close(f.close)
+      return response
+
+  obj = client.get_object(bucket, path, offset=start, length=stop - start)
+
+  def release():
+    obj.close()
+    obj.release_conn()
+
+  def generate():
+    try:
+      yield from obj.stream(STREAM_CHUNK_SIZE)
+    finally:
+      release()
+
+  response.response = generate()
+  # Also runs if the body is never iterated, e.g. the client went away.
+  response.call_on_close(release)
+  return response
+
+
 @inject_client_and_bucket
 def put_object(client, bucket, path, file, content_type):
   content_length = file.seek(0, 2)
   file.seek(0)  # Reset the file pointer to the beginning.
   client.put_object(bucket, path, file, content_length, content_type)
+  _invalidate(path)
+
+
+# Chunks written to a _StreamPipe that haven't been read yet.
+_STREAM_PIPE_CHUNKS = 64
+# Ends the chunks in a _StreamPipe.
+_END = object()
+
+
+class _StreamPipe(io.RawIOBase):
+  '''
+  A writable, non-seekable file whose contents are read by another thread,
+  holding at most _STREAM_PIPE_CHUNKS chunks in between. If writing fails,
+  reading raises instead of ending, so that the reader never takes part of
+  the contents for all of it.
+  '''
+
+  def __init__(self):
+    self._chunks = queue.Queue(maxsize=_STREAM_PIPE_CHUNKS)
+    self._buffer = bytearray()
+    self._ended = False
+    self._closed_by_reader = False
+    self._size = 0
+    self.error = None
+
+  def writable(self):
+    return True
+
+  def tell(self):
+    return self._size
+
+  def write(self, b):
+    if self._closed_by_reader:
+      raise ObjectStorageException('The stream is no longer read')
+    self._chunks.put(bytes(b))
+    self._size += len(b)
+    return len(b)
+
+  def run_writer(self, write):
+    try:
+      write(self)
+    except BaseException as e:
+      self.error = e
+    self._chunks.put(_END)
+
+  def read(self, size=-1):
+    # Returns all of size at once where possible, so that the caller doesn't
+    # concatenate a part from many small chunks.
+    while not self._ended and (size < 0 or len(self._buffer) < size):
+      chunk = self._chunks.get()
+      if chunk is _END:
+        self._ended = True
+      else:
+        self._buffer += chunk
+    if self._ended and self.error is not None:
+      raise ObjectStorageException('Writing the stream failed')
+    if size < 0:
+      size = len(self._buffer)
+    data = bytes(self._buffer[:size])
+    del self._buffer[:size]
+    return data
+
+  def stop_reading(self, writer):
+    '''
+    Makes the write()s of the thread writer fail, and waits for it to end.
+    '''
+    self._closed_by_reader = True
+    while writer.is_alive():
+      # Unblocks a write() that waits for room.
+      try:
+        self._chunks.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    writer.join()
+
+
+@inject_client_and_bucket
+def put_stream(client, bucket, path, write, content_type):
+  '''
+  Uploads what write(f) writes to the binary file f as the object path, while
+  it is being written, so the object never has to fit on disk. f is not
+  seekable, and write runs in another thread. Returns the size of the object.
+  '''
+  config = flask.current_app.config
+  pipe = _StreamPipe()
+  writer = threading.Thread(target=pipe.run_writer, args=(write,))
+  writer.start()
+  try:
+    # A multipart upload, unless the object fits in a single part. MinIO
+    # aborts the upload if reading the stream fails.
+    client.put_object(bucket,
+                      path,
+                      pipe,
+                      -1,
+                      content_type,
+                      part_size=config['MINIO_UPLOAD_PART_SIZE'],
+                      num_parallel_uploads=config['MINIO_UPLOAD_PART_WORKERS'])
+  except BaseException:
+    # Raises the error of write() if that's what failed the upload. Stopping
+    # the writer makes it fail too.
+    error = pipe.error
+    pipe.stop_reading(writer)
+    if error is not None:
+      raise error
+    raise
+  finally:
+    _invalidate(path)
+  writer.join()
+  return pipe.tell()
+
+
+def presigned_post_form(path, size):
+  '''
+  Returns the URL and form fields for a browser to upload exactly size bytes
+  as the object path, with a multipart/form-data POST whose last field is the
+  file, for MINIO_PRESIGNED_UPLOAD_EXPIRY seconds. The size is part of the
+  signed policy, so the storage rejects a file of any other size.
+  '''
+  app = flask.current_app
+  config = app.config
+  policy = PostPolicy(
+      config['MINIO_BUCKET'],
+      datetime.now(timezone.utc) +
+      timedelta(seconds=config['MINIO_PRESIGNED_UPLOAD_EXPIRY']))
+  policy.add_equals_condition('key', path)
+  policy.add_content_length_range_condition(size, size)
+  fields = _presign_client(app).presigned_post_policy(policy)
+  fields['key'] = path
+  endpoint = config['MINIO_PUBLIC_ENDPOINT'] or config['MINIO_ENDPOINT']
+  scheme = 'https' if config['MINIO_PUBLIC_SECURE'] else 'http'
+  return {
+      'url': f'{scheme}://{endpoint}/{config["MINIO_BUCKET"]}',
+      'fields': fields,
+  }
+
+
+@inject_client_and_bucket
+def compose_parts(client,
+                  bucket,
+                  path,
+                  part_paths,
+                  part_sizes,
+                  content_type,
+                  max_size=None):
+  '''
+  Combines the objects part_paths into the object path, server side. Raises
+  without combining them if a part is missing or isn't of its size in
+  part_sizes, or if the parts add up to more than max_size. The parts are
+  left for the caller to remove.
+  '''
+  if max_size is not None and sum(part_sizes) > max_size:
+    raise ObjectStorageException(
+        f'Parts of {path} are {sum(part_sizes)} bytes, more than {max_size}')
+  for part_path, size in zip(part_paths, part_sizes, strict=True):
+    try:
+      stat = client.stat_object(bucket, part_path)
+    except S3Error as e:
+      raise ObjectStorageException(f'Part {part_path} was not uploaded') from e
+    if stat.size != size:
+      raise ObjectStorageException(
+          f'Part {part_path} is {stat.size} bytes instead of {size}')
+
+  client.compose_object(bucket,
+                        path,
+                        [ComposeSource(bucket, part_path)
+                         for part_path in part_paths],
+                        metadata={'Content-Type': content_type})
+  _invalidate(path)
+
+
+@inject_client_and_bucket
+def copy_object(client, bucket, old_path, new_path):
+  client.copy_object(bucket, new_path, CopySource(bucket, old_path))
+  _invalidate(new_path)
 
 
 @inject_client_and_bucket
 def remove_object(client, bucket, path):
   client.remove_object(bucket, path)
+  _invalidate(path)
 
 
-@inject_client_and_bucket
-def rmtree(client, bucket, path):
-  delete_object_list = map(
-      lambda x: DeleteObject(x.object_name),
-      client.list_objects(bucket, path, recursive=True),
-  )
+# The most keys S3 accepts in one DeleteObjects request.
+DELETE_BATCH_SIZE = 1000
+
 
-  errors = client.remove_objects(bucket, delete_object_list)
+def _remove_batch(client, bucket, names):
   num_errors = 0
-  for e in errors:
+  for e in client.remove_objects(bucket, [DeleteObject(n) for n in names]):
     log.error('Error deleting %s: %s', e.object_name, e.error_message)
     num_errors += 1
+  return num_errors
+
+
+def _remove_objects(client, bucket, names, path):
+  # Batches are deleted MINIO_DELETE_WORKERS at a time while the listing
+  # continues.
+  workers = flask.current_app.config['MINIO_DELETE_WORKERS']
+  names = iter(names)
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = []
+    while batch := list(itertools.islice(names, DELETE_BATCH_SIZE)):
+      futures.append(pool.submit(_remove_batch, client, bucket, batch))
+    num_errors = sum(future.result() for future in futures)
+  _invalidate(path)
 
   if num_errors > 0:
     raise ObjectDeleteException(
@@ -82,39 +749,257 @@ def rmtree(client, bucket, path):
     )
 
 
+@inject_client_and_bucket
+def remove_objects(client, bucket, paths):
+  paths = list(paths)
+  if paths:
+    _remove_objects(client, bucket, paths, os.path.commonpath(paths))
+
+
+@inject_client_and_bucket
+def rmtree(client, bucket, path):
+  _remove_objects(
+      client, bucket,
+      (x.object_name for x in client.list_objects(bucket, path, recursive=True)),
+      path)
+
+
 @inject_client_and_bucket
 def download_file(client, bucket, path, output_path):
   client.fget_object(bucket, path, output_path)
 
 
+def _fget_object(client, bucket, path, output_path):
+  stat = client.fget_object(bucket, path, output_path)
+  if stat.last_modified is not None:
+    mtime = stat.last_modified.timestamp()
+    os.utime(output_path, (mtime, mtime))
+  return stat
+
+
+def _download_file(client, bucket, path, output_path, cache):
+  os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+  if cache is None:
+    return False, _fget_object(client, bucket, path, output_path).size
+
+  stat = client.stat_object(bucket, path)
+  hit = cache.materialize(
+      stat.etag, output_path,
+      lambda tmp_path: _fget_object(client, bucket, path, tmp_path))
+  return hit, 0 if hit else stat.size
+
+
+@inject_client_and_bucket
+def download_files(client, bucket, paths, cache=None):
+  '''
+  Downloads (object path, local path) pairs, MINIO_DOWNLOAD_WORKERS at a time.
+  If an ObjectCache is given, objects whose ETag is already cached are linked
+  into place instead of downloaded. Returns a TransferStats of the bytes that
+  were actually transferred.
+
+  Downloaded files get the object's last modified time as their mtime, so
+  repeated downloads of an object look unchanged to tools like faircamp.
+  '''
+  config = flask.current_app.config
+  start = time.monotonic()
+  stats = TransferStats()
+
+  with ThreadPoolExecutor(
+      max_workers=config['MINIO_DOWNLOAD_WORKERS']) as pool:
+    futures = [
+        pool.submit(_download_file, client, bucket, path, output_path, cache)
+        for path, output_path in paths
+    ]
+    try:
+      for future in futures:
+        hit, size = future.result()
+        stats.files += 1
+        stats.bytes += size
+        stats.cached += hit
+    except Exception:
+      pool.shutdown(cancel_futures=True)
+      raise
+
+  if cache is not None:
+    cache.evict()
+
+  stats.seconds = time.monotonic() - start
+  return stats
+
+
+def walk_files(path, output_path):
+  '''Yields (local_path, remote_path, size) for every file under path.'''
+  stack = [(path, output_path)]
+  while stack:
+    local_dir, remote_dir = stack.pop()
+    with os.scandir(local_dir) as entries:
+      for entry in entries:
+        remote_path = os.path.join(remote_dir, entry.name)
+        if entry.is_dir():
+          stack.append((entry.path, remote_path))
+        elif entry.is_file():
+          yield entry.path, remote_path, entry.stat().st_size
+
+
+def _upload_file(client, bucket, local_path, remote_path, part_size,
+                 part_workers):
+  content_type, _ = mimetypes.guess_type(local_path)
+  # Files larger than part_size are sent as a multipart upload with
+  # part_workers parts in flight at once.
+  client.fput_object(bucket,
+                     remote_path,
+                     local_path,
+                     content_type=content_type or 'application/octet-stream',
+                     part_size=part_size,
+                     num_parallel_uploads=part_workers)
+
+
+def _upload_files(client, bucket, files, output_path):
+  config = flask.current_app.config
+  start = time.monotonic()
+  stats = TransferStats()
+
+  with ThreadPoolExecutor(max_workers=config['MINIO_UPLOAD_WORKERS']) as pool:
+    futures = []
+    for local_path, remote_path, size in files:
+      futures.append(
+          pool.submit(_upload_file, client, bucket, local_path, remote_path,
+                      config['MINIO_UPLOAD_PART_SIZE'],
+                      config['MINIO_UPLOAD_PART_WORKERS']))
+      stats.files += 1
+      stats.bytes += size
+
+    try:
+      for future in futures:
+        future.result()
+    except Exception:
+      pool.shutdown(cancel_futures=True)
+      raise
+    finally:
+      _invalidate(output_path)
+
+  stats.seconds = time.monotonic() - start
+  return stats
+
+
 @inject_client_and_bucket
 def upload_dir_recursively(client, bucket, path, output_path):
+  '''
+  Uploads every file under the local directory path to output_path in object
+  storage, MINIO_UPLOAD_WORKERS files at a time. Returns a TransferStats.
+  '''
   assert os.path.isdir(path)
-  for local_file in glob.glob(path + '/**'):
-    remote_path = os.path.join(output_path, os.path.basename(local_file))
-    if not os.path.isfile(local_file):
-      upload_dir_recursively(local_file, remote_path)
-    else:
-      client.fput_object(bucket, remote_path, local_file)
+  return _upload_files(client, bucket, walk_files(path, output_path),
+                       output_path)
+
+
+@inject_client_and_bucket
+def upload_files(client, bucket, files):
+  '''
+  Uploads (local_path, remote_path, size) tuples, MINIO_UPLOAD_WORKERS files
+  at a time. Returns a TransferStats.
+  '''
+  files = list(files)
+  if not files:
+    return TransferStats()
+  return _upload_files(client, bucket, files,
+                       os.path.commonpath([f[1] for f in files]))
+
+
+def _copy_verified(client, bucket, obj, old_path, new_path):
+  new_name = obj.object_name.replace(old_path, new_path, 1)
+  client.copy_object(bucket, new_name, CopySource(bucket, obj.object_name))
+
+  copied = client.stat_object(bucket, new_name)
+  # Multipart ETags depend on the part layout, so only compare simple ones.
+  etag_mismatch = '-' not in obj.etag and copied.etag != obj.etag
+  if copied.size != obj.size or etag_mismatch:
+    raise ObjectStorageException(
+        f'Copy of {obj.object_name} to {new_name} does not match the original')
+  return obj.size
 
 
 @inject_client_and_bucket
 def rename_dir_recursively(client, bucket, old_path, new_path):
-  objects = client.list_objects(bucket, prefix=old_path, recursive=True)
-  for obj in objects:
-    old_name = obj.object_name
-    new_name = old_name.replace(old_path, new_path, 1)
-
-    # Move is a copy + delete.
-    client.copy_object(
-        bucket,
-        new_name,
-        CopySource(bucket, old_name),
-    )
-    client.remove_object(bucket, old_name)
+  '''
+  Moves every object under old_path to new_path. Objects are copied server
+  side, MINIO_COPY_WORKERS at a time, and the originals are only deleted (in
+  bulk) once every copy has been verified. Returns a TransferStats.
+  '''
+  config = flask.current_app.config
+  start = time.monotonic()
+  stats = TransferStats()
+  objects = list(client.list_objects(bucket, prefix=old_path, recursive=True))
+
+  with ThreadPoolExecutor(max_workers=config['MINIO_COPY_WORKERS']) as pool:
+    futures = [
+        pool.submit(_copy_verified, client, bucket, obj, old_path, new_path)
+        for obj in objects
+    ]
+    try:
+      for future in futures:
+        stats.bytes += future.result()
+        stats.files += 1
+    except Exception:
+      pool.shutdown(cancel_futures=True)
+      # Nothing has been deleted yet, so the originals are still intact.
+      raise
+    finally:
+      _invalidate(new_path)
+
+  _remove_objects(client, bucket, (obj.object_name for obj in objects),
+                  old_path)
+
+  stats.seconds = time.monotonic() - start
+  return stats
+
+
+@inject_client_and_bucket
+def object_exists(client, bucket, path):
+  '''Whether an object exists at exactly path.'''
+
+  def check():
+    try:
+      client.stat_object(bucket, path)
+    except S3Error as e:
+      if e.code in ('NoSuchKey', 'NoSuchObject', 'ResourceNotFound'):
+        return False
+      raise
+    return True
+
+  return _cached_exists('object', bucket, path, check)
+
+
+@inject_client_and_bucket
+def object_etags(client, bucket, paths):
+  '''
+  Returns {path: ETag} for the given object paths, stat'ing
+  MINIO_DOWNLOAD_WORKERS at a time. Raises if an object doesn't exist.
+  '''
+  paths = list(paths)
+  workers = flask.current_app.config['MINIO_DOWNLOAD_WORKERS']
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    stats = pool.map(lambda path: client.stat_object(bucket, path), paths)
+    return {path: stat.etag for path, stat in zip(paths, stats)}
 
 
 @inject_client_and_bucket
 def path_exists(client, bucket, path, recursive=False):
-  objects = client.list_objects(bucket, prefix=path, recursive=recursive)
-  return any(objects)
+  '''
+  Whether any object name starts with path. With recursive=False, a
+  "directory" at path also counts.
+  '''
+
+  def check():
+    # Any object under path shows up in a listing delimited by '/', either
+    # itself or as a common prefix, so the listing is delimited either way.
+    # Its first page then has one entry per name segment after path, not one
+    # per object, and only the first entry is read.
+    objects = client.list_objects(bucket, prefix=path, recursive=False)
+    try:
+      return next(objects, None) is not None
+    finally:
+      objects.close()
+
+  return _cached_exists('recursive' if recursive else 'prefix', bucket, path,
+                        check)
@@ -0,0 +1,299 @@
+import io
+import os
+from unittest.mock import patch
+
+import pytest
+import urllib3
+
+from rainfall import object_storage
+
+
+class ObjectStorageTest:
+
+  def test_connect_reuses_client(self, app):
+    with app.app_context():
+      client = object_storage.connect()
+      assert object_storage.connect() is client
+      assert object_storage.connect(app) is client
+
+  def test_presigned_post_form(self, app):
+    app.config['MINIO_PUBLIC_ENDPOINT'] = app.config['MINIO_ENDPOINT']
+    app.config['MINIO_PUBLIC_SECURE'] = False
+    with app.app_context():
+      form = object_storage.presigned_post_form('post/part', 4)
+      resp = urllib3.request('POST',
+                             form['url'],
+                             fields=dict(form['fields'],
+                                         file=('part', b'part')))
+      assert resp.status == 204
+      assert object_storage.get_object('post/part').read() == b'part'
+
+    assert form['fields']['key'] == 'post/part'
+    assert 'policy' in form['fields']
+
+  def test_compose_parts(self, app):
+    with app.app_context():
+      object_storage.put_object('compose/1', io.BytesIO(b'song'),
+                                'application/octet-stream')
+      object_storage.compose_parts('compose/song', ['compose/1'], [4],
+                                   'audio/wav')
+      assert object_storage.get_object('compose/song').read() == b'song'
+      assert object_storage.connect().stat_object(
+          app.config['MINIO_BUCKET'], 'compose/song').content_type == (
+              'audio/wav')
+
+  def test_compose_parts_wrong_size(self, app):
+    with app.app_context():
+      object_storage.put_object('compose/1', io.BytesIO(b'too large'),
+                                'application/octet-stream')
+      with pytest.raises(object_storage.ObjectStorageException):
+        object_storage.compose_parts('compose/large', ['compose/1'], [4],
+                                     'audio/wav')
+      with pytest.raises(object_storage.ObjectStorageException):
+        object_storage.compose_parts('compose/large', ['compose/1'], [9],
+                                     'audio/wav',
+                                     max_size=4)
+      with pytest.raises(object_storage.ObjectStorageException):
+        object_storage.compose_parts('compose/large', ['compose/2'], [9],
+                                     'audio/wav')
+      assert not object_storage.object_exists('compose/large')
+
+  def test_connect_pool_config(self, app):
+    with patch.dict(app.config, {
+        'MINIO_ENDPOINT': 'pool-config.fake:9000',
+        'MINIO_POOL_MAXSIZE': 32,
+        'MINIO_CONNECT_TIMEOUT': 2.5
+    }):
+      client = object_storage.connect(app)
+
+    assert client._http.connection_pool_kw['maxsize'] == 32
+    assert client._http.connection_pool_kw['timeout'].connect_timeout == 2.5
+
+  def test_connect_new_client_after_fork(self, app):
+    with app.app_context():
+      client = object_storage.connect()
+      with patch('rainfall.object_storage.os.getpid', return_value=-1):
+        forked_client = object_storage.connect()
+
+    assert forked_client is not client
+
+  def test_pool_stats(self, app):
+    with app.app_context():
+      object_storage.put_object('pool_stats/a.txt', io.BytesIO(b'a'),
+                                'text/plain')
+      object_storage.get_object('pool_stats/a.txt').read()
+      actual = object_storage.pool_stats()
+
+    assert actual['clients'] >= 1
+    assert actual['clients_reused'] >= 1
+    assert actual['pools'] >= 1
+    assert actual['requests'] >= 2
+    assert actual['peak_requests_in_flight'] >= 1
+    assert actual['requests_in_flight'] == 0
+    assert actual['connections_opened'] >= 1
+
+  def test_upload_dir_recursively(self, app, tmp_path):
+    (tmp_path / 'nested' / 'deeper').mkdir(parents=True)
+    (tmp_path / 'index.html').write_bytes(b'<html></html>')
+    (tmp_path / 'nested' / 'a.css').write_bytes(b'body {}')
+    (tmp_path / 'nested' / 'deeper' / 'b.mp3').write_bytes(b'not-an-mp3')
+
+    with app.app_context():
+      actual = object_storage.upload_dir_recursively(path=str(tmp_path),
+                                                     output_path='upload')
+
+      assert object_storage.get_object('upload/index.html').read() == (
+          b'<html></html>')
+      assert object_storage.get_object('upload/nested/a.css').read() == (
+          b'body {}')
+      assert object_storage.get_object('upload/nested/deeper/b.mp3').read() == (
+          b'not-an-mp3')
+
+    assert actual.files == 3
+    assert actual.bytes == 30
+    assert actual.seconds > 0
+
+  def test_upload_dir_recursively_multipart(self, app, tmp_path):
+    data = os.urandom(6 * 1024 * 1024)
+    (tmp_path / 'big.flac').write_bytes(data)
+    app.config['MINIO_UPLOAD_PART_SIZE'] = 5 * 1024 * 1024
+
+    with app.app_context():
+      object_storage.upload_dir_recursively(path=str(tmp_path),
+                                            output_path='upload')
+
+      assert object_storage.get_object('upload/big.flac').read() == data
+
+  def test_upload_dir_recursively_not_a_dir(self, app, tmp_path):
+    with app.app_context(), pytest.raises(AssertionError):
+      object_storage.upload_dir_recursively(path=str(tmp_path / 'missing'),
+                                            output_path='upload')
+
+  def test_put_stream(self, app):
+    with app.app_context():
+      actual = object_storage.put_stream('stream/a.txt',
+                                         lambda f: f.write(b'hello'),
+                                         'text/plain')
+
+      assert actual == 5
+      assert object_storage.get_object('stream/a.txt').read() == b'hello'
+
+  def test_put_stream_multipart(self, app):
+    data = os.urandom(11 * 1024 * 1024)
+    app.config['MINIO_UPLOAD_PART_SIZE'] = 5 * 1024 * 1024
+
+    def write(f):
+      for i in range(0, len(data), 1024 * 1024):
+        f.write(data[i:i + 1024 * 1024])
+
+    with app.app_context():
+      actual = object_storage.put_stream('stream/big.zip', write,
+                                         'application/zip')
+
+      assert actual == len(data)
+      assert object_storage.get_object('stream/big.zip').read() == data
+
+  def test_put_stream_error(self, app):
+    app.config['MINIO_UPLOAD_PART_SIZE'] = 5 * 1024 * 1024
+
+    def write(f):
+      f.write(os.urandom(6 * 1024 * 1024))
+      raise ValueError('broken')
+
+    with app.app_context():
+      with pytest.raises(ValueError):
+        object_storage.put_stream('stream/broken.zip', write,
+                                  'application/zip')
+
+      assert not object_storage.object_exists('stream/broken.zip')
+
+  def test_put_stream_upload_error(self, app):
+    written = []
+
+    def write(f):
+      # Much more than the stream holds, so the writer has to be stopped.
+      for _ in range(1000):
+        f.write(b'x' * 1024)
+        written.append(1024)
+
+    with app.app_context(), patch('minio.Minio.put_object',
+                                  side_effect=ConnectionError()):
+      with pytest.raises(ConnectionError):
+        object_storage.put_stream('stream/broken.zip', write,
+                                  'application/zip')
+
+    assert len(written) < 1000
+
+  def test_rename_dir_recursively(self, app):
+    with app.app_context():
+      for name in ('a.wav', 'b.wav', 'nested/c.jpg'):
+        object_storage.put_object(f'rename/old/{name}',
+                                  io.BytesIO(name.encode()), 'audio/wav')
+
+      actual = object_storage.rename_dir_recursively('rename/old',
+                                                     'rename/new')
+
+      assert not object_storage.path_exists('rename/old', recursive=True)
+      for name in ('a.wav', 'b.wav', 'nested/c.jpg'):
+        assert object_storage.get_object(
+            f'rename/new/{name}').read() == name.encode()
+
+    assert actual.files == 3
+    assert actual.bytes == 22
+
+  def test_rename_dir_recursively_copy_mismatch(self, app):
+    with app.app_context():
+      object_storage.put_object('rename/old/a.wav', io.BytesIO(b'a'),
+                                'audio/wav')
+
+      with patch('rainfall.object_storage._copy_verified') as mock_copy:
+        mock_copy.side_effect = object_storage.ObjectStorageException(
+            'mismatch')
+        with pytest.raises(object_storage.ObjectStorageException):
+          object_storage.rename_dir_recursively('rename/old', 'rename/new')
+
+      assert object_storage.get_object('rename/old/a.wav').read() == b'a'
+
+  def test_rmtree_batches(self, app):
+    with app.app_context(), patch.object(object_storage, 'DELETE_BATCH_SIZE',
+                                         2):
+      for i in range(5):
+        object_storage.put_object(f'rmtree/{i}.wav', io.BytesIO(b'a'),
+                                  'audio/wav')
+      object_storage.put_object('rmtree-other/a.wav', io.BytesIO(b'a'),
+                                'audio/wav')
+
+      with patch('rainfall.object_storage._remove_batch',
+                 wraps=object_storage._remove_batch) as mock_remove:
+        object_storage.rmtree('rmtree/')
+
+      assert mock_remove.call_count == 3
+      assert not object_storage.path_exists('rmtree/', recursive=True)
+      assert object_storage.object_exists('rmtree-other/a.wav')
+
+  def test_object_exists(self, app):
+    with app.app_context():
+      object_storage.put_object('exists/a.txt', io.BytesIO(b'a'), 'text/plain')
+
+      assert object_storage.object_exists('exists/a.txt')
+      assert not object_storage.object_exists('exists/a')
+      assert not object_storage.object_exists('exists')
+
+  def test_path_exists_prefix(self, app):
+    with app.app_context():
+      object_storage.put_object('exists/nested/a.txt', io.BytesIO(b'a'),
+                                'text/plain')
+
+      assert object_storage.path_exists('exists/nested/a.txt')
+      assert object_storage.path_exists('exists')
+      assert object_storage.path_exists('exists/nested', recursive=True)
+      assert not object_storage.path_exists('exists/other', recursive=True)
+
+  def test_path_exists_delimited_listing(self, app):
+    with app.app_context():
+      for i in range(3):
+        object_storage.put_object(f'delimited/a/b/{i}.txt', io.BytesIO(b'a'),
+                                  'text/plain')
+      client = object_storage.connect()
+
+      with patch.object(client, 'list_objects',
+                        wraps=client.list_objects) as mock_list:
+        assert object_storage.path_exists('delimited/a', recursive=True)
+        assert object_storage.path_exists('delimited/a/b/', recursive=True)
+
+      assert all(not c.kwargs['recursive'] for c in mock_list.call_args_list)
+
+  def test_exists_cached(self, app):
+    with app.app_context():
+      object_storage.put_object('exists/a.txt', io.BytesIO(b'a'), 'text/plain')
+      assert object_storage.object_exists('exists/a.txt')
+
+      with patch.object(object_storage.connect(), 'stat_object') as mock_stat:
+        assert object_storage.object_exists('exists/a.txt')
+        mock_stat.assert_not_called()
+
+  def test_exists_cache_invalidated(self, app):
+    with app.app_context():
+      assert not object_storage.object_exists('exists/a.txt')
+      assert not object_storage.path_exists('exists', recursive=True)
+
+      object_storage.put_object('exists/a.txt', io.BytesIO(b'a'), 'text/plain')
+      assert object_storage.object_exists('exists/a.txt')
+      assert object_storage.path_exists('exists', recursive=True)
+
+      object_storage.rmtree('exists')
+      assert not object_storage.object_exists('exists/a.txt')
+      assert not object_storage.path_exists('exists', recursive=True)
+
+  def test_download_files_keeps_mtime(self, app, tmp_path):
+    with app.app_context():
+      object_storage.put_object('download/a.wav', io.BytesIO(b'a'),
+                                'audio/wav')
+      stat = object_storage.connect().stat_object(app.config['MINIO_BUCKET'],
+                                                  'download/a.wav')
+
+      object_storage.download_files([('download/a.wav',
+                                      str(tmp_path / 'a.wav'))])
+
+    assert os.stat(tmp_path / 'a.wav').st_mtime == (
+        stat.last_modified.timestamp())
@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import flask
+
+log = logging.getLogger(__name__)
+
+# Stages of a build, in the order they run. Every build ends with one of
+# FINAL_STAGES.
+STAGES = ('download', 'eno', 'faircamp', 'publish', 'zip')
+FINAL_STAGES = ('done', 'failed')
+
+# How long the last event of a site is kept for clients that connect late.
+LAST_EVENT_TTL = 60 * 60
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def channel(site_id):
+  return f'rainfall:build-progress:{site_id}'
+
+
+def last_event_key(site_id):
+  return f'rainfall:build-progress:{site_id}:last'
+
+
+def connect(app=None):
+  '''
+  Returns this process's Redis client for REDIS_URL, or None if REDIS_URL is
+  not set (progress events are disabled).
+  '''
+  app = app or flask.current_app
+  url = app.config['REDIS_URL']
+  if not url:
+    return None
+
+  # Imported here, so that the app runs without redis while REDIS_URL is
+  # unset.
+  import redis
+
+  key = (url, os.getpid())
+  with _clients_lock:
+    client = _clients.get(key)
+    if client is None:
+      client = redis.Redis.from_url(url, socket_connect_timeout=2)
+      _clients[key] = client
+  return client
+
+
+class BuildProgress:
+  '''
+  Publishes the progress events of one build of a site, on the site's
+  channel. Each event is also stored as the site's last event. Events are
+  best effort, an unreachable Redis never fails the build.
+  '''
+
+  def __init__(self, site_id, task_id):
+    self.site_id = site_id
+    self.task_id = task_id
+    self.client = connect()
+
+  def publish(self, stage, progress=None, message=None):
+    if self.client is None:
+      return
+    event = json.dumps({
+        'task_id': self.task_id,
+        'stage': stage,
+        'progress': progress,
+        'message': message,
+    })
+    import redis
+
+    try:
+      pipe = self.client.pipeline()
+      pipe.set(last_event_key(self.site_id), event, ex=LAST_EVENT_TTL)
+      pipe.publish(channel(self.site_id), event)
+      pipe.execute()
+    except redis.RedisError:
+      log.warning('Could not publish build progress of site %s',
+                  self.site_id,
+                  exc_info=True)
+      # Don't wait for Redis again for the rest of the build.
+      self.client = None
+
+
+def format_event(event):
+  return f'data: {json.dumps(event)}\n\n'
+
+
+def _ends(event, task_id):
+  return event['stage'] in FINAL_STAGES and (task_id is None or
+                                             event['task_id'] == task_id)
+
+
+def stream(client, site_id, task_id, poll_status, heartbeat_seconds,
+           max_seconds):
+  '''
+  Yields the progress events of site_id as server-sent events, until a final
+  event of the build task_id (of any build if it's None), or for at most
+  max_seconds, after which the browser reconnects.
+
+  Events can be lost (the worker died, or Redis was unreachable), so every
+  heartbeat_seconds poll_status() is called to get a final event for task_id
+  from its result, or None while it hasn't finished.
+  '''
+  pubsub = client.pubsub(ignore_subscribe_messages=True)
+  pubsub.subscribe(channel(site_id))
+  try:
+    yield 'retry: 1000\n\n'
+    # Subscribed first, so that no event is missed in between.
+    last = client.get(last_event_key(site_id))
+    if last is not None:
+      event = json.loads(last)
+      yield format_event(event)
+      if _ends(event, task_id):
+        return
+
+    end = time.monotonic() + max_seconds
+    heartbeat = time.monotonic()
+    while time.monotonic() < end:
+      message = pubsub.get_message(
+          timeout=max(min(heartbeat, end) - time.monotonic(), 0))
+      if message is not None:
+        event = json.loads(message['data'])
+        yield format_event(event)
+        if _ends(event, task_id):
+          return
+      elif time.monotonic() >= heartbeat:
+        event = poll_status()
+        if event is not None:
+          yield format_event(event)
+          return
+        yield ': heartbeat\n\n'
+        heartbeat = time.monotonic() + heartbeat_seconds
+  finally:
+    pubsub.close()
@@ -0,0 +1,116 @@
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from rainfall import progress
+
+# redis is only imported when REDIS_URL is set.
+redis = pytest.importorskip('redis')
+
+
+def message(event):
+  return {'type': 'message', 'data': json.dumps(event).encode('utf-8')}
+
+
+def event(stage, task_id='task-1'):
+  return {
+      'task_id': task_id,
+      'stage': stage,
+      'progress': None,
+      'message': None
+  }
+
+
+class ProgressTest:
+
+  def test_connect_disabled(self, app):
+    app.config['REDIS_URL'] = None
+    with app.app_context():
+      assert progress.connect() is None
+
+  def test_connect_reuses_client(self, app):
+    with app.app_context():
+      assert progress.connect() is progress.connect()
+
+  @patch('rainfall.progress.connect')
+  def test_publish(self, mock_connect, app):
+    client = mock_connect.return_value
+    with app.app_context():
+      progress.BuildProgress('site-1', 'task-1').publish('faircamp',
+                                                         progress=0.5,
+                                                         message='a.wav')
+
+    pipe = client.pipeline.return_value
+    expected = {
+        'task_id': 'task-1',
+        'stage': 'faircamp',
+        'progress': 0.5,
+        'message': 'a.wav'
+    }
+    key, data = pipe.set.call_args.args
+    assert key == progress.last_event_key('site-1')
+    assert json.loads(data) == expected
+    channel, data = pipe.publish.call_args.args
+    assert channel == progress.channel('site-1')
+    assert json.loads(data) == expected
+    pipe.execute.assert_called_once()
+
+  @patch('rainfall.progress.connect')
+  def test_publish_redis_error(self, mock_connect, app):
+    client = mock_connect.return_value
+    client.pipeline.return_value.execute.side_effect = redis.ConnectionError()
+    with app.app_context():
+      events = progress.BuildProgress('site-1', 'task-1')
+      events.publish('download')
+      events.publish('eno')
+
+    client.pipeline.assert_called_once()
+
+  def test_stream_last_event_final(self):
+    client = MagicMock()
+    client.get.return_value = json.dumps(event('done'))
+
+    actual = list(
+        progress.stream(client, 'site-1', 'task-1', lambda: None, 10, 10))
+
+    assert actual[1:] == [progress.format_event(event('done'))]
+    client.pubsub.return_value.get_message.assert_not_called()
+    client.pubsub.return_value.close.assert_called_once()
+
+  def test_stream_until_final(self):
+    client = MagicMock()
+    client.get.return_value = json.dumps(event('done', task_id='task-0'))
+    client.pubsub.return_value.get_message.side_effect = [
+        message(event('faircamp')),
+        message(event('done')),
+    ]
+
+    actual = list(
+        progress.stream(client, 'site-1', 'task-1', lambda: None, 10, 10))
+
+    assert actual[1:] == [
+        progress.format_event(event('done', task_id='task-0')),
+        progress.format_event(event('faircamp')),
+        progress.format_event(event('done')),
+    ]
+
+  def test_stream_poll_status(self):
+    client = MagicMock()
+    client.get.return_value = None
+    client.pubsub.return_value.get_message.return_value = None
+
+    actual = list(
+        progress.stream(client, 'site-1', 'task-1', lambda: event('failed'),
+                        10, 10))
+
+    assert actual[1:] == [progress.format_event(event('failed'))]
+
+  def test_stream_max_seconds(self):
+    client = MagicMock()
+    client.get.return_value = None
+
+    actual = list(
+        progress.stream(client, 'site-1', 'task-1', lambda: None, 10, 0))
+
+    assert actual == ['retry: 1000\n\n']
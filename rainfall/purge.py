@@ -0,0 +1,66 @@
+import logging
+from datetime import timedelta
+from uuid import UUID
+
+import flask
+from sqlalchemy import select
+
+from rainfall import object_storage
+from rainfall.db import db, utcnow
+from rainfall.models.object_purge import ObjectPurge
+
+log = logging.getLogger(__name__)
+
+PURGE_TASK_NAME = 'rainfall.main.purge_objects_async'
+# Tombstones this old have run out of retries or were never enqueued, so the
+# next successful purge enqueues them again.
+STALE_PURGE_AGE = timedelta(hours=1)
+STALE_PURGE_BATCH = 10
+
+
+def schedule_purge(prefix):
+  '''
+  Adds a tombstone for prefix to the session. Pass its id to enqueue_purge
+  once the session has been committed.
+  '''
+  purge = ObjectPurge(prefix=prefix, attempts=0)
+  db.session.add(purge)
+  return purge
+
+
+def enqueue_purge(purge_id):
+  try:
+    flask.current_app.extensions['celery'].send_task(PURGE_TASK_NAME,
+                                                     args=[str(purge_id)])
+  except Exception:
+    # The tombstone remains, so a later purge picks it up.
+    log.exception('Could not enqueue object purge id=%s', purge_id)
+
+
+def purge_objects(purge_id):
+  '''
+  Deletes every object under the prefix of the given tombstone, then the
+  tombstone itself. Raises if any object could not be deleted.
+  '''
+  purge = db.session.get(ObjectPurge, UUID(purge_id))
+  if purge is None:
+    # Already purged by an earlier run.
+    return
+
+  purge.attempts += 1
+  try:
+    object_storage.rmtree(purge.prefix)
+  except Exception as e:
+    purge.last_error = str(e)
+    db.session.commit()
+    raise
+
+  log.info('Purged %s after %s attempt(s)', purge.prefix, purge.attempts)
+  db.session.delete(purge)
+  db.session.commit()
+
+  stmt = select(ObjectPurge).where(
+      ObjectPurge.created_at < utcnow() - STALE_PURGE_AGE).order_by(
+          ObjectPurge.created_at).limit(STALE_PURGE_BATCH)
+  for stale in db.session.scalars(stmt):
+    enqueue_purge(stale.id)
@@ -0,0 +1,78 @@
+import io
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+
+from rainfall import object_storage
+from rainfall.db import db, utcnow
+from rainfall.models.object_purge import ObjectPurge
+from rainfall.purge import (PURGE_TASK_NAME, enqueue_purge, purge_objects,
+                            schedule_purge)
+
+
+class PurgeTest:
+
+  def test_purge_objects(self, app):
+    with app.app_context():
+      for name in ('a.wav', 'nested/b.jpg'):
+        object_storage.put_object(f'purge/site/{name}', io.BytesIO(b'x'),
+                                  'audio/wav')
+      object_storage.put_object('purge/other/c.wav', io.BytesIO(b'x'),
+                                'audio/wav')
+      purge = schedule_purge('purge/site')
+      db.session.commit()
+
+      purge_objects(str(purge.id))
+
+      assert not object_storage.path_exists('purge/site', recursive=True)
+      assert object_storage.object_exists('purge/other/c.wav')
+      assert db.session.get(ObjectPurge, purge.id) is None
+
+  def test_purge_objects_already_purged(self, app):
+    with app.app_context():
+      purge = schedule_purge('purge/site')
+      db.session.commit()
+
+      purge_objects(str(purge.id))
+      purge_objects(str(purge.id))
+
+  @patch('rainfall.purge.object_storage.rmtree')
+  def test_purge_objects_error(self, mock_rmtree, app):
+    mock_rmtree.side_effect = object_storage.ObjectDeleteException('Nope')
+    with app.app_context():
+      purge = schedule_purge('purge/site')
+      db.session.commit()
+
+      with pytest.raises(object_storage.ObjectDeleteException):
+        purge_objects(str(purge.id))
+
+      db.session.refresh(purge)
+      assert purge.attempts == 1
+      assert purge.last_error == 'Nope'
+
+  @patch('rainfall.purge.enqueue_purge')
+  def test_purge_objects_enqueues_stale(self, mock_enqueue, app):
+    with app.app_context():
+      stale = schedule_purge('purge/stale')
+      stale.created_at = utcnow() - timedelta(days=1)
+      recent = schedule_purge('purge/recent')
+      purge = schedule_purge('purge/site')
+      db.session.commit()
+
+      purge_objects(str(purge.id))
+
+      # The recent tombstone may still be handled by its own task.
+      mock_enqueue.assert_called_once_with(stale.id)
+      assert recent.id not in [c.args[0] for c in mock_enqueue.call_args_list]
+
+  def test_enqueue_purge(self, app):
+    with app.app_context(), patch.object(app.extensions['celery'],
+                                         'send_task') as mock_send:
+      purge = schedule_purge('purge/site')
+      db.session.commit()
+
+      enqueue_purge(purge.id)
+
+      mock_send.assert_called_once_with(PURGE_TASK_NAME, args=[str(purge.id)])
+      assert PURGE_TASK_NAME in app.extensions['celery'].tasks
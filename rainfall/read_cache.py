@@ -0,0 +1,196 @@
+import io
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class ReadCache:
+  '''
+  A read-through cache of object contents for the web process, keyed by
+  object name and ETag so a changed object is never served stale.
+
+  Small objects are kept in memory, larger ones in files under root. Each tier
+  evicts its least recently used entries once it holds more than its byte
+  budget. Objects too large for the disk tier are not cached.
+  '''
+
+  def __init__(self, root, memory_bytes, memory_object_max, disk_bytes,
+               disk_object_max):
+    self.root = root
+    self.memory_bytes = memory_bytes
+    self.memory_object_max = memory_object_max if memory_bytes else -1
+    self.disk_bytes = disk_bytes
+    self.disk_object_max = min(disk_object_max,
+                               disk_bytes) if disk_bytes else -1
+    self._lock = threading.Lock()
+    # (name, etag) -> bytes
+    self._memory = OrderedDict()
+    self._memory_used = 0
+    # (name, etag) -> (path, size)
+    self._disk = OrderedDict()
+    self._disk_used = 0
+    self._counters = {
+        'memory_hits': 0,
+        'disk_hits': 0,
+        'misses': 0,
+        'uncacheable': 0,
+        'memory_evictions': 0,
+        'disk_evictions': 0,
+    }
+
+    if self.disk_bytes:
+      # Entries of a previous process are not indexed, so start empty.
+      shutil.rmtree(self.root, ignore_errors=True)
+      os.makedirs(self.root, exist_ok=True)
+
+  def open(self, name, etag, size, fetch):
+    '''
+    Returns a readable binary file with the contents of the object name at
+    the given ETag, or None if the object is too large to cache. On a miss,
+    fetch(f) is called to write the object to the binary file f. The caller
+    must close the returned file.
+    '''
+    key = (name, etag)
+    with self._lock:
+      data = self._memory.get(key)
+      if data is not None:
+        self._memory.move_to_end(key)
+        self._counters['memory_hits'] += 1
+        return io.BytesIO(data)
+      entry = self._disk.get(key)
+      if entry is not None:
+        try:
+          f = open(entry[0], 'rb')
+        except FileNotFoundError:
+          self._disk.pop(key)
+          self._disk_used -= entry[1]
+        else:
+          self._disk.move_to_end(key)
+          self._counters['disk_hits'] += 1
+          return f
+
+    if size <= self.memory_object_max:
+      with self._lock:
+        self._counters['misses'] += 1
+      buf = io.BytesIO()
+      fetch(buf)
+      data = buf.getvalue()
+      self._add_memory(key, data)
+      return io.BytesIO(data)
+
+    if size <= self.disk_object_max:
+      with self._lock:
+        self._counters['misses'] += 1
+      os.makedirs(self.root, exist_ok=True)
+      path = os.path.join(self.root, uuid.uuid4().hex)
+      try:
+        with open(path, 'wb') as f:
+          fetch(f)
+        actual_size = os.path.getsize(path)
+        f = open(path, 'rb')
+      except BaseException:
+        if os.path.exists(path):
+          os.remove(path)
+        raise
+      self._add_disk(key, path, actual_size)
+      return f
+
+    with self._lock:
+      self._counters['uncacheable'] += 1
+    return None
+
+  def _add_memory(self, key, data):
+    with self._lock:
+      if key in self._memory:
+        return
+      self._memory[key] = data
+      self._memory_used += len(data)
+      while self._memory_used > self.memory_bytes and self._memory:
+        _, evicted = self._memory.popitem(last=False)
+        self._memory_used -= len(evicted)
+        self._counters['memory_evictions'] += 1
+
+  def _add_disk(self, key, path, size):
+    evicted_paths = []
+    with self._lock:
+      if key in self._disk:
+        evicted_paths.append(path)
+      else:
+        self._disk[key] = (path, size)
+        self._disk_used += size
+      while self._disk_used > self.disk_bytes and self._disk:
+        _, (evicted_path, evicted_size) = self._disk.popitem(last=False)
+        self._disk_used -= evicted_size
+        self._counters['disk_evictions'] += 1
+        evicted_paths.append(evicted_path)
+
+    # Open files keep working after the unlink on POSIX.
+    for evicted_path in evicted_paths:
+      try:
+        os.remove(evicted_path)
+      except FileNotFoundError:
+        pass
+
+  def stats(self):
+    with self._lock:
+      return {
+          **self._counters,
+          'memory_entries': len(self._memory),
+          'memory_used': self._memory_used,
+          'memory_bytes': self.memory_bytes,
+          'disk_entries': len(self._disk),
+          'disk_used': self._disk_used,
+          'disk_bytes': self.disk_bytes,
+      }
+
+
+def get_cache(root, memory_bytes, memory_object_max, disk_bytes,
+              disk_object_max):
+  '''
+  Returns this process's ReadCache, or None if both tiers are disabled. Each
+  process gets its own directory under root.
+  '''
+  if not memory_bytes and not disk_bytes:
+    return None
+
+  pid = os.getpid()
+  settings = (memory_bytes, memory_object_max, disk_bytes, disk_object_max)
+  with _caches_lock:
+    cached = _caches.get((root, pid))
+    if cached is None or cached[0] != settings:
+      if cached is None and disk_bytes:
+        _remove_dead_process_dirs(root)
+      cache = ReadCache(os.path.join(root, str(pid)), *settings)
+      _caches[(root, pid)] = (settings, cache)
+      return cache
+    return cached[1]
+
+
+def _remove_dead_process_dirs(root):
+  if not os.path.isdir(root):
+    return
+  with os.scandir(root) as entries:
+    for entry in entries:
+      if not entry.name.isdigit():
+        continue
+      try:
+        os.kill(int(entry.name), 0)
+      except ProcessLookupError:
+        shutil.rmtree(entry.path, ignore_errors=True)
+      except PermissionError:
+        # Alive, but owned by someone else.
+        pass
+
+
+def stats():
+  '''Returns the stats of each cache in this process, by directory.'''
+  pid = os.getpid()
+  with _caches_lock:
+    caches = [cache for (_, cache_pid), (_, cache) in _caches.items()
+              if cache_pid == pid]
+  return {cache.root: cache.stats() for cache in caches}
@@ -0,0 +1,107 @@
+import os
+
+from rainfall import read_cache
+from rainfall.read_cache import ReadCache
+
+
+def write_fetch(data, calls=None):
+
+  def fetch(f):
+    if calls is not None:
+      calls.append(data)
+    f.write(data)
+
+  return fetch
+
+
+def new_cache(tmp_path, memory_bytes=16, memory_object_max=4, disk_bytes=32,
+              disk_object_max=16):
+  return ReadCache(str(tmp_path / 'cache'), memory_bytes, memory_object_max,
+                   disk_bytes, disk_object_max)
+
+
+class ReadCacheTest:
+
+  def test_memory_miss_then_hit(self, tmp_path):
+    cache = new_cache(tmp_path)
+    calls = []
+
+    with cache.open('a.css', 'etag1', 3, write_fetch(b'abc', calls)) as f:
+      assert f.read() == b'abc'
+    with cache.open('a.css', 'etag1', 3, write_fetch(b'xyz', calls)) as f:
+      assert f.read() == b'abc'
+
+    assert calls == [b'abc']
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['memory_hits'] == 1
+    assert cache.stats()['memory_entries'] == 1
+    assert os.listdir(tmp_path / 'cache') == []
+
+  def test_disk_miss_then_hit(self, tmp_path):
+    cache = new_cache(tmp_path)
+    calls = []
+
+    with cache.open('a.jpg', 'etag1', 10, write_fetch(b'0123456789',
+                                                      calls)) as f:
+      assert f.read() == b'0123456789'
+    with cache.open('a.jpg', 'etag1', 10, write_fetch(b'x', calls)) as f:
+      assert f.read() == b'0123456789'
+
+    assert len(calls) == 1
+    assert cache.stats()['disk_hits'] == 1
+    assert cache.stats()['disk_used'] == 10
+    assert len(os.listdir(tmp_path / 'cache')) == 1
+
+  def test_new_etag_misses(self, tmp_path):
+    cache = new_cache(tmp_path)
+    cache.open('a.css', 'etag1', 3, write_fetch(b'old')).close()
+
+    with cache.open('a.css', 'etag2', 3, write_fetch(b'new')) as f:
+      assert f.read() == b'new'
+    assert cache.stats()['misses'] == 2
+
+  def test_too_large(self, tmp_path):
+    cache = new_cache(tmp_path)
+
+    assert cache.open('a.mp3', 'etag1', 17, write_fetch(b'x' * 17)) is None
+    assert cache.stats()['uncacheable'] == 1
+
+  def test_memory_eviction(self, tmp_path):
+    cache = new_cache(tmp_path, memory_bytes=8)
+    cache.open('a', 'etag', 4, write_fetch(b'aaaa')).close()
+    cache.open('b', 'etag', 4, write_fetch(b'bbbb')).close()
+    # Touch a so that b is the least recently used.
+    cache.open('a', 'etag', 4, write_fetch(b'aaaa')).close()
+    cache.open('c', 'etag', 4, write_fetch(b'cccc')).close()
+
+    calls = []
+    cache.open('a', 'etag', 4, write_fetch(b'aaaa', calls)).close()
+    cache.open('b', 'etag', 4, write_fetch(b'bbbb', calls)).close()
+
+    assert calls == [b'bbbb']
+    assert cache.stats()['memory_evictions'] == 2
+    assert cache.stats()['memory_used'] <= 8
+
+  def test_disk_eviction(self, tmp_path):
+    cache = new_cache(tmp_path, disk_bytes=20)
+    cache.open('a', 'etag', 10, write_fetch(b'a' * 10)).close()
+    cache.open('b', 'etag', 10, write_fetch(b'b' * 10)).close()
+    cache.open('c', 'etag', 10, write_fetch(b'c' * 10)).close()
+
+    assert cache.stats()['disk_evictions'] == 1
+    assert cache.stats()['disk_used'] == 20
+    assert len(os.listdir(tmp_path / 'cache')) == 2
+
+  def test_disabled_tiers(self, tmp_path):
+    cache = new_cache(tmp_path, memory_bytes=0, disk_bytes=0)
+
+    assert cache.open('a', 'etag', 0, write_fetch(b'')) is None
+
+  def test_get_cache(self, tmp_path):
+    root = str(tmp_path / 'caches')
+    cache = read_cache.get_cache(root, 16, 4, 32, 16)
+
+    assert read_cache.get_cache(root, 16, 4, 32, 16) is cache
+    assert cache.root == os.path.join(root, str(os.getpid()))
+    assert read_cache.get_cache(root, 0, 4, 0, 16) is None
+    assert root + os.sep + str(os.getpid()) in read_cache.stats()
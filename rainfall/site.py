@@ -1,16 +1,29 @@
+import hashlib
 import io
+import json
 import logging
 import os
 import re
 import shutil
+import signal
 import subprocess
+import threading
+import time
 import unicodedata
+import zipfile
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
 from uuid import UUID
 
 import flask
+from sqlalchemy import delete, or_, select, update
 
-from rainfall import object_storage
-from rainfall.db import db
+from rainfall import (object_cache, object_storage, progress, read_cache,
+                      transcode_cache, workspace, zip_stream)
+from rainfall.db import db, utcnow
+from rainfall.models.build_run import BuildRun
 from rainfall.models.site import Site
 
 log = logging.getLogger(__name__)
@@ -32,12 +45,6 @@ def secure_filename(filename):
   return filename
 
 
-def catalog_dir(data_dir_path, site_id):
-  site = db.session.get(Site, UUID(site_id))
-  return os.path.join(data_dir_path, str(site.user.id),
-                      secure_filename(site.name))
-
-
 def build_dir(preview_dir_path, site_id):
   site = db.session.get(Site, UUID(site_id))
   return os.path.join(preview_dir_path, str(site.user.id),
@@ -48,12 +55,6 @@ def public_dir(site):
   return os.path.join(str(site.user.id), secure_filename(site.name), 'public')
 
 
-def cache_dir(preview_dir_path, site_id):
-  site = db.session.get(Site, UUID(site_id))
-  return os.path.join(preview_dir_path, str(site.user.id),
-                      secure_filename(site.name), 'cache')
-
-
 def site_path(data_dir_path, site, override_name=None):
   name = override_name if override_name else site.name
   return os.path.join(data_dir_path, str(site.user.id), secure_filename(name))
@@ -69,82 +70,744 @@ def file_path(data_dir_path, file):
   return os.path.join(release_path(data_dir_path, file.release), file.filename)
 
 
+# A build's catalog has a directory for each release, named like it.
+def catalog_release_path(catalog_path, release):
+  return os.path.join(catalog_path, secure_filename(release.name))
+
+
+def catalog_file_path(catalog_path, file):
+  return os.path.join(catalog_release_path(catalog_path, file.release),
+                      file.filename)
+
+
+# Source objects (songs and artwork) are stored under immutable ids, so that
+# renaming a site or release never touches object storage. The human readable
+# paths above are only used for the local catalog that faircamp builds from.
+def site_object_path(data_dir_path, site):
+  return os.path.join(data_dir_path, str(site.user.id), str(site.id))
+
+
+def release_object_path(data_dir_path, release):
+  return os.path.join(site_object_path(data_dir_path, release.site),
+                      str(release.id))
+
+
+def file_object_path(data_dir_path, file):
+  return os.path.join(release_object_path(data_dir_path, file.release),
+                      str(file.id))
+
+
+def site_preview_prefixes(preview_dir_path, site):
+  '''
+  Returns the prefixes of the objects made by builds of the site: the
+  preview with its manifest and zip, and the saved faircamp cache. The
+  trailing slashes keep them from matching a site whose name starts with
+  this one's.
+  '''
+  return [
+      os.path.join(preview_dir_path, str(site.user.id),
+                   secure_filename(site.name), ''),
+      os.path.join(preview_dir_path, str(site.user.id), str(site.id), ''),
+  ]
+
+
 def site_exists(preview_dir_path, site_id):
   dir_ = build_dir(preview_dir_path, site_id)
   return object_storage.path_exists(dir_, recursive=True)
 
 
-def download_site_objects(data_dir_path, site_id):
+def source_cache():
+  config = flask.current_app.config
+  return object_cache.get_cache(config['SOURCE_CACHE_DIR'],
+                                config['SOURCE_CACHE_MAX_BYTES'])
+
+
+def preview_cache():
+  config = flask.current_app.config
+  return read_cache.get_cache(config['PREVIEW_CACHE_DIR'],
+                              config['PREVIEW_CACHE_MEMORY_BYTES'],
+                              config['PREVIEW_CACHE_MEMORY_OBJECT_MAX'],
+                              config['PREVIEW_CACHE_DISK_BYTES'],
+                              config['PREVIEW_CACHE_DISK_OBJECT_MAX'])
+
+
+def download_site_objects(data_dir_path, site_id, catalog_path):
+  '''
+  Downloads the songs and artwork of the site into the local catalog
+  directory catalog_path.
+  '''
   site = db.session.get(Site, UUID(site_id))
+  files = []
   for release in site.releases:
-    for file in release.files:
-      path = file_path(data_dir_path, file)
-      # The first path is in the object storage, the second is the local path.
-      object_storage.download_file(path=path, output_path=path)
-
+    files.extend(release.files)
     if release.artwork:
-      path = file_path(data_dir_path, release.artwork)
-      object_storage.download_file(path=path, output_path=path)
+      files.append(release.artwork)
+
+  # The first path is in the object storage, the second is the local path.
+  paths = [(file_object_path(data_dir_path, file),
+            catalog_file_path(catalog_path, file)) for file in files]
+  # Downloads keep the objects' mtimes, which faircamp checks before reusing
+  # its cached transcodes.
+  stats = object_storage.download_files(paths, cache=source_cache())
+  log.info('Downloaded %s files (%s bytes, %s cached) for site %s in %.2fs',
+           stats.files, stats.bytes, stats.cached, site_id, stats.seconds)
+  return stats
+
+
+def manifest_object_path(preview_dir_path, site_id):
+  return os.path.join(zip_file_path(preview_dir_path, site_id),
+                      'manifest.json')
+
+
+def _manifest_entry(path, size):
+  digest = hashlib.sha256()
+  crc = 0
+  with open(path, 'rb') as f:
+    while chunk := f.read(1024 * 1024):
+      digest.update(chunk)
+      crc = zlib.crc32(chunk, crc)
+  return {
+      'sha256': digest.hexdigest(),
+      'size': size,
+      # Lets zips of the published files be laid out without reading them.
+      'crc32': crc,
+      'mtime': int(os.path.getmtime(path)),
+  }
+
+
+def build_manifest(path):
+  '''
+  Returns {relative path: {'sha256': ..., 'size': ..., 'crc32': ...,
+  'mtime': ...}} for every file under the local directory path.
+  '''
+  return {
+      rel_path: _manifest_entry(local_path, size)
+      for local_path, rel_path, size in object_storage.walk_files(path, '')
+  }
+
+
+def _same_contents(old_entry, entry):
+  return old_entry is not None and (old_entry['sha256'], old_entry['size']) == (
+      entry['sha256'], entry['size'])
+
+
+def _load_json_object(path):
+  if not object_storage.object_exists(path):
+    return None
+  obj = object_storage.get_object(path)
+  try:
+    return json.loads(obj.read())
+  except ValueError:
+    log.warning('Ignoring unreadable manifest %s', path)
+    return None
+  finally:
+    obj.close()
 
 
-def upload_site_objects(preview_dir_path, site_id):
-  path = build_dir(preview_dir_path, site_id)
-  # The first path is the local path, the second is in object storage.
-  object_storage.upload_dir_recursively(path=path, output_path=path)
+def _put_json_object(path, data):
+  object_storage.put_object(
+      path, io.BytesIO(json.dumps(data, sort_keys=True).encode('utf-8')),
+      'application/json')
 
 
-def generate_eno_files(data_dir_path, site_id):
+def _sync_dir(path, output_path, old_manifest):
+  '''
+  Makes output_path in object storage match the local directory path, given
+  the manifest it was last synced with. Only new and changed files are
+  uploaded. Returns the new manifest, the upload TransferStats and the number
+  of objects removed.
+  '''
+  manifest = build_manifest(path)
+  # The first path is the local path, the second is in object storage.
+  changed = [(os.path.join(path, rel_path), os.path.join(output_path,
+                                                         rel_path),
+              entry['size'])
+             for rel_path, entry in manifest.items()
+             if not _same_contents(old_manifest.get(rel_path), entry)]
+  removed = [
+      os.path.join(output_path, rel_path)
+      for rel_path in old_manifest
+      if rel_path not in manifest
+  ]
+
+  stats = object_storage.upload_files(changed)
+  object_storage.remove_objects(removed)
+  return manifest, stats, len(removed)
+
+
+def load_manifest(preview_dir_path, site_id):
+  '''
+  Returns the manifest of the last published build, or None if there is none
+  (or it can't be read), in which case everything must be published.
+  '''
+  return _load_json_object(manifest_object_path(preview_dir_path, site_id))
+
+
+def upload_site_objects(preview_dir_path, site_id, local_path):
+  '''
+  Publishes the local build dir local_path to the site's build dir, uploading
+  only the files that are new or changed since the last published manifest
+  and deleting the ones that are gone. The manifest is written last, so an
+  interrupted publish is redone next time.
+  '''
+  old_manifest = load_manifest(preview_dir_path, site_id) or {}
+  manifest, stats, removed = _sync_dir(local_path,
+                                       build_dir(preview_dir_path, site_id),
+                                       old_manifest)
+  _put_json_object(manifest_object_path(preview_dir_path, site_id), manifest)
+
+  log.info(
+      'Published %s of %s files (%s bytes), removed %s for site %s in %.2fs '
+      '(%.0f B/s)', stats.files, len(manifest), stats.bytes, removed,
+      site_id, stats.seconds, stats.bytes_per_second)
+  return stats
+
+
+_UNKNOWN = object()
+_faircamp_version = _UNKNOWN
+
+
+def faircamp_version():
+  '''
+  Returns FAIRCAMP_VERSION, or what `faircamp --version` reports. None if
+  faircamp can't be run. Either way, faircamp is only run once per process.
+  '''
+  global _faircamp_version
+  configured = flask.current_app.config['FAIRCAMP_VERSION']
+  if configured:
+    return configured
+
+  if _faircamp_version is _UNKNOWN:
+    try:
+      output = subprocess.run(['faircamp', '--version'],
+                              capture_output=True,
+                              check=True,
+                              text=True)
+    except (OSError, subprocess.CalledProcessError):
+      log.warning('Could not determine the faircamp version')
+      _faircamp_version = None
+    else:
+      _faircamp_version = output.stdout.strip()
+  return _faircamp_version
+
+
+# The files of faircamp's cache (mostly transcoded audio) are stored once per
+# installation by content hash, see transcode_cache. Each site id has a
+# manifest of which file goes where in its cache dir, so the cache survives
+# renames, and a track used by several sites is only stored once.
+#
+# A track is still transcoded once per site, not once per installation.
+# faircamp finds transcodes through its own cache index, which is keyed by
+# the source file's catalog path and is neither documented nor stable
+# across faircamp versions, so a new site's cache isn't seeded with other
+# sites' transcodes of the same source.
+def faircamp_cache_manifest_path(preview_dir_path, site_id):
+  site = db.session.get(Site, UUID(site_id))
+  return os.path.join(preview_dir_path, str(site.user.id), str(site.id),
+                      'faircamp-cache.json')
+
+
+def restore_faircamp_cache(preview_dir_path, site_id, local_path):
+  '''
+  Downloads the site's saved faircamp cache to the local cache dir
+  local_path. A cache saved by a different faircamp version is dropped
+  instead. Returns the files of the restored cache's manifest, to pass to
+  save_faircamp_cache.
+  '''
+  manifest_path = faircamp_cache_manifest_path(preview_dir_path, site_id)
+  manifest = _load_json_object(manifest_path)
+  if manifest is None:
+    return {}
+
+  version = faircamp_version()
+  if version is None or manifest.get('faircamp_version') != version:
+    # The blobs are evicted once nothing uses them anymore.
+    log.info('Discarding faircamp cache of site %s made by %s', site_id,
+             manifest.get('faircamp_version'))
+    object_storage.remove_object(manifest_path)
+    return {}
+
+  files = manifest['files']
+  stats = transcode_cache.fetch(preview_dir_path, files, local_path)
+  if stats is None:
+    log.info('Parts of the faircamp cache of site %s were evicted', site_id)
+    return {}
+  log.info('Restored faircamp cache of site %s, %s files (%s bytes) in %.2fs',
+           site_id, stats.files, stats.bytes, stats.seconds)
+  return files
+
+
+def save_faircamp_cache(preview_dir_path, site_id, local_path, old_files):
+  '''
+  Saves the local faircamp cache dir local_path as the site's cache,
+  uploading only the files that aren't stored for any site yet.
+  '''
+  if not os.path.isdir(local_path):
+    return
+  version = faircamp_version()
+  if version is None:
+    return
+
+  files = build_manifest(local_path)
+  stats, deduplicated = transcode_cache.store(
+      preview_dir_path, files, local_path,
+      {entry['sha256'] for entry in old_files.values()})
+  _put_json_object(faircamp_cache_manifest_path(preview_dir_path, site_id), {
+      'faircamp_version': version,
+      'files': files
+  })
+  evicted = transcode_cache.evict(preview_dir_path)
+  log.info(
+      'Saved faircamp cache of site %s, %s files, %s already stored by other '
+      'builds, %s uploaded (%s bytes) in %.2fs, %s evicted', site_id,
+      len(files), deduplicated, stats.files, stats.bytes, stats.seconds, evicted)
+
+
+def render_release_eno(release):
+  return flask.render_template(
+      'release.eno.jinja2',
+      cover_filename=release.artwork.filename if release.artwork else None,
+      cover_alt_text='no alt text given' if release.artwork else None,
+      description=release.description,
+      title=release.name,
+  )
+
+
+def generate_eno_files(site_id, catalog_path):
   site = db.session.get(Site, UUID(site_id))
   for release in site.releases:
     if release.empty():
       continue
 
-    release_eno = flask.render_template(
-        'release.eno.jinja2',
-        cover_filename=release.artwork.filename if release.artwork else None,
-        cover_alt_text='no alt text given' if release.artwork else None,
-        description=release.description,
-        title=release.name,
-    )
-
-    path = release_path(data_dir_path, release)
+    release_eno = render_release_eno(release)
+    path = catalog_release_path(catalog_path, release)
     os.makedirs(path, exist_ok=True)
     eno_path = os.path.join(path, 'release.eno')
     with open(eno_path, 'w', encoding='utf-8') as f:
       f.write(release_eno)
 
 
-def cleanup_site(data_dir_path, preview_dir_path, site_id):
+def site_fingerprint(data_dir_path, site_id):
+  '''
+  Returns a hash of everything a build of the site depends on: the site's
+  name, every release's rendered release.eno, the ids, names and ETags of
+  the songs and artwork, and the faircamp version.
+  '''
   site = db.session.get(Site, UUID(site_id))
-  # Delete local cache of data dir, and local cache of preview dir.
-  shutil.rmtree(site_path(data_dir_path, site), ignore_errors=True)
-  shutil.rmtree(site_path(preview_dir_path, site), ignore_errors=True)
+  releases = sorted(site.releases, key=lambda release: release.id)
+  files = [file for release in releases for file in release.files]
+  files.extend(release.artwork for release in releases if release.artwork)
+  etags = object_storage.object_etags(
+      file_object_path(data_dir_path, file) for file in files)
+
+  def describe(file):
+    return [
+        str(file.id), file.filename,
+        etags[file_object_path(data_dir_path, file)]
+    ]
 
+  inputs = {
+      'faircamp_version':
+          faircamp_version(),
+      'site': [str(site.id), site.name],
+      'releases': [{
+          'id': str(release.id),
+          'eno': render_release_eno(release),
+          'artwork': describe(release.artwork) if release.artwork else None,
+          'files': sorted(describe(file) for file in release.files),
+      } for release in releases],
+  }
+  return hashlib.sha256(
+      json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _build_lock_lease():
+  return timedelta(
+      seconds=flask.current_app.config['PREVIEW_BUILD_LOCK_SECONDS'])
+
+
+def queued_build_task_id(site):
+  '''
+  Returns the id of the site's build task that is enqueued but not started,
+  or None. A task that has been queued for longer than a build may take is
+  assumed to be lost.
+  '''
+  lease = _build_lock_lease()
+  if (site.build_queued_task_id is None or
+      site.build_queued_at < utcnow() - lease):
+    return None
+  return site.build_queued_task_id
+
+
+def build_running(site):
+  return site.build_lock_until is not None and site.build_lock_until > utcnow()
+
+
+def acquire_build_lock(site_id, task_id):
+  '''
+  Takes the site's build lock for task_id, unless another build holds it.
+  The task stops being the queued one, so later requests queue a follow-up
+  build. Returns whether the lock was taken.
+  '''
+  now = utcnow()
+  lease = _build_lock_lease()
+  # A single UPDATE, so that only one worker can win.
+  result = db.session.execute(
+      update(Site).where(
+          Site.id == UUID(site_id),
+          or_(Site.build_lock_until.is_(None),
+              Site.build_lock_until < now)).values(
+                  build_lock_until=now + lease, build_lock_task_id=task_id))
+  if result.rowcount == 0:
+    db.session.rollback()
+    return False
+
+  db.session.execute(
+      update(Site).where(Site.id == UUID(site_id),
+                         Site.build_queued_task_id == task_id).values(
+                             build_queued_task_id=None, build_queued_at=None))
+  db.session.commit()
+  return True
+
+
+def release_build_lock(site_id, task_id):
+  '''
+  Releases the site's build lock, if task_id still holds it. When the lease
+  ran out, another build may have taken the lock, which it keeps.
+  '''
+  db.session.rollback()
+  db.session.execute(
+      update(Site).where(Site.id == UUID(site_id),
+                         Site.build_lock_task_id == task_id).values(
+                             build_lock_until=None, build_lock_task_id=None))
+  db.session.commit()
 
-def generate_site(data_dir_path, preview_dir_path, site_id):
-  download_site_objects(data_dir_path, site_id)
-  generate_eno_files(data_dir_path, site_id)
 
-  # Run faircamp.
+@dataclass
+class ProcessLimits:
+  '''
+  What run_faircamp allows faircamp, and the processes it starts (like
+  ffmpeg), to use. None is no limit.
+  '''
+  # Wall clock seconds, after which the whole process group is terminated.
+  timeout: float = None
+  # How long terminated processes get to exit before they are killed.
+  kill_grace_seconds: float = 10
+  # RLIMIT_DATA of each process, in bytes. It counts the memory a process
+  # allocates (heap and private mappings), not the address space it reserves,
+  # so it doesn't fail programs that reserve much more than they use.
+  memory_bytes: int = None
+  # RLIMIT_CPU of each process, in seconds.
+  cpu_seconds: int = None
+  # Added to the niceness of the processes.
+  nice: int = 0
+  # Whether the processes get the lowest best effort I/O priority.
+  ionice: bool = False
+
+
+def faircamp_limits():
+  config = flask.current_app.config
+  # 0 is no limit.
+  return ProcessLimits(
+      timeout=config['FAIRCAMP_TIMEOUT_SECONDS'] or None,
+      kill_grace_seconds=config['FAIRCAMP_KILL_GRACE_SECONDS'],
+      memory_bytes=config['FAIRCAMP_MEMORY_LIMIT_BYTES'] or None,
+      cpu_seconds=config['FAIRCAMP_CPU_LIMIT_SECONDS'] or None,
+      nice=config['FAIRCAMP_NICE'],
+      ionice=config['FAIRCAMP_IONICE'])
+
+
+def _limit_args(limits):
+  '''
+  Returns the commands that run a command within limits, to put before its
+  args. The limits are applied by these commands rather than between fork
+  and exec, which isn't safe in a process with threads.
+  '''
+  args = []
+  rlimits = []
+  if limits.memory_bytes:
+    rlimits.append(f'--data={limits.memory_bytes}')
+  if limits.cpu_seconds:
+    rlimits.append(f'--cpu={limits.cpu_seconds}')
+  if rlimits:
+    args += ['prlimit'] + rlimits
+  if limits.nice:
+    args += ['nice', '-n', str(limits.nice)]
+  if limits.ionice and shutil.which('ionice'):
+    args += ['ionice', '-c', '2', '-n', '7']
+  return args
+
+
+def _signal_group(proc, sig):
   try:
-    args = [
-        'faircamp', '--catalog-dir',
-        catalog_dir(data_dir_path, site_id), '--build-dir',
-        build_dir(preview_dir_path, site_id), '--cache-dir',
-        cache_dir(preview_dir_path, site_id), '--no-clean-urls'
-    ]
-    log.info('Running faircamp with args: %s', ' '.join(args))
-    output = subprocess.run(args, capture_output=True, check=True, text=True)
-    log.debug('Faircamp output:\n===STDOUT===\n%s', output.stdout)
+    os.killpg(proc.pid, sig)
+  except ProcessLookupError:
+    pass
 
-    upload_site_objects(preview_dir_path, site_id)
-    generate_and_upload_zip(preview_dir_path, site_id)
-  except subprocess.CalledProcessError as e:
-    log.exception('Faircamp failed\n===STDOUT===:\n%s', e.output)
+
+def _watch(proc, limits, timed_out):
+  '''
+  Terminates the process group of proc if it runs for longer than
+  limits.timeout, and kills it if it's still running kill_grace_seconds
+  later.
+  '''
+  try:
+    proc.wait(limits.timeout)
+    return
+  except subprocess.TimeoutExpired:
+    pass
+  timed_out.set()
+  log.warning('Faircamp timed out after %ss, terminating it', limits.timeout)
+  _signal_group(proc, signal.SIGTERM)
+  try:
+    proc.wait(limits.kill_grace_seconds)
+  except subprocess.TimeoutExpired:
+    _signal_group(proc, signal.SIGKILL)
+
+
+def run_faircamp(args, on_line, limits=None):
+  '''
+  Runs faircamp within limits, calling on_line with each line of its output
+  as it is written. Returns the output, stdout and stderr combined. Raises
+  CalledProcessError if faircamp fails, and TimeoutExpired if it ran out of
+  time.
+
+  Faircamp runs in its own process group, so that the processes it starts
+  are stopped with it.
+  '''
+  limits = limits or ProcessLimits()
+  limit_args = _limit_args(limits)
+  if limit_args:
+    # Like Popen, fail with an OSError if faircamp isn't installed, instead of
+    # the command that runs it failing.
+    if shutil.which(args[0]) is None:
+      raise FileNotFoundError(f'Could not find {args[0]}')
+    args = limit_args + args
+  log.info('Running faircamp with args: %s', ' '.join(args))
+  lines = []
+  timed_out = threading.Event()
+  with subprocess.Popen(args,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        text=True,
+                        bufsize=1,
+                        start_new_session=True) as proc:
+    try:
+      if limits.timeout:
+        threading.Thread(target=_watch,
+                         args=(proc, limits, timed_out),
+                         daemon=True).start()
+      for line in proc.stdout:
+        lines.append(line)
+        on_line(line)
+    finally:
+      if proc.poll() is None:
+        # Nothing is reading the output anymore.
+        _signal_group(proc, signal.SIGKILL)
+  output = ''.join(lines)
+  if timed_out.is_set():
+    raise subprocess.TimeoutExpired(args, limits.timeout, output=output)
+  if proc.returncode != 0:
+    raise subprocess.CalledProcessError(proc.returncode, args, output=output)
+  log.debug('Faircamp output:\n===STDOUT===\n%s', output)
+  return output
+
+
+def faircamp_progress(events, track_names):
+  '''
+  Returns an on_line callback for run_faircamp that publishes faircamp's
+  progress, as the share of track_names that its output has mentioned.
+  '''
+  remaining = set(track_names)
+  total = len(remaining) or 1
+
+  def on_line(line):
+    seen = {name for name in remaining if name in line}
+    if seen:
+      remaining.difference_update(seen)
+      events.publish('faircamp',
+                     progress=(total - len(remaining)) / total,
+                     message=line.strip())
+
+  return on_line
+
+
+# How many BuildRuns are kept per site.
+BUILD_RUNS_KEEP = 50
+# How much of faircamp's output is kept in a BuildRun.
+OUTPUT_TAIL_CHARS = 4096
+
+
+class _Build:
+  '''
+  One run of generate_site. Publishes its progress events, and collects the
+  stage timings and transfer stats that are saved to its BuildRun when it
+  finishes.
+  '''
+
+  def __init__(self, site_id, task_id, queued_at):
+    self.site_id = site_id
+    self.events = progress.BuildProgress(site_id, task_id)
+    self.fields = {}
+    run = BuildRun(site_id=UUID(site_id),
+                   task_id=task_id,
+                   queued_at=queued_at,
+                   started_at=utcnow())
+    if queued_at is not None:
+      self.fields['queue_seconds'] = max(
+          (run.started_at - queued_at).total_seconds(), 0)
+    db.session.add(run)
+    db.session.commit()
+    self.run_id = run.id
+
+  @contextmanager
+  def stage(self, name):
+    if name in progress.STAGES:
+      self.events.publish(name)
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.fields[f'{name}_seconds'] = time.monotonic() - start
+
+  def finish(self, status):
+    # Whatever a failed build left in the session is not saved with the run.
+    db.session.rollback()
+    run = db.session.get(BuildRun, self.run_id)
+    for name, value in self.fields.items():
+      setattr(run, name, value)
+    run.status = status
+    run.finished_at = utcnow()
+
+    old_ids = db.session.execute(
+        select(BuildRun.id).where(BuildRun.site_id == UUID(
+            self.site_id)).order_by(
+                BuildRun.started_at.desc(),
+                BuildRun.id.desc()).offset(BUILD_RUNS_KEEP)).scalars().all()
+    if old_ids:
+      db.session.execute(delete(BuildRun).where(BuildRun.id.in_(old_ids)))
+    db.session.commit()
+
+
+def generate_site(data_dir_path,
+                  preview_dir_path,
+                  site_id,
+                  task_id=None,
+                  queued_at=None):
+  '''
+  Builds the site's preview and publishes it, publishing progress events for
+  the build task_id along the way, and records the build as a BuildRun.
+  Returns (success, faircamp output if it failed).
+  '''
+  build = _Build(site_id, task_id, queued_at)
+  try:
+    result = _generate_site(data_dir_path, preview_dir_path, site_id, build)
+  except subprocess.TimeoutExpired as e:
+    # Not an error of the worker, the site takes too long to build.
+    build.events.publish('failed', message='Faircamp timed out')
+    build.finish('timeout')
     return (False, e.output)
+  except Exception:
+    build.events.publish('failed', message='An error occurred')
+    # Recording the run must not replace the error of the build.
+    try:
+      build.finish('error')
+    except Exception:
+      log.exception('Could not record failed build of site %s', site_id)
+    raise
+  if result[0]:
+    build.events.publish('done', progress=1)
+    build.finish('success')
+  else:
+    build.events.publish('failed', message='Faircamp failed')
+    build.finish('failed')
+  return result
+
+
+def _run_faircamp_stage(site_id, ws, build):
+  args = [
+      'faircamp', '--catalog-dir', ws.catalog_dir, '--build-dir',
+      ws.build_dir, '--cache-dir', ws.cache_dir, '--no-clean-urls'
+  ]
+  site = db.session.get(Site, UUID(site_id))
+  build.fields['faircamp_version'] = faircamp_version()
+  try:
+    with build.stage('faircamp'):
+      output = run_faircamp(
+          args,
+          faircamp_progress(build.events, [
+              file.filename for release in site.releases
+              for file in release.files
+          ]), faircamp_limits())
+  except subprocess.CalledProcessError as e:
+    build.fields['faircamp_exit_status'] = e.returncode
+    build.fields['faircamp_output_tail'] = (e.output or
+                                            '')[-OUTPUT_TAIL_CHARS:]
+    raise
+  except subprocess.TimeoutExpired as e:
+    build.fields['faircamp_output_tail'] = (e.output or
+                                            '')[-OUTPUT_TAIL_CHARS:]
+    raise
+  build.fields['faircamp_exit_status'] = 0
+  build.fields['faircamp_output_tail'] = (output or '')[-OUTPUT_TAIL_CHARS:]
+
+
+def _generate_site(data_dir_path, preview_dir_path, site_id, build):
+  # Taken before anything is downloaded, so that changes made during the
+  # build cause the next one to run.
+  fingerprint = site_fingerprint(data_dir_path, site_id)
+  # Everything local to the build is in its own workspace, so that nothing
+  # else can change or remove it while the build runs.
+  ws = workspace.create(site_id)
+  try:
+    with build.stage('download'):
+      stats = download_site_objects(data_dir_path, site_id, ws.catalog_dir)
+    build.fields.update(download_files=stats.files,
+                        download_bytes=stats.bytes,
+                        download_cached=stats.cached)
+    with build.stage('eno'):
+      generate_eno_files(site_id, ws.catalog_dir)
+
+    try:
+      cache_files = restore_faircamp_cache(preview_dir_path, site_id,
+                                           ws.cache_dir)
+    except Exception:
+      # The cache only saves time, build without it.
+      log.exception('Could not restore faircamp cache of site %s', site_id)
+      shutil.rmtree(ws.cache_dir, ignore_errors=True)
+      cache_files = {}
+
+    try:
+      _run_faircamp_stage(site_id, ws, build)
+    except subprocess.CalledProcessError as e:
+      log.exception('Faircamp failed\n===STDOUT===:\n%s', e.output)
+      return (False, e.output)
+
+    # The stored zip of the previous build would be stale once this one is
+    # published. Until a new one is stored, zips are streamed from the
+    # published files.
+    object_storage.remove_object(
+        os.path.join(zip_file_path(preview_dir_path, site_id),
+                     'rainfall_site.zip'))
+    with build.stage('publish'):
+      stats = upload_site_objects(preview_dir_path, site_id, ws.build_dir)
+    build.fields.update(publish_files=stats.files, publish_bytes=stats.bytes)
+    if flask.current_app.config['PREVIEW_STORE_ZIP']:
+      with build.stage('zip'):
+        build.fields['zip_bytes'] = generate_and_upload_zip(
+            preview_dir_path, site_id, ws.build_dir)
+
+    try:
+      save_faircamp_cache(preview_dir_path, site_id, ws.cache_dir, cache_files)
+    except Exception:
+      log.exception('Could not save faircamp cache of site %s', site_id)
   finally:
-    cleanup_site(data_dir_path, preview_dir_path, site_id)
+    with build.stage('cleanup'):
+      ws.remove()
 
+  site = db.session.get(Site, UUID(site_id))
+  site.build_fingerprint = fingerprint
+  db.session.commit()
   return (True, None)
 
 
@@ -154,22 +817,82 @@ def zip_file_path(preview_dir_path, site_id):
                       secure_filename(site.name))
 
 
-def generate_and_upload_zip(preview_dir_path, site_id):
-  root_dir = zip_file_path(preview_dir_path, site_id)
-  out_path = os.path.join(root_dir, 'rainfall_site')
-  shutil.make_archive(out_path, 'zip', root_dir=root_dir, base_dir='public')
+# Media that is already compressed gains next to nothing from deflate, so it
+# is stored as is.
+ZIP_STORED_EXTENSIONS = frozenset(
+    ('.aac', '.avif', '.flac', '.gif', '.jpeg', '.jpg', '.m4a', '.mp3', '.ogg',
+     '.opus', '.png', '.webp', '.woff', '.woff2', '.zip'))
+
+
+def zip_compression(filename):
+  if os.path.splitext(filename)[1].lower() in ZIP_STORED_EXTENSIONS:
+    return zipfile.ZIP_STORED
+  return zipfile.ZIP_DEFLATED
 
+
+def write_zip(path, f):
+  '''
+  Writes a zip of the local directory path to the binary file f, which need
+  not be seekable. Entries are under the directory's name.
+  '''
+  parent = os.path.dirname(path)
+  with zipfile.ZipFile(f, 'w') as zf:
+    for dirpath, dirnames, filenames in os.walk(path):
+      dirnames.sort()
+      arc_dir = os.path.relpath(dirpath, parent)
+      zf.write(dirpath, arc_dir)
+      for filename in sorted(filenames):
+        zf.write(os.path.join(dirpath, filename),
+                 os.path.join(arc_dir, filename),
+                 compress_type=zip_compression(filename))
+
+
+def generate_and_upload_zip(preview_dir_path, site_id, local_path):
+  # The zip of the local build dir local_path is streamed into object storage
+  # as it is written, instead of being written to disk and read back.
   zip_path = os.path.join(zip_file_path(preview_dir_path, site_id),
                           'rainfall_site.zip')
-  with open(zip_path, 'rb') as f:
-    object_storage.put_object(zip_path, f, 'application/zip')
+  start = time.monotonic()
+  size = object_storage.put_stream(zip_path,
+                                   lambda f: write_zip(local_path, f),
+                                   'application/zip')
+  log.info('Uploaded zip of site %s (%s bytes) in %.2fs', site_id, size,
+           time.monotonic() - start)
+  return size
+
+
+def zip_object_path(preview_dir_path, site):
+  return os.path.join(zip_file_path(preview_dir_path, str(site.id)),
+                      'rainfall_site.zip')
+
+
+def site_zip_layout(preview_dir_path, site):
+  '''
+  Returns the ZipLayout of a zip of the site's published build, or None if
+  the build was published without the CRCs it needs.
+  '''
+  manifest = load_manifest(preview_dir_path, str(site.id))
+  if not manifest or any('crc32' not in entry for entry in manifest.values()):
+    return None
+
+  path = build_dir(preview_dir_path, str(site.id))
+  return zip_stream.ZipLayout(
+      zip_stream.ZipEntry(name=f'public/{rel_path}',
+                          path=os.path.join(path, rel_path),
+                          size=entry['size'],
+                          crc32=entry['crc32'],
+                          mtime=entry.get('mtime'))
+      for rel_path, entry in sorted(manifest.items()))
 
 
 def get_zip_file(preview_dir_path, site):
-  zip_path = os.path.join(zip_file_path(preview_dir_path, str(site.id)),
-                          'rainfall_site.zip')
+  layout = site_zip_layout(preview_dir_path, site)
+  if layout is not None:
+    return layout.open()
 
-  if not object_storage.path_exists(zip_path):
+  zip_path = zip_object_path(preview_dir_path, site)
+
+  if not object_storage.object_exists(zip_path):
     raise FileNotFoundError(f'Could not find zip file at {zip_path}')
 
   return object_storage.get_object(zip_path)
@@ -187,12 +910,10 @@ def delete_file(clz, file_id, user):
         status=401,
         error='Cannot delete files for that release, unauthorized'), 403
 
-  cur_release_path = release_path(flask.current_app.config['DATA_DIR'],
-                                  file.release)
-  file_path = os.path.join(cur_release_path, file.filename)
+  object_path = file_object_path(flask.current_app.config['DATA_DIR'], file)
 
   try:
-    object_storage.remove_object(file_path)
+    object_storage.remove_object(object_path)
   except Exception:
     log.exception('Could not delete file id=%s', file.id)
     return flask.jsonify(status=500, error='Could not delete file'), 500
@@ -204,18 +925,22 @@ def delete_file(clz, file_id, user):
 
 
 def rename_release_dir(data_dir_path, release, old_name):
+  '''
+  Objects are stored by id, so a rename only has to make sure that the new
+  name doesn't map to the same catalog directory as another release.
+  '''
   new_path = release_path(data_dir_path, release)
-  if object_storage.path_exists(new_path):
-    raise FileExistsError(f'The directory {new_path} already exists')
-
-  old_path = release_path(data_dir_path, release, override_name=old_name)
-  object_storage.rename_dir_recursively(old_path, new_path)
+  for other in release.site.releases:
+    if other is not release and release_path(data_dir_path, other) == new_path:
+      raise FileExistsError(f'The directory {new_path} already exists')
 
 
 def rename_site_dir(data_dir_path, site, old_name):
+  '''
+  Objects are stored by id, so a rename only has to make sure that the new
+  name doesn't map to the same catalog and build directory as another site.
+  '''
   new_path = site_path(data_dir_path, site)
-  if object_storage.path_exists(new_path):
-    raise FileExistsError(f'The directory {new_path} already exists')
-
-  old_path = site_path(data_dir_path, site, override_name=old_name)
-  object_storage.rename_dir_recursively(old_path, new_path)
+  for other in site.user.sites:
+    if other is not site and site_path(data_dir_path, other) == new_path:
+      raise FileExistsError(f'The directory {new_path} already exists')
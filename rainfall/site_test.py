@@ -1,20 +1,45 @@
+import hashlib
 import io
 import os
+import shutil
 import subprocess
-from unittest.mock import patch
+import time
+import zipfile
+import zlib
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+from uuid import UUID
 
 import pytest
+from sqlalchemy import select
 from uuid_extensions import uuid7
 
-from rainfall import object_storage
+import rainfall.site
+from rainfall import object_storage, transcode_cache
 from rainfall.conftest import BASIC_USER_ID
-from rainfall.db import db
-from rainfall.models import File, User
-from rainfall.site import (build_dir, cache_dir, catalog_dir, delete_file,
+from rainfall.db import db, utcnow
+from rainfall.models import BuildRun, File, Site, User
+from rainfall.site import (ProcessLimits, acquire_build_lock, build_dir,
+                           build_running, catalog_file_path, delete_file,
+                           download_site_objects,
+                           faircamp_cache_manifest_path, faircamp_progress,
+                           faircamp_version, file_object_path,
+                           generate_and_upload_zip,
                            generate_eno_files, generate_site, get_zip_file,
-                           public_dir, release_path, rename_release_dir,
-                           rename_site_dir, secure_filename, site_exists,
-                           site_path)
+                           load_manifest, manifest_object_path, public_dir,
+                           queued_build_task_id, release_build_lock,
+                           release_path, rename_release_dir, rename_site_dir,
+                           restore_faircamp_cache, run_faircamp,
+                           save_faircamp_cache, secure_filename, site_exists,
+                           site_fingerprint, site_path, site_zip_layout,
+                           upload_site_objects)
+
+
+def write_build(path, files):
+  for name, data in files.items():
+    os.makedirs(os.path.dirname(f'{path}/{name}'), exist_ok=True)
+    with open(f'{path}/{name}', 'wb') as f:
+      f.write(data)
 
 
 @pytest.fixture
@@ -33,11 +58,13 @@ def site_name(app, sites_user):
 
 class SiteTest:
 
-  def test_catalog_dir(self, app, site_id, site_name):
+  def test_catalog_file_path(self, app, releases_user):
     with app.app_context():
-      actual = catalog_dir('foo/data', site_id)
+      db.session.add(releases_user)
+      file = releases_user.sites[0].releases[1].files[0]
+      actual = catalog_file_path('/tmp/catalog', file)
 
-      assert actual == f'foo/data/{str(BASIC_USER_ID)}/{site_name}'
+      assert actual == '/tmp/catalog/Site 0 Release 2/s0_r1_file_0.wav'
 
   def test_build_dir(self, app, site_id, site_name):
     with app.app_context():
@@ -52,12 +79,6 @@ class SiteTest:
 
     assert actual == f'{str(BASIC_USER_ID)}/{site_name}/public'
 
-  def test_cache_dir(self, app, site_id, site_name):
-    with app.app_context():
-      actual = cache_dir('foo/data', site_id)
-
-      assert actual == f'foo/data/{str(BASIC_USER_ID)}/{site_name}/cache'
-
   def test_release_path(self, app, releases_user):
     with app.app_context():
       db.session.add(releases_user)
@@ -95,11 +116,11 @@ class SiteTest:
           f'{app.config["PREVIEW_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/Cool Site 1'
       )
 
-  @patch('rainfall.site.subprocess.run')
-  def test_generate_site_exception(self, mock_subprocess, app, releases_user):
+  @patch('rainfall.site.run_faircamp')
+  def test_generate_site_exception(self, mock_faircamp, app, releases_user):
     exc = subprocess.CalledProcessError(1, 'faircamp')
     exc.stdout = 'fake faircamp stdout'
-    mock_subprocess.side_effect = exc
+    mock_faircamp.side_effect = exc
 
     with app.app_context():
       db.session.add(releases_user)
@@ -110,6 +131,361 @@ class SiteTest:
     assert actual[0] is False
     assert actual[1] == 'fake faircamp stdout'
 
+  @patch('rainfall.site.generate_and_upload_zip')
+  @patch('rainfall.site.upload_site_objects')
+  @patch('rainfall.site.run_faircamp')
+  def test_generate_site_saves_fingerprint(self, mock_faircamp, mock_upload,
+                                           mock_zip, app, releases_user):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    mock_faircamp.return_value = ''
+    mock_upload.return_value = object_storage.TransferStats()
+    mock_zip.return_value = 0
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+      actual = generate_site(app.config['DATA_DIR'], app.config['PREVIEW_DIR'],
+                             site_id)
+
+      assert actual[0] is True
+      assert releases_user.sites[0].build_fingerprint == site_fingerprint(
+          app.config['DATA_DIR'], site_id)
+
+  @patch('rainfall.site.generate_and_upload_zip')
+  @patch('rainfall.site.upload_site_objects')
+  @patch('rainfall.site.run_faircamp')
+  @patch('rainfall.site.progress.BuildProgress')
+  def test_generate_site_progress(self, mock_progress, mock_faircamp,
+                                  mock_upload, mock_zip, app, releases_user):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    app.config['PREVIEW_STORE_ZIP'] = True
+    mock_faircamp.return_value = ''
+    mock_upload.return_value = object_storage.TransferStats()
+    mock_zip.return_value = 0
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+      generate_site(app.config['DATA_DIR'],
+                    app.config['PREVIEW_DIR'],
+                    site_id,
+                    task_id='task-1')
+
+    mock_progress.assert_called_once_with(site_id, 'task-1')
+    stages = [
+        c.args[0] for c in mock_progress.return_value.publish.call_args_list
+    ]
+    assert stages == ['download', 'eno', 'faircamp', 'publish', 'zip', 'done']
+
+  @patch('rainfall.site.upload_site_objects')
+  @patch('rainfall.site.run_faircamp')
+  def test_generate_site_build_run(self, mock_faircamp, mock_upload, app,
+                                   releases_user):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    app.config['PREVIEW_STORE_ZIP'] = False
+    mock_faircamp.return_value = 'Done\n'
+    mock_upload.return_value = object_storage.TransferStats(files=2,
+                                                            bytes=100)
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+      generate_site(app.config['DATA_DIR'],
+                    app.config['PREVIEW_DIR'],
+                    site_id,
+                    task_id='task-1',
+                    queued_at=utcnow() - timedelta(seconds=30))
+
+      run = db.session.execute(select(BuildRun)).scalar_one()
+      assert run.task_id == 'task-1'
+      assert run.status == 'success'
+      assert run.finished_at is not None
+      assert run.queue_seconds >= 30
+      for stage in ('download', 'eno', 'faircamp', 'publish', 'cleanup'):
+        assert getattr(run, f'{stage}_seconds') is not None
+      assert run.zip_seconds is None
+      assert run.download_files == 3
+      assert run.publish_files == 2
+      assert run.publish_bytes == 100
+      assert run.faircamp_version == 'faircamp 1.0.0'
+      assert run.faircamp_exit_status == 0
+      assert run.faircamp_output_tail == 'Done\n'
+
+  @patch('rainfall.site.run_faircamp')
+  def test_generate_site_build_run_failed(self, mock_faircamp, app,
+                                          releases_user):
+    mock_faircamp.side_effect = subprocess.CalledProcessError(
+        2, 'faircamp', output='x' * 5000 + 'Error: bad catalog\n')
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+      generate_site(app.config['DATA_DIR'], app.config['PREVIEW_DIR'],
+                    site_id)
+
+      run = db.session.execute(select(BuildRun)).scalar_one()
+      assert run.status == 'failed'
+      assert run.faircamp_exit_status == 2
+      assert run.faircamp_output_tail.endswith('Error: bad catalog\n')
+      assert len(run.faircamp_output_tail) == 4096
+      assert run.publish_seconds is None
+
+  @patch('rainfall.site.download_site_objects')
+  def test_generate_site_build_run_error(self, mock_download, app, site_id):
+    mock_download.side_effect = ValueError('broken')
+    with app.app_context():
+      with pytest.raises(ValueError):
+        generate_site(app.config['DATA_DIR'], app.config['PREVIEW_DIR'],
+                      site_id)
+
+      run = db.session.execute(select(BuildRun)).scalar_one()
+      assert run.status == 'error'
+      assert run.download_seconds is not None
+
+  @patch('rainfall.site.upload_site_objects')
+  @patch('rainfall.site.run_faircamp')
+  def test_generate_site_workspace(self, mock_faircamp, mock_upload, app,
+                                   releases_user, tmp_path):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    app.config['BUILD_WORKSPACE_DIR'] = str(tmp_path)
+    mock_upload.return_value = object_storage.TransferStats()
+    catalogs = []
+
+    def run_faircamp(args, on_line, limits):
+      catalogs.append(args[args.index('--catalog-dir') + 1])
+      assert os.path.exists(f'{catalogs[-1]}/Site 0 Release 2/release.eno')
+      return ''
+
+    mock_faircamp.side_effect = run_faircamp
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+      for _ in range(2):
+        generate_site(app.config['DATA_DIR'], app.config['PREVIEW_DIR'],
+                      site_id)
+
+    # Every build has its own workspace, which is removed when it's done.
+    assert catalogs[0] != catalogs[1]
+    assert all(catalog.startswith(str(tmp_path)) for catalog in catalogs)
+    assert os.listdir(tmp_path) == []
+
+  @patch('rainfall.site.BUILD_RUNS_KEEP', 2)
+  @patch('rainfall.site.download_site_objects')
+  def test_generate_site_build_run_pruned(self, mock_download, app,
+                                          site_id):
+    mock_download.side_effect = ValueError('broken')
+    with app.app_context():
+      for _ in range(3):
+        with pytest.raises(ValueError):
+          generate_site(app.config['DATA_DIR'], app.config['PREVIEW_DIR'],
+                        site_id)
+
+      assert len(db.session.execute(select(BuildRun)).scalars().all()) == 2
+
+  @patch('rainfall.site.BUILD_RUNS_KEEP', 2)
+  @patch('rainfall.site.utcnow')
+  @patch('rainfall.site.download_site_objects')
+  def test_generate_site_build_run_pruned_same_start(self, mock_download,
+                                                     mock_utcnow, app,
+                                                     site_id):
+    mock_download.side_effect = ValueError('broken')
+    mock_utcnow.return_value = datetime(2026, 1, 1)
+    with app.app_context():
+      for i in range(3):
+        with pytest.raises(ValueError):
+          generate_site(app.config['DATA_DIR'], app.config['PREVIEW_DIR'],
+                        site_id)
+        if i == 0:
+          oldest = db.session.execute(select(BuildRun.id)).scalar_one()
+
+      ids = db.session.execute(select(BuildRun.id)).scalars().all()
+      assert len(ids) == 2
+      assert oldest not in ids
+
+  @patch('rainfall.site._Build.finish')
+  @patch('rainfall.site.download_site_objects')
+  def test_generate_site_build_run_error_not_recorded(self, mock_download,
+                                                      mock_finish, app,
+                                                      site_id):
+    mock_download.side_effect = ValueError('broken')
+    mock_finish.side_effect = RuntimeError('database gone')
+    with app.app_context():
+      # The error of the build is raised, not the one of recording it.
+      with pytest.raises(ValueError):
+        generate_site(app.config['DATA_DIR'], app.config['PREVIEW_DIR'],
+                      site_id)
+
+  @patch('rainfall.site.run_faircamp')
+  @patch('rainfall.site.progress.BuildProgress')
+  def test_generate_site_timeout(self, mock_progress, mock_faircamp, app,
+                                 releases_user, tmp_path):
+    app.config['BUILD_WORKSPACE_DIR'] = str(tmp_path)
+    mock_faircamp.side_effect = subprocess.TimeoutExpired('faircamp',
+                                                          60,
+                                                          output='Reading\n')
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+      actual = generate_site(app.config['DATA_DIR'],
+                             app.config['PREVIEW_DIR'], site_id)
+
+      run = db.session.execute(select(BuildRun)).scalar_one()
+      assert run.status == 'timeout'
+      assert run.faircamp_output_tail == 'Reading\n'
+
+    assert actual == (False, 'Reading\n')
+    assert mock_progress.return_value.publish.call_args.kwargs[
+        'message'] == 'Faircamp timed out'
+    assert os.listdir(tmp_path) == []
+
+  @patch('rainfall.site.run_faircamp')
+  @patch('rainfall.site.progress.BuildProgress')
+  def test_generate_site_progress_failed(self, mock_progress, mock_faircamp,
+                                         app, releases_user):
+    mock_faircamp.side_effect = subprocess.CalledProcessError(1, 'faircamp')
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+      generate_site(app.config['DATA_DIR'], app.config['PREVIEW_DIR'],
+                    site_id)
+
+    publish = mock_progress.return_value.publish
+    assert publish.call_args.args == ('failed',)
+
+  def test_run_faircamp(self):
+    lines = []
+    actual = run_faircamp(['sh', '-c', 'echo one; echo two >&2'],
+                          lines.append)
+
+    assert actual == 'one\ntwo\n'
+    assert lines == ['one\n', 'two\n']
+
+  def test_run_faircamp_failure(self):
+    with pytest.raises(subprocess.CalledProcessError) as e:
+      run_faircamp(['sh', '-c', 'echo broken; exit 3'], lambda line: None)
+
+    assert e.value.returncode == 3
+    assert e.value.output == 'broken\n'
+
+  def test_run_faircamp_timeout(self):
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+      # The background sleep keeps the output open unless the whole process
+      # group is stopped.
+      run_faircamp(['sh', '-c', 'echo started; sleep 30 & wait'],
+                   lambda line: None,
+                   ProcessLimits(timeout=0.5, kill_grace_seconds=1))
+
+    assert e.value.output == 'started\n'
+    assert time.monotonic() - start < 10
+
+  def test_run_faircamp_limits(self):
+    actual = run_faircamp(['sh', '-c', 'ulimit -d; ulimit -t; nice'],
+                          lambda line: None,
+                          ProcessLimits(memory_bytes=1024 * 1024 * 1024,
+                                        cpu_seconds=60,
+                                        nice=5))
+
+    assert actual.split() == ['1048576', '60', str(min(os.nice(0) + 5, 19))]
+
+  def test_faircamp_progress(self):
+    events = MagicMock()
+    on_line = faircamp_progress(events, ['a.wav', 'b.wav'])
+
+    on_line('Reading catalog\n')
+    on_line('Transcoding a.wav\n')
+    on_line('Transcoding a.wav to mp3\n')
+    on_line('Transcoding b.wav\n')
+
+    assert [c.kwargs['progress'] for c in events.publish.call_args_list
+           ] == [0.5, 1]
+    assert events.publish.call_args.kwargs['message'] == 'Transcoding b.wav'
+
+  @patch('rainfall.site.subprocess.run', side_effect=OSError('No faircamp'))
+  def test_faircamp_version_unavailable(self, mock_run, app):
+    app.config['FAIRCAMP_VERSION'] = None
+    with app.app_context(), patch('rainfall.site._faircamp_version',
+                                  rainfall.site._UNKNOWN):
+      assert faircamp_version() is None
+      assert faircamp_version() is None
+
+    mock_run.assert_called_once()
+
+  def test_site_fingerprint(self, app, releases_user):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    with app.app_context():
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+      site_id = str(site.id)
+
+      actual = site_fingerprint(app.config['DATA_DIR'], site_id)
+      assert site_fingerprint(app.config['DATA_DIR'], site_id) == actual
+
+      site.releases[0].description = 'Changed'
+      changed = site_fingerprint(app.config['DATA_DIR'], site_id)
+      assert changed != actual
+
+      app.config['FAIRCAMP_VERSION'] = 'faircamp 1.1.0'
+      assert site_fingerprint(app.config['DATA_DIR'], site_id) != changed
+
+  def test_site_fingerprint_etag(self, app, releases_user):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    with app.app_context():
+      db.session.add(releases_user)
+      site = releases_user.sites[0]
+      site_id = str(site.id)
+      actual = site_fingerprint(app.config['DATA_DIR'], site_id)
+
+      file = site.releases[1].files[0]
+      object_storage.put_object(file_object_path(app.config['DATA_DIR'], file),
+                                io.BytesIO(b'other audio'), 'audio/wav')
+
+      assert site_fingerprint(app.config['DATA_DIR'], site_id) != actual
+
+  def test_build_lock(self, app, site_id):
+    with app.app_context():
+      site = db.session.get(Site, UUID(site_id))
+      site.build_queued_task_id = 'task-1'
+      site.build_queued_at = utcnow()
+      db.session.commit()
+
+      assert acquire_build_lock(site_id, 'task-1')
+      assert site.build_queued_task_id is None
+      assert build_running(site)
+      assert not acquire_build_lock(site_id, 'task-2')
+
+      release_build_lock(site_id, 'task-1')
+      assert not build_running(site)
+      assert acquire_build_lock(site_id, 'task-2')
+
+  def test_release_build_lock_other_holder(self, app, site_id):
+    with app.app_context():
+      site = db.session.get(Site, UUID(site_id))
+      site.build_lock_until = utcnow() - timedelta(seconds=1)
+      site.build_lock_task_id = 'task-1'
+      db.session.commit()
+      # The lease of task-1 ran out and task-2 took the lock.
+      assert acquire_build_lock(site_id, 'task-2')
+
+      release_build_lock(site_id, 'task-1')
+
+      assert build_running(site)
+      assert site.build_lock_task_id == 'task-2'
+
+  def test_build_lock_expired(self, app, site_id):
+    with app.app_context():
+      site = db.session.get(Site, UUID(site_id))
+      site.build_lock_until = utcnow() - timedelta(seconds=1)
+      db.session.commit()
+
+      assert acquire_build_lock(site_id, 'task-1')
+
+  def test_build_lock_keeps_other_queued(self, app, site_id):
+    with app.app_context():
+      site = db.session.get(Site, UUID(site_id))
+      site.build_queued_task_id = 'task-2'
+      site.build_queued_at = utcnow()
+      db.session.commit()
+
+      assert acquire_build_lock(site_id, 'task-1')
+      assert queued_build_task_id(site) == 'task-2'
+
   def test_site_path(self, app, sites_user, site_name):
     with app.app_context():
       db.session.add(sites_user)
@@ -160,6 +536,35 @@ class SiteTest:
       actual = get_zip_file(app.config['PREVIEW_DIR'], site)
       assert actual.read() == b'not-a-zip'
 
+  def test_get_zip_file_streamed(self, app, site_id, tmp_path):
+    with app.app_context():
+      site = db.session.get(Site, UUID(site_id))
+      write_build(tmp_path, {
+          'index.html': b'<html></html>',
+          'album/song.mp3': b'mp3',
+      })
+      upload_site_objects(app.config['PREVIEW_DIR'], site_id, tmp_path)
+
+      with get_zip_file(app.config['PREVIEW_DIR'], site) as f:
+        data = f.read()
+      assert len(data) == site_zip_layout(app.config['PREVIEW_DIR'],
+                                          site).size
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+      assert zf.testzip() is None
+      assert zf.read('public/album/song.mp3') == b'mp3'
+      assert zf.read('public/index.html') == b'<html></html>'
+
+  def test_site_zip_layout_old_manifest(self, app, site_id):
+    with app.app_context():
+      site = db.session.get(Site, UUID(site_id))
+      object_storage.put_object(
+          manifest_object_path(app.config['PREVIEW_DIR'], site_id),
+          io.BytesIO(b'{"index.html": {"sha256": "abc", "size": 13}}'),
+          'application/json')
+
+      assert site_zip_layout(app.config['PREVIEW_DIR'], site) is None
+
   def test_get_zip_file_not_found(self, app, sites_user):
     with app.app_context():
       db.session.add(sites_user)
@@ -212,7 +617,10 @@ class SiteTest:
       db.session.add(releases_user)
       release = releases_user.sites[0].releases[1]
       old_name = release.name
-      old_path = f'{app.config["DATA_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/Cool Site 1/{old_name}'
+      object_paths = [
+          file_object_path(app.config['DATA_DIR'], file)
+          for file in release.files
+      ]
       new_name = 'new name'
       release.name = new_name
       db.session.add(release)
@@ -220,10 +628,9 @@ class SiteTest:
 
       rename_release_dir(app.config['DATA_DIR'], release, old_name)
 
-      assert not object_storage.path_exists(old_path)
-      assert object_storage.path_exists(
-          f'{app.config["DATA_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/Cool Site 1/new name'
-      )
+      # Objects are keyed by id, so nothing moves.
+      for path in object_paths:
+        assert object_storage.path_exists(path)
       assert release.name == new_name
 
   def test_rename_release_dir_new_exists(self, app, releases_user):
@@ -231,6 +638,8 @@ class SiteTest:
       db.session.add(releases_user)
       release = releases_user.sites[0].releases[1]
       old_name = release.name
+      # Maps to the same directory as 'Site 0 Release 1'.
+      release.name = 'Site 0 Release 1$'
 
       with pytest.raises(FileExistsError):
         rename_release_dir(app.config['DATA_DIR'], release, old_name)
@@ -240,7 +649,10 @@ class SiteTest:
       db.session.add(releases_user)
       site = releases_user.sites[0]
       old_name = site.name
-      old_path = f'{app.config["DATA_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/{old_name}'
+      object_paths = [
+          file_object_path(app.config['DATA_DIR'], file)
+          for file in site.releases[1].files
+      ]
       new_name = 'new name'
       site.name = new_name
       db.session.add(site)
@@ -248,10 +660,9 @@ class SiteTest:
 
       rename_site_dir(app.config['DATA_DIR'], site, old_name)
 
-      assert not object_storage.path_exists(old_path)
-      assert object_storage.path_exists(
-          f'{app.config["DATA_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/new name'
-      )
+      # Objects are keyed by id, so nothing moves.
+      for path in object_paths:
+        assert object_storage.path_exists(path)
       assert site.name == new_name
 
   def test_rename_site_dir_new_exists(self, app, releases_user):
@@ -259,21 +670,236 @@ class SiteTest:
       db.session.add(releases_user)
       site = releases_user.sites[0]
       old_name = site.name
+      # Maps to the same directory as 'Another Cool Site'.
+      site.name = 'Another Cool Site!'
 
       with pytest.raises(FileExistsError):
         rename_site_dir(app.config['DATA_DIR'], site, old_name)
 
-  def test_generate_eno_files(self, app, releases_user):
+  def test_file_object_path(self, app, releases_user):
+    with app.app_context():
+      db.session.add(releases_user)
+      release = releases_user.sites[0].releases[1]
+      file = release.files[0]
+      actual = file_object_path('foo/data', file)
+
+      assert actual == (f'foo/data/{str(BASIC_USER_ID)}/{release.site.id}/'
+                        f'{release.id}/{file.id}')
+
+  def test_generate_eno_files(self, app, releases_user, tmp_path):
     with app.app_context():
       db.session.add(releases_user)
       site = releases_user.sites[0]
 
-      generate_eno_files(app.config['DATA_DIR'], str(site.id))
+      generate_eno_files(str(site.id), tmp_path)
 
       # Empty release, no eno file.
-      assert not os.path.exists(
-          f'{app.config["DATA_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/Cool Site 1/Site 0 Release 1/release.eno'
-      )
-      assert os.path.exists(
-          f'{app.config["DATA_DIR"]}/06543f11-12b6-71ea-8000-e026c63c22e2/Cool Site 1/Site 0 Release 2/release.eno'
-      )
+      assert not os.path.exists(f'{tmp_path}/Site 0 Release 1/release.eno')
+      assert os.path.exists(f'{tmp_path}/Site 0 Release 2/release.eno')
+
+  def test_upload_site_objects(self, app, site_id, tmp_path):
+    with app.app_context():
+      path = build_dir(app.config['PREVIEW_DIR'], site_id)
+      write_build(tmp_path, {
+          'index.html': b'<html></html>',
+          'album/cover.jpg': b'jpg',
+          'album/song.mp3': b'mp3',
+      })
+
+      actual = upload_site_objects(app.config['PREVIEW_DIR'], site_id,
+                                   tmp_path)
+
+      assert actual.files == 3
+      assert object_storage.get_object(
+          f'{path}/album/song.mp3').read() == b'mp3'
+      entry = load_manifest(app.config['PREVIEW_DIR'],
+                            site_id)['album/song.mp3']
+      assert entry['sha256'] == hashlib.sha256(b'mp3').hexdigest()
+      assert entry['size'] == 3
+      assert entry['crc32'] == zlib.crc32(b'mp3')
+      assert entry['mtime'] == int(
+          os.path.getmtime(f'{tmp_path}/album/song.mp3'))
+
+  def test_generate_and_upload_zip(self, app, site_id, tmp_path):
+    with app.app_context():
+      path = build_dir(app.config['PREVIEW_DIR'], site_id)
+      local_path = f'{tmp_path}/public'
+      write_build(local_path, {
+          'index.html': b'<html></html>',
+          'album/cover.jpg': b'jpg',
+          'album/song.mp3': b'mp3',
+      })
+
+      generate_and_upload_zip(app.config['PREVIEW_DIR'], site_id, local_path)
+
+      data = object_storage.get_object(f'{os.path.dirname(path)}/'
+                                       'rainfall_site.zip').read()
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+      infos = {info.filename: info for info in zf.infolist()}
+      assert zf.read('public/album/song.mp3') == b'mp3'
+      assert zf.read('public/index.html') == b'<html></html>'
+    assert 'public/album/' in infos
+    assert infos['public/album/song.mp3'].compress_type == zipfile.ZIP_STORED
+    assert infos['public/album/cover.jpg'].compress_type == zipfile.ZIP_STORED
+    assert infos['public/index.html'].compress_type == zipfile.ZIP_DEFLATED
+
+  def test_upload_site_objects_incremental(self, app, site_id, tmp_path):
+    with app.app_context():
+      path = build_dir(app.config['PREVIEW_DIR'], site_id)
+      write_build(tmp_path, {
+          'index.html': b'<html></html>',
+          'album/cover.jpg': b'jpg',
+          'album/song.mp3': b'mp3',
+      })
+      upload_site_objects(app.config['PREVIEW_DIR'], site_id, tmp_path)
+
+      shutil.rmtree(tmp_path)
+      write_build(tmp_path, {
+          'index.html': b'<html>new description</html>',
+          'album/song.mp3': b'mp3',
+          'album/new.mp3': b'new',
+      })
+      with patch('rainfall.site.object_storage.upload_files',
+                 wraps=object_storage.upload_files) as mock_upload:
+        actual = upload_site_objects(app.config['PREVIEW_DIR'], site_id,
+                                     tmp_path)
+
+      assert sorted(f[1] for f in mock_upload.call_args.args[0]) == [
+          f'{path}/album/new.mp3', f'{path}/index.html'
+      ]
+      assert actual.files == 2
+      assert object_storage.get_object(
+          f'{path}/index.html').read() == b'<html>new description</html>'
+      assert object_storage.object_exists(f'{path}/album/song.mp3')
+      assert not object_storage.object_exists(f'{path}/album/cover.jpg')
+      assert sorted(load_manifest(app.config['PREVIEW_DIR'], site_id)) == [
+          'album/new.mp3', 'album/song.mp3', 'index.html'
+      ]
+
+  def test_load_manifest_missing(self, app, site_id):
+    with app.app_context():
+      assert load_manifest(app.config['PREVIEW_DIR'], site_id) is None
+
+  def test_download_site_objects_stable_mtime(self, app, releases_user,
+                                              tmp_path):
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+      file = releases_user.sites[0].releases[1].files[0]
+      path = catalog_file_path(tmp_path, file)
+
+      download_site_objects(app.config['DATA_DIR'], site_id, tmp_path)
+      first = os.stat(path).st_mtime_ns
+      os.remove(path)
+      download_site_objects(app.config['DATA_DIR'], site_id, tmp_path)
+
+      assert os.stat(path).st_mtime_ns == first
+
+  def test_faircamp_cache_round_trip(self, app, site_id, tmp_path):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    with app.app_context():
+      path = tmp_path
+      write_build(path, {'manifest.bincode': b'cache', 'a/track.opus': b'opus'})
+
+      save_faircamp_cache(app.config['PREVIEW_DIR'], site_id, path, {})
+      shutil.rmtree(path)
+      actual = restore_faircamp_cache(app.config['PREVIEW_DIR'], site_id,
+                                      path)
+
+      assert sorted(actual) == ['a/track.opus', 'manifest.bincode']
+      with open(f'{path}/a/track.opus', 'rb') as f:
+        assert f.read() == b'opus'
+
+      # Only new files are uploaded on the next save.
+      write_build(path, {'b/track.opus': b'new'})
+      with patch('rainfall.transcode_cache.object_storage.upload_files',
+                 wraps=object_storage.upload_files) as mock_upload:
+        save_faircamp_cache(app.config['PREVIEW_DIR'], site_id, path, actual)
+
+      assert [f[0] for f in mock_upload.call_args.args[0]
+             ] == [f'{path}/b/track.opus']
+      assert transcode_cache.stats()['blobs'] == 3
+
+  def test_faircamp_cache_shared_between_sites(self, app, sites_user,
+                                              tmp_path):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    with app.app_context():
+      db.session.add(sites_user)
+      site_ids = [str(site.id) for site in sites_user.sites[:2]]
+      for site_id in site_ids:
+        path = f'{tmp_path}/{site_id}'
+        write_build(path, {'a/track.opus': b'same track'})
+        save_faircamp_cache(app.config['PREVIEW_DIR'], site_id, path, {})
+
+      actual = transcode_cache.stats()
+
+    assert actual['blobs'] == 1
+    assert actual['deduplicated'] == 1
+    assert actual['dedup_rate'] == 0.5
+
+  def test_faircamp_cache_version_change(self, app, site_id, tmp_path):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    with app.app_context():
+      path = tmp_path
+      write_build(path, {'a/track.opus': b'opus'})
+      save_faircamp_cache(app.config['PREVIEW_DIR'], site_id, path, {})
+      shutil.rmtree(path)
+
+      app.config['FAIRCAMP_VERSION'] = 'faircamp 1.1.0'
+      actual = restore_faircamp_cache(app.config['PREVIEW_DIR'], site_id,
+                                      path)
+
+      assert actual == {}
+      assert not os.path.exists(path)
+      assert not object_storage.object_exists(
+          faircamp_cache_manifest_path(app.config['PREVIEW_DIR'], site_id))
+
+  def test_faircamp_cache_evicted(self, app, site_id, tmp_path):
+    app.config['FAIRCAMP_VERSION'] = 'faircamp 1.0.0'
+    app.config['TRANSCODE_CACHE_MAX_BYTES'] = 0
+    with app.app_context():
+      path = tmp_path
+      write_build(path, {'a/track.opus': b'opus'})
+      save_faircamp_cache(app.config['PREVIEW_DIR'], site_id, path, {})
+      shutil.rmtree(path)
+
+      actual = restore_faircamp_cache(app.config['PREVIEW_DIR'], site_id,
+                                      path)
+
+      assert actual == {}
+      assert not os.path.exists(path)
+
+  def test_restore_faircamp_cache_missing(self, app, site_id, tmp_path):
+    with app.app_context():
+      assert restore_faircamp_cache(app.config['PREVIEW_DIR'], site_id,
+                                    tmp_path) == {}
+
+  def test_download_site_objects(self, app, releases_user, tmp_path):
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+      release_dir = f'{tmp_path}/Site 0 Release 2'
+
+      actual = download_site_objects(app.config['DATA_DIR'], site_id,
+                                     tmp_path)
+
+      assert actual.files == 3
+      assert actual.cached == 0
+      assert os.path.exists(f'{release_dir}/s0_r1_file_0.wav')
+      assert os.path.exists(f'{release_dir}/s0_r1_file_1.wav')
+      assert os.path.exists(f'{release_dir}/artwork.jpg')
+
+  def test_download_site_objects_cached(self, app, releases_user, tmp_path):
+    with app.app_context():
+      db.session.add(releases_user)
+      site_id = str(releases_user.sites[0].id)
+
+      download_site_objects(app.config['DATA_DIR'], site_id,
+                            f'{tmp_path}/first')
+      actual = download_site_objects(app.config['DATA_DIR'], site_id,
+                                     f'{tmp_path}/second')
+
+      assert actual.files == 3
+      assert actual.cached == 3
+      assert actual.bytes == 0
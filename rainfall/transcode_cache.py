@@ -0,0 +1,146 @@
+import logging
+import os
+
+import flask
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from rainfall import object_storage
+from rainfall.db import db, utcnow
+from rainfall.models.transcode_blob import TranscodeBlob
+
+log = logging.getLogger(__name__)
+
+# Keeps IN clauses to a size every database accepts.
+_QUERY_BATCH_SIZE = 500
+
+
+def blob_path(preview_dir_path, sha256):
+  return os.path.join(preview_dir_path, 'transcode-cache', sha256[:2], sha256)
+
+
+def _get_blobs(hashes):
+  hashes = list(hashes)
+  blobs = {}
+  for i in range(0, len(hashes), _QUERY_BATCH_SIZE):
+    stmt = select(TranscodeBlob).where(
+        TranscodeBlob.sha256.in_(hashes[i:i + _QUERY_BATCH_SIZE]))
+    blobs.update((blob.sha256, blob) for blob in db.session.scalars(stmt))
+  return blobs
+
+
+def fetch(preview_dir_path, files, path):
+  '''
+  Downloads the blobs of files, a manifest of {relative path: {'sha256': ...,
+  'size': ...}}, into the local directory path. Returns a TransferStats, or
+  None without downloading anything if some of the blobs were evicted.
+  '''
+  hashes = {entry['sha256'] for entry in files.values()}
+  blobs = _get_blobs(hashes)
+  if len(blobs) != len(hashes):
+    return None
+
+  stats = object_storage.download_files([
+      (blob_path(preview_dir_path, entry['sha256']), os.path.join(path,
+                                                                  rel_path))
+      for rel_path, entry in files.items()
+  ])
+  now = utcnow()
+  for blob in blobs.values():
+    blob.last_used_at = now
+  db.session.commit()
+  return stats
+
+
+def store(preview_dir_path, files, path, known_hashes):
+  '''
+  Uploads the blobs of files, a manifest of the local directory path, that
+  aren't stored yet. Blobs that are already stored count as deduplicated,
+  unless their hash is in known_hashes (the caller had them already).
+  Returns the upload TransferStats and the number of deduplicated blobs.
+
+  This only saves storage and uploads: faircamp has already transcoded the
+  deduplicated files again for this site.
+  '''
+  local_files = {}
+  for rel_path, entry in files.items():
+    local_files.setdefault(entry['sha256'],
+                           (os.path.join(path, rel_path), entry['size']))
+  blobs = _get_blobs(local_files)
+
+  missing = [(local_path, blob_path(preview_dir_path, sha256), size)
+             for sha256, (local_path, size) in local_files.items()
+             if sha256 not in blobs]
+  stats = object_storage.upload_files(missing)
+
+  now = utcnow()
+  deduplicated = 0
+  for sha256, blob in blobs.items():
+    blob.last_used_at = now
+    if sha256 not in known_hashes:
+      blob.dedup_count += 1
+      deduplicated += 1
+  for sha256, (_, size) in local_files.items():
+    if sha256 in blobs:
+      continue
+    # A savepoint per row, so that a blob that another build stored at the
+    # same time doesn't cost the rows of the others.
+    try:
+      with db.session.begin_nested():
+        db.session.add(
+            TranscodeBlob(sha256=sha256,
+                          size=size,
+                          last_used_at=now,
+                          dedup_count=0))
+    except IntegrityError:
+      # The contents are identical, so the other build's row will do.
+      log.info('Transcode blob %s was stored concurrently', sha256)
+  db.session.commit()
+  return stats, deduplicated
+
+
+def evict(preview_dir_path):
+  '''
+  Deletes the least recently used blobs until the total size is at most
+  TRANSCODE_CACHE_MAX_BYTES. Returns the number of blobs deleted.
+  '''
+  max_bytes = flask.current_app.config['TRANSCODE_CACHE_MAX_BYTES']
+  total = db.session.scalar(
+      select(func.coalesce(func.sum(TranscodeBlob.size), 0)))
+  if total <= max_bytes:
+    return 0
+
+  evicted = []
+  stmt = select(TranscodeBlob).order_by(TranscodeBlob.last_used_at)
+  for blob in db.session.scalars(stmt):
+    if total <= max_bytes:
+      break
+    evicted.append(blob)
+    total -= blob.size
+
+  paths = [blob_path(preview_dir_path, blob.sha256) for blob in evicted]
+  # The rows go first, so that no build starts using a blob being deleted.
+  for blob in evicted:
+    db.session.delete(blob)
+  db.session.commit()
+  object_storage.remove_objects(paths)
+  return len(evicted)
+
+
+def stats():
+  '''
+  Returns the number and total size of stored blobs, how often a build
+  produced a blob that was already stored, and the dedup rate (the share of
+  stored files that didn't take up storage of their own). These are storage
+  savings only, not transcodes saved.
+  '''
+  blobs, size, deduplicated = db.session.execute(
+      select(func.count(), func.coalesce(func.sum(TranscodeBlob.size), 0),
+             func.coalesce(func.sum(TranscodeBlob.dedup_count), 0))).one()
+  return {
+      'blobs': blobs,
+      'bytes': size,
+      'max_bytes': flask.current_app.config['TRANSCODE_CACHE_MAX_BYTES'],
+      'deduplicated': deduplicated,
+      'dedup_rate': (deduplicated / (deduplicated + blobs) if blobs else 0.0),
+  }
@@ -0,0 +1,104 @@
+import os
+from datetime import timedelta
+from unittest.mock import patch
+
+from rainfall import object_storage, transcode_cache
+from rainfall.db import db, utcnow
+from rainfall.models.transcode_blob import TranscodeBlob
+from rainfall.site import build_manifest
+
+
+def write_files(path, files):
+  for name, data in files.items():
+    os.makedirs(os.path.dirname(path / name), exist_ok=True)
+    (path / name).write_bytes(data)
+
+
+class TranscodeCacheTest:
+
+  def test_store_and_fetch(self, app, tmp_path):
+    write_files(tmp_path / 'in', {'a.opus': b'aaaa', 'b/b.mp3': b'bb'})
+    with app.app_context():
+      files = build_manifest(str(tmp_path / 'in'))
+      stats, deduplicated = transcode_cache.store(app.config['PREVIEW_DIR'],
+                                                  files, str(tmp_path / 'in'),
+                                                  set())
+
+      assert stats.files == 2
+      assert deduplicated == 0
+
+      actual = transcode_cache.fetch(app.config['PREVIEW_DIR'], files,
+                                     str(tmp_path / 'out'))
+
+    assert actual.files == 2
+    assert (tmp_path / 'out' / 'b' / 'b.mp3').read_bytes() == b'bb'
+
+  def test_store_duplicate_contents(self, app, tmp_path):
+    write_files(tmp_path, {'a.opus': b'same', 'b.opus': b'same'})
+    with app.app_context():
+      files = build_manifest(str(tmp_path))
+      stats, _ = transcode_cache.store(app.config['PREVIEW_DIR'], files,
+                                       str(tmp_path), set())
+
+      assert stats.files == 1
+      assert transcode_cache.stats()['blobs'] == 1
+
+  def test_store_known_hashes_not_deduplicated(self, app, tmp_path):
+    write_files(tmp_path, {'a.opus': b'aaaa'})
+    with app.app_context():
+      files = build_manifest(str(tmp_path))
+      transcode_cache.store(app.config['PREVIEW_DIR'], files, str(tmp_path),
+                            set())
+
+      _, deduplicated = transcode_cache.store(app.config['PREVIEW_DIR'],
+                                              files, str(tmp_path),
+                                              {files['a.opus']['sha256']})
+
+      assert deduplicated == 0
+
+  def test_store_concurrently_stored(self, app, tmp_path):
+    write_files(tmp_path, {'a.opus': b'aaaa', 'b.opus': b'bbbb'})
+    with app.app_context():
+      files = build_manifest(str(tmp_path))
+      # Another build stores a.opus after this one looked for it.
+      with patch('rainfall.transcode_cache._get_blobs', return_value={}):
+        db.session.add(
+            TranscodeBlob(sha256=files['a.opus']['sha256'],
+                          size=4,
+                          last_used_at=utcnow(),
+                          dedup_count=0))
+        db.session.commit()
+        transcode_cache.store(app.config['PREVIEW_DIR'], files, str(tmp_path),
+                              set())
+
+      assert db.session.get(TranscodeBlob, files['b.opus']['sha256'])
+      assert transcode_cache.stats()['blobs'] == 2
+
+  def test_fetch_evicted(self, app, tmp_path):
+    with app.app_context():
+      files = {'a.opus': {'sha256': 'ab' * 32, 'size': 4}}
+
+      assert transcode_cache.fetch(app.config['PREVIEW_DIR'], files,
+                                   str(tmp_path)) is None
+    assert not os.listdir(tmp_path)
+
+  def test_evict_least_recently_used(self, app, tmp_path):
+    write_files(tmp_path, {'old': b'1111', 'new': b'2222'})
+    app.config['TRANSCODE_CACHE_MAX_BYTES'] = 5
+    with app.app_context():
+      files = build_manifest(str(tmp_path))
+      transcode_cache.store(app.config['PREVIEW_DIR'], files, str(tmp_path),
+                            set())
+      old = db.session.get(TranscodeBlob, files['old']['sha256'])
+      old.last_used_at = utcnow() - timedelta(days=1)
+      db.session.commit()
+
+      assert transcode_cache.evict(app.config['PREVIEW_DIR']) == 1
+
+      assert db.session.get(TranscodeBlob, files['old']['sha256']) is None
+      assert not object_storage.object_exists(
+          transcode_cache.blob_path(app.config['PREVIEW_DIR'],
+                                    files['old']['sha256']))
+      assert object_storage.object_exists(
+          transcode_cache.blob_path(app.config['PREVIEW_DIR'],
+                                    files['new']['sha256']))
@@ -0,0 +1,82 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import flask
+
+log = logging.getLogger(__name__)
+
+# Workspaces are the directories in the workspace root that start with this.
+PREFIX = 'rainfall-build-'
+# Added to the name of a workspace that is being removed.
+_REMOVING_SUFFIX = '.removing'
+
+
+class Workspace:
+  '''
+  The scratch directory of one build, with the catalog that faircamp builds
+  from, its build dir and its cache dir. No other build uses it, so builds
+  can run in parallel in any number of worker processes and machines.
+  '''
+
+  def __init__(self, path):
+    self.path = path
+    self.catalog_dir = os.path.join(path, 'catalog')
+    # Named like the published build, it's the top directory of zips.
+    self.build_dir = os.path.join(path, 'public')
+    self.cache_dir = os.path.join(path, 'cache')
+
+  def remove(self):
+    remove(self.path)
+
+
+def create(site_id):
+  '''
+  Creates a new workspace for a build of site_id in BUILD_WORKSPACE_DIR,
+  after removing the ones that builds which were killed left behind.
+  '''
+  config = flask.current_app.config
+  root = config['BUILD_WORKSPACE_DIR']
+  os.makedirs(root, exist_ok=True)
+  # A build can't run for longer than it holds the build lock.
+  remove_stale(root, config['PREVIEW_BUILD_LOCK_SECONDS'])
+  return Workspace(tempfile.mkdtemp(prefix=f'{PREFIX}{site_id}-', dir=root))
+
+
+def remove(path):
+  '''
+  Removes the workspace at path. It's renamed first, so it's gone in one
+  step, and a removal that is interrupted is finished by remove_stale.
+  '''
+  removing = path + _REMOVING_SUFFIX
+  try:
+    os.rename(path, removing)
+  except FileNotFoundError:
+    # Already removed.
+    return
+  shutil.rmtree(removing, ignore_errors=True)
+
+
+def remove_stale(root, max_age_seconds):
+  '''
+  Removes the workspaces in root that are older than max_age_seconds, and
+  the ones that are being removed.
+  '''
+  now = time.time()
+  with os.scandir(root) as entries:
+    for entry in entries:
+      if (not entry.name.startswith(PREFIX) or
+          not entry.is_dir(follow_symlinks=False)):
+        continue
+      try:
+        if entry.name.endswith(_REMOVING_SUFFIX):
+          shutil.rmtree(entry.path, ignore_errors=True)
+        elif (now - entry.stat(follow_symlinks=False).st_mtime >
+              max_age_seconds):
+          log.info('Removing stale build workspace %s', entry.path)
+          remove(entry.path)
+      except FileNotFoundError:
+        # Another worker removed it first.
+        pass
@@ -0,0 +1,43 @@
+import os
+import time
+
+from rainfall import workspace
+
+
+class WorkspaceTest:
+
+  def test_create(self, app, tmp_path):
+    app.config['BUILD_WORKSPACE_DIR'] = str(tmp_path)
+    with app.app_context():
+      first = workspace.create('site-1')
+      second = workspace.create('site-1')
+
+    assert first.path != second.path
+    assert os.path.dirname(first.path) == str(tmp_path)
+    assert first.build_dir == os.path.join(first.path, 'public')
+
+  def test_remove(self, tmp_path):
+    ws = workspace.Workspace(str(tmp_path / f'{workspace.PREFIX}site-1-a'))
+    os.makedirs(os.path.join(ws.catalog_dir, 'release'))
+
+    ws.remove()
+
+    assert os.listdir(tmp_path) == []
+
+  def test_remove_missing(self, tmp_path):
+    workspace.remove(str(tmp_path / f'{workspace.PREFIX}site-1-a'))
+
+    assert os.listdir(tmp_path) == []
+
+  def test_remove_stale(self, tmp_path):
+    for name in ('site-1-old', 'site-1-new', 'site-2-a.removing'):
+      os.makedirs(tmp_path / f'{workspace.PREFIX}{name}' / 'catalog')
+    os.makedirs(tmp_path / 'other')
+    old = time.time() - 120
+    os.utime(tmp_path / f'{workspace.PREFIX}site-1-old', (old, old))
+
+    workspace.remove_stale(tmp_path, 60)
+
+    assert sorted(os.listdir(tmp_path)) == [
+        'other', f'{workspace.PREFIX}site-1-new'
+    ]
@@ -0,0 +1,247 @@
+import bisect
+import hashlib
+import io
+import struct
+import time
+from dataclasses import dataclass
+
+import flask
+
+from rainfall import object_storage
+
+# Sizes and offsets from this value up need ZIP64 records.
+ZIP64_LIMIT = 0xFFFFFFFF
+# Entry counts from this value up need ZIP64 records.
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+# Stands in for a value that is in the ZIP64 records.
+_ZIP64_MARKER = 0xFFFFFFFF
+_ZIP64_COUNT_MARKER = 0xFFFF
+_UTF8_FLAG = 0x0800
+_ZIP64_VERSION = 45
+_DEFAULT_VERSION = 20
+# Regular file, rw-r--r--.
+_EXTERNAL_ATTR = 0o100644 << 16
+
+
+@dataclass
+class ZipEntry:
+  # The name in the archive.
+  name: str
+  # The object the contents are read from.
+  path: str
+  size: int
+  crc32: int
+  # Seconds since the epoch, or None for the earliest zip date.
+  mtime: int = None
+
+
+@dataclass
+class _ObjectSegment:
+  path: str
+  length: int
+
+
+def _dos_datetime(mtime):
+  if mtime is None:
+    return 0, (1 << 5) | 1
+  t = time.gmtime(max(mtime, 315532800))
+  return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+          ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class ZipLayout:
+  '''
+  The byte layout of an uncompressed zip of objects, computed from their
+  names, sizes and CRCs alone. That gives the archive's size before any of
+  it is read, and lets any byte range of it be produced on its own, reading
+  only the objects the range overlaps.
+  '''
+
+  def __init__(self, entries):
+    self.entries = list(entries)
+    self._segments = []
+    self._starts = []
+    self.size = 0
+
+    central_dir = bytearray()
+    for entry in self.entries:
+      offset = self.size
+      local_header, central_header = self._headers(entry, offset)
+      self._add(local_header)
+      if entry.size:
+        self._add(_ObjectSegment(entry.path, entry.size))
+      central_dir += central_header
+
+    cd_offset = self.size
+    self._add(bytes(central_dir))
+    self._add(self._end_records(cd_offset, len(central_dir)))
+
+    digest = hashlib.sha256()
+    for entry in self.entries:
+      digest.update(
+          f'{entry.name}\0{entry.size}\0{entry.crc32}\0{entry.mtime}\0'.encode(
+              'utf-8'))
+    self.etag = digest.hexdigest()
+
+  def _add(self, segment):
+    length = len(segment) if isinstance(segment, bytes) else segment.length
+    if not length:
+      return
+    self._starts.append(self.size)
+    self._segments.append(segment)
+    self.size += length
+
+  def _headers(self, entry, offset):
+    name = entry.name.encode('utf-8')
+    dos_time, dos_date = _dos_datetime(entry.mtime)
+    zip64_size = entry.size >= ZIP64_LIMIT
+    zip64_offset = offset >= ZIP64_LIMIT
+    version = _ZIP64_VERSION if zip64_size or zip64_offset else _DEFAULT_VERSION
+    size = _ZIP64_MARKER if zip64_size else entry.size
+
+    local_extra = b''
+    if zip64_size:
+      local_extra = struct.pack('<HHQQ', 1, 16, entry.size, entry.size)
+    local_header = struct.pack('<IHHHHHIIIHH', 0x04034b50, version,
+                               _UTF8_FLAG, 0, dos_time, dos_date, entry.crc32,
+                               size, size, len(name),
+                               len(local_extra)) + name + local_extra
+
+    # Only the fields that overflowed go in the central ZIP64 extra field.
+    fields = []
+    if zip64_size:
+      fields += [entry.size, entry.size]
+    if zip64_offset:
+      fields.append(offset)
+    central_extra = b''
+    if fields:
+      central_extra = struct.pack(f'<HH{len(fields)}Q', 1, 8 * len(fields),
+                                  *fields)
+    central_header = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50,
+                                 (3 << 8) | version, version, _UTF8_FLAG, 0,
+                                 dos_time, dos_date, entry.crc32, size, size,
+                                 len(name), len(central_extra), 0, 0, 0,
+                                 _EXTERNAL_ATTR, _ZIP64_MARKER if zip64_offset
+                                 else offset) + name + central_extra
+    return local_header, central_header
+
+  def _end_records(self, cd_offset, cd_size):
+    count = len(self.entries)
+    records = b''
+    zip64_count = count >= ZIP64_COUNT_LIMIT
+    zip64_size = cd_size >= ZIP64_LIMIT
+    zip64_offset = cd_offset >= ZIP64_LIMIT
+    if zip64_count or zip64_size or zip64_offset:
+      zip64_end_offset = cd_offset + cd_size
+      records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, _ZIP64_VERSION,
+                             _ZIP64_VERSION, 0, 0, count, count, cd_size,
+                             cd_offset)
+      records += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+    count = _ZIP64_COUNT_MARKER if zip64_count else count
+    records += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count,
+                           _ZIP64_MARKER if zip64_size else cd_size,
+                           _ZIP64_MARKER if zip64_offset else cd_offset, 0)
+    return records
+
+  def iter_bytes(self, start, stop, read_object):
+    '''
+    Yields the bytes of the archive from start up to stop.
+    read_object(path, offset, length) must yield that part of an object.
+    '''
+    i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+    for seg_start, segment in zip(self._starts[i:], self._segments[i:]):
+      if seg_start >= stop:
+        break
+      lo = max(start, seg_start) - seg_start
+      if isinstance(segment, bytes):
+        hi = min(stop - seg_start, len(segment))
+        yield segment[lo:hi]
+        continue
+
+      hi = min(stop - seg_start, segment.length)
+      read = 0
+      for chunk in read_object(segment.path, lo, hi - lo):
+        read += len(chunk)
+        yield chunk
+      if read != hi - lo:
+        # The object changed since the layout was computed, and the archive
+        # can't be completed with the size it was announced with.
+        raise object_storage.ObjectStorageException(
+            f'Expected {hi - lo} bytes of {segment.path}, got {read}')
+
+  def open(self):
+    '''Returns a readable binary file of the whole archive.'''
+    return io.BufferedReader(
+        _IterReader(self.iter_bytes(0, self.size,
+                                    object_storage.stream_object)),
+        buffer_size=object_storage.STREAM_CHUNK_SIZE)
+
+
+class _IterReader(io.RawIOBase):
+
+  def __init__(self, chunks):
+    self._chunks = chunks
+    self._pending = b''
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    while not self._pending:
+      self._pending = next(self._chunks, None)
+      if self._pending is None:
+        self._pending = b''
+        return 0
+    n = min(len(b), len(self._pending))
+    b[:n] = self._pending[:n]
+    self._pending = self._pending[n:]
+    return n
+
+  def close(self):
+    self._chunks.close()
+    super().close()
+
+
+@dataclass
+class _Stat:
+  etag: str
+  last_modified: object
+  size: int
+
+
+def send_zip(layout, download_name):
+  '''
+  Streams the archive of layout as an attachment in response to the current
+  request, honoring single byte Range requests.
+  '''
+  response = flask.Response(mimetype='application/zip',
+                            headers={'Accept-Ranges': 'bytes'})
+  response.headers['Content-Disposition'] = (
+      object_storage.content_disposition(download_name))
+  response.set_etag(layout.etag)
+
+  byte_range = object_storage.requested_range(
+      _Stat(layout.etag, None, layout.size))
+  if byte_range is False:
+    response.status_code = 416
+    response.headers['Content-Range'] = f'bytes */{layout.size}'
+    return response
+
+  if byte_range is None:
+    start, stop = 0, layout.size
+  else:
+    start, stop = byte_range
+    response.status_code = 206
+    response.headers['Content-Range'] = (
+        f'bytes {start}-{stop - 1}/{layout.size}')
+  response.content_length = stop - start
+
+  if flask.request.method == 'HEAD' or stop == start:
+    return response
+
+  # The objects are read while the response is sent, after the request and
+  # its database session are torn down, so the storage is looked up now.
+  response.response = layout.iter_bytes(start, stop,
+                                        object_storage.object_streamer())
+  return response
@@ -0,0 +1,100 @@
+import io
+import zipfile
+import zlib
+from unittest.mock import patch
+
+import pytest
+
+from rainfall import object_storage, zip_stream
+
+FILES = {
+    'objects/index.html': b'<html></html>',
+    'objects/empty.txt': b'',
+    'objects/album/song.mp3': b'mp3' * 1000,
+}
+
+
+def entries(files=FILES):
+  return [
+      zip_stream.ZipEntry(name=f'public/{path.split("/", 1)[1]}',
+                          path=path,
+                          size=len(data),
+                          crc32=zlib.crc32(data),
+                          mtime=1700000000) for path, data in files.items()
+  ]
+
+
+def read_object(path, offset, length):
+  data = FILES[path][offset:offset + length]
+  # Several chunks, like a real stream.
+  for i in range(0, len(data), 100):
+    yield data[i:i + 100]
+
+
+def archive(layout):
+  return b''.join(layout.iter_bytes(0, layout.size, read_object))
+
+
+class ZipStreamTest:
+
+  def test_archive(self):
+    layout = zip_stream.ZipLayout(entries())
+    data = archive(layout)
+
+    assert len(data) == layout.size
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+      assert zf.testzip() is None
+      assert zf.read('public/album/song.mp3') == b'mp3' * 1000
+      assert zf.read('public/empty.txt') == b''
+      assert zf.getinfo('public/index.html').date_time == (2023, 11, 14, 22,
+                                                           13, 20)
+
+  def test_ranges(self):
+    layout = zip_stream.ZipLayout(entries())
+    data = archive(layout)
+
+    for start, stop in ((0, 10), (25, 3000), (100, layout.size),
+                        (layout.size - 1, layout.size)):
+      assert b''.join(layout.iter_bytes(start, stop,
+                                        read_object)) == data[start:stop]
+
+  @patch('rainfall.zip_stream.ZIP64_COUNT_LIMIT', 2)
+  @patch('rainfall.zip_stream.ZIP64_LIMIT', 1000)
+  def test_zip64(self):
+    # The song's size and the offsets of the entries after it need ZIP64.
+    layout = zip_stream.ZipLayout(reversed(entries()))
+
+    with zipfile.ZipFile(io.BytesIO(archive(layout))) as zf:
+      assert zf.testzip() is None
+      assert zf.read('public/album/song.mp3') == b'mp3' * 1000
+      assert len(zf.infolist()) == 3
+
+  def test_etag(self):
+    changed = dict(FILES)
+    changed['objects/index.html'] = b'<html>changed</html>'
+
+    assert zip_stream.ZipLayout(entries()).etag == zip_stream.ZipLayout(
+        entries()).etag
+    assert zip_stream.ZipLayout(entries()).etag != zip_stream.ZipLayout(
+        entries(changed)).etag
+
+  def test_object_changed(self):
+    layout = zip_stream.ZipLayout(entries())
+
+    with pytest.raises(object_storage.ObjectStorageException):
+      b''.join(
+          layout.iter_bytes(0, layout.size, lambda path, offset, length:
+                            [b'short']))
+
+  def test_send_zip_after_request(self, app):
+    with app.app_context():
+      for path, data in FILES.items():
+        object_storage.put_object(path, io.BytesIO(data),
+                                  'application/octet-stream')
+    layout = zip_stream.ZipLayout(entries())
+
+    with app.test_request_context('/'):
+      response = zip_stream.send_zip(layout, 'rainfall_site.zip')
+
+    # The body is sent after the request context is gone.
+    assert b''.join(response.response) == archive(layout)